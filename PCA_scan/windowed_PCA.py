@@ -1,9 +1,13 @@
+import os
+import sys
 import gzip
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from hapmatrix import HapMatrix, SampleView, hapmatrix_exists, snp_window_bounds, read_sample_manifest, manifest_haplotypes, manifest_tag
 
 
 
@@ -33,7 +37,7 @@ def _get_record_position(record):
 
 
 
-def pca_on_window(haplo_matrix):
+def pca_on_window(haplo_matrix, haplotypes=None):
     """
     Takes in a ndarray of haplotypes for a window and performs a principal component analysis.
     Input look like:
@@ -43,9 +47,15 @@ def pca_on_window(haplo_matrix):
     ...
     hapN
 
+    haplotypes (np.ndarray or slice or None): rows of the haplotypes to keep e.g. from manifest_haplotypes in haplotype_matrix/hapmatrix.py, default is all rows
+
     Returns PCA 2D matrix and percent variance for each PC
     """
 
+    #select haplotypes of a sample subset
+    if haplotypes is not None:
+        haplo_matrix = haplo_matrix[haplotypes]
+
     #normalize
     scaler = StandardScaler()
     scaled_data = scaler.fit_transform(haplo_matrix)
@@ -63,7 +73,7 @@ def pca_on_window(haplo_matrix):
 
 
 
-def run_pca_on_SNP_windows(vcfgz, SNPwindow, output_dir=""):
+def run_pca_on_SNP_windows(vcfgz, SNPwindow, output_dir="", manifest=None):
     """
     Runs principal component analysis on haplotypes from a phased vcf in non-overlapping SNP windows
 
@@ -71,8 +81,19 @@ def run_pca_on_SNP_windows(vcfgz, SNPwindow, output_dir=""):
     PCA of 2 PCs using sklearn. It will then output a csv file of PCs for each window will be saved
     to the given output_dir (default is the current dir). After the windowing complete, the function
     will also save a csv of explained variance of each PC for each window.
+
+    If a sample manifest is given (see read_sample_manifest in haplotype_matrix/hapmatrix.py) only the
+    haplotypes of its samples are used and the manifest name is added to the output file names.
     """
 
+    #read from the bit-packed haplotype matrix if it was built for this vcf
+    if hapmatrix_exists(vcfgz):
+        _hapmatrix_pca_on_SNP_windows(vcfgz, SNPwindow, output_dir, manifest)
+        return
+
+    #haplotypes of the manifest samples
+    haplotypes = None
+
     #empty lists for variance explained df
     win = []
     pos = []
@@ -95,8 +116,13 @@ def run_pca_on_SNP_windows(vcfgz, SNPwindow, output_dir=""):
         #loop through lines
         for line in vcf:
 
+            #select the haplotypes of the manifest samples, the haplotypes are split on "|" so samples are diploid
+            if line.startswith("#CHROM") and manifest is not None:
+                haplotypes = manifest_haplotypes(line.strip().split("\t")[9:], read_sample_manifest(manifest), 2)
+                continue
+
             #skip header
-            if line.startswith("#"):
+            elif line.startswith("#"):
                 continue
 
             #run through SNPs
@@ -123,10 +149,10 @@ def run_pca_on_SNP_windows(vcfgz, SNPwindow, output_dir=""):
                     matrix = np.transpose(matrix)
 
                     #running PCA
-                    pcdf, v1, v2 = pca_on_window(matrix)
+                    pcdf, v1, v2 = pca_on_window(matrix, haplotypes)
                     pc1v.append(v1)
                     pc2v.append(v2)
-                    pcdf.to_csv(f"{output_dir}win{window_counter}_windowsize{SNPwindow}_from_{start_pos}_to_{end_pos}_{vcfgz}".replace(".vcf.gz", ".csv"), index=False)
+                    pcdf.to_csv(f"{output_dir}win{window_counter}_windowsize{SNPwindow}_from_{start_pos}_to_{end_pos}{manifest_tag(manifest)}_{vcfgz}".replace(".vcf.gz", ".csv"), index=False)
 
                     #resetting counts
                     SNP_counter = 0
@@ -151,17 +177,59 @@ def run_pca_on_SNP_windows(vcfgz, SNPwindow, output_dir=""):
             matrix = np.array(matrix)
             matrix = np.transpose(matrix)
 
-            pcdf, v1, v2 = pca_on_window(matrix)
+            pcdf, v1, v2 = pca_on_window(matrix, haplotypes)
             pc1v.append(v1)
             pc2v.append(v2)
-            pcdf.to_csv(f"{output_dir}win{window_counter}_windowsize{SNPwindow}_from_{start_pos}_to_{end_pos}_{vcfgz}".replace(".vcf.gz", ".csv"), index=False)
+            pcdf.to_csv(f"{output_dir}win{window_counter}_windowsize{SNPwindow}_from_{start_pos}_to_{end_pos}{manifest_tag(manifest)}_{vcfgz}".replace(".vcf.gz", ".csv"), index=False)
 
             #clear matrix
             matrix = []
 
     #saving variance explained csv
     vdf = pd.DataFrame({"Window":win, "POS":pos, "PC1_variance":pc1v, "PC2_variance":pc2v})
-    vdf.to_csv(f"{output_dir}var_explained_windowsize{SNPwindow}_{vcfgz}".replace(".vcf.gz", ".csv"), index=False)
+    vdf.to_csv(f"{output_dir}var_explained_windowsize{SNPwindow}{manifest_tag(manifest)}_{vcfgz}".replace(".vcf.gz", ".csv"), index=False)
+
+    print(f"Done sliding window PCA for {vcfgz} with window size {SNPwindow}")
+
+
+
+def _hapmatrix_pca_on_SNP_windows(vcfgz, SNPwindow, output_dir="", manifest=None):
+    """
+    Runs the same non-overlapping window PCA as run_pca_on_SNP_windows on the bit-packed haplotype matrix
+    built with haplotype_matrix/hapmatrix.py. Windows are sliced from the memory-mapped matrix instead of parsed from the vcf.
+    """
+
+    #empty lists for variance explained df
+    win = []
+    pos = []
+    pc1v = []
+    pc2v = []
+
+    #open haplotype matrix
+    hapmat = HapMatrix(vcfgz)
+    hapsites = hapmat if manifest is None else SampleView(hapmat, hapmat.samples, read_sample_manifest(manifest))
+
+    #loop through non-overlapping windows
+    for window_counter, (lo, hi) in enumerate(snp_window_bounds(hapmat.num_sites, SNPwindow, SNPwindow)):
+
+        #logging meta data
+        start_pos = int(hapmat.positions[lo])
+        end_pos = int(hapmat.positions[hi - 1])
+        win.append(window_counter)
+        pos.append((start_pos + end_pos) // 2)
+
+        #slicing and transposing
+        matrix = np.transpose(hapsites.sites(lo, hi))
+
+        #running PCA
+        pcdf, v1, v2 = pca_on_window(matrix)
+        pc1v.append(v1)
+        pc2v.append(v2)
+        pcdf.to_csv(f"{output_dir}win{window_counter}_windowsize{SNPwindow}_from_{start_pos}_to_{end_pos}{manifest_tag(manifest)}_{vcfgz}".replace(".vcf.gz", ".csv"), index=False)
+
+    #saving variance explained csv
+    vdf = pd.DataFrame({"Window":win, "POS":pos, "PC1_variance":pc1v, "PC2_variance":pc2v})
+    vdf.to_csv(f"{output_dir}var_explained_windowsize{SNPwindow}{manifest_tag(manifest)}_{vcfgz}".replace(".vcf.gz", ".csv"), index=False)
 
     print(f"Done sliding window PCA for {vcfgz} with window size {SNPwindow}")
 
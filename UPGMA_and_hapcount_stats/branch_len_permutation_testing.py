@@ -6,6 +6,8 @@ from statistics import stdev
 import scipy.stats
 import random
 import matplotlib.pyplot as plt
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from window_table import load_window_table
 
 
 random.seed(672)
@@ -197,7 +199,7 @@ def run_ztest_on_percentile(tsvfile, percentile, param_to_define_percentile, par
     Main function to run permutation Z-test on a specified parameter to test for a significant difference of this parameter
     between its values above the nth percentile of another paramter and its values in the dataset as a whole.
     
-    :param tsvfile: file of windowed average branch length, repeat density, SNP density, and any other relevant parameters
+    :param tsvfile: file of windowed average branch length, repeat density, SNP density, and any other relevant parameters, a tsv with a header line or a window table .npz
     :type tsvfile: str
     :param percentile: percentile to filter data
     :type percentile: float
@@ -211,7 +213,8 @@ def run_ztest_on_percentile(tsvfile, percentile, param_to_define_percentile, par
     :type plottitle: str
     """
 
-    data = pd.read_csv(tsvfile, sep="\t")
+    #window tables are loaded without parsing text (see haplotype_matrix/window_table.py)
+    data = load_window_table(tsvfile) if tsvfile.endswith(".npz") else pd.read_csv(tsvfile, sep="\t")
 
     top, size = _avg_nth_percentile_of_data(data, percentile, param_to_define_percentile, param_to_perform_ztest)
 
@@ -229,7 +232,7 @@ def run_ztest_on_coordinates(tsvfile, coordinates_to_extract, param_to_perform_z
     Main function to run permutation Z-test on a specified parameter to test for a significant difference of this parameter
     between its values above the nth percentile of another paramter and its values in the dataset as a whole.
     
-    :param tsvfile: file of windowed average branch length, repeat density, SNP density, and any other relevant parameters
+    :param tsvfile: file of windowed average branch length, repeat density, SNP density, and any other relevant parameters, a tsv with a header line or a window table .npz
     :type tsvfile: str
     :param coordinates_to_extract: list of tuples with regions to include [("chrom", start, end)...]
     :type coordinates_to_extract: list of tuples of str, int, and int
@@ -241,7 +244,8 @@ def run_ztest_on_coordinates(tsvfile, coordinates_to_extract, param_to_perform_z
     :type plottitle: str
     """
 
-    data = pd.read_csv(tsvfile, sep="\t")
+    #window tables are loaded without parsing text (see haplotype_matrix/window_table.py)
+    data = load_window_table(tsvfile) if tsvfile.endswith(".npz") else pd.read_csv(tsvfile, sep="\t")
 
     top, size = _avg_from_windows_within_coordinates(data, coordinates_to_extract, param_to_perform_ztest)
 
@@ -1,11 +1,26 @@
-import gzip
+import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.cluster.hierarchy import dendrogram, linkage
-from collections import deque
+from functools import partial
 from multiprocessing import Pool
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from hapmatrix import HapMatrix, SampleView, hapmatrix_exists, snp_window_bounds, load_positions, read_sample_manifest, manifest_tag, vcf_samples
+from gt_parser import parse_record
+from bgzf_reader import bgzf_open
+from window_buffer import WindowBuffer
+from shards import ShardLoader, scan_shards, shard_sites, stitch_shards
+from window_kernels import avg_branch
+from checkpoint import open_checkpoint
+from scheduler import estimate_job, run_scheduled
+from window_pool import ordered_window_map
+from collapsed_upgma import collapsed_linkage
+from sliding_hamming import SlidingHamming
+from packed_distances import euclidean_distances
+from downsampled_upgma import downsample_tag, stat_columns, downsampled_stats
+from linkage_archive import LinkageArchiveWriter, archive_path, stitch_linkage_archives
 sys.setrecursionlimit(10000)
 
 
@@ -33,104 +48,100 @@ def _joinany(sep, mylist):
 
 
 
-def _pop_step(d, step):
-    """
-    Helper function used to pop a number of elements from the left
-    of a deque equal to the step size in. This is done in place.
-    """
+def _find_avg_branch(linkage_array):
+    """Helper function that finds the noramlized average branch length from a linakge array (see haplotype_matrix/window_kernels.py)"""
 
-    for i in range(step):
-        d.popleft()
+    #averaging the merge heights over the tree height
+    return avg_branch(linkage_array[:, 2])
 
 
-def _construct_matrix(d):
+
+def _runUPGMA(haplo_matrix, collapse=False, dists=None, keep_tree=False):
     """
-    Helper function takes in the window deque and constructs the haplo matrix
+    Helper function runs UPGMA on haplotypes.
 
-    d (deque of RecordLoader objects): window deque
+    haplo_matrix (np.ndarray): each row is a site and each column is the haplotype at that site
+    collapse (bool): cluster the distinct haplotypes weighted by their copies instead of every haplotype (see haplotype_matrix/collapsed_upgma.py), default is False
+    dists (np.ndarray or None): condensed euclidean distances between the haplotypes (see haplotype_matrix/sliding_hamming.py), default is computing them from the packed haplotypes
+    keep_tree (bool): also return the linkage array, default is False
 
-    Returns list of lists: each sublist is a site and each sublist element is the haplotype at that site
+    Returns float for normalized average branch length, and ndarray from linkage() with keep_tree
     """
 
-    matrix = []
-    for record in d:
-        hap_ls = []
-        for gt in record.GTs:
-            # if "|" in gt:
-            #     haps = gt.split("|")
-            #     hap_ls.append(int(haps[0]))
-            #     hap_ls.append(int(haps[1]))
-            # else:
-            #     hap_ls.append(int(gt))
-            haps = gt.split("|")
-            for h in haps:
-                hap_ls.append(int(h))
-        matrix.append(hap_ls)
+    #running UPGMA on the distinct haplotypes
+    if collapse:
+        tre = collapsed_linkage(haplo_matrix, dists)
 
+    else:
+        #distances of the bit-packed haplotypes, in float64 like the linkage (see haplotype_matrix/packed_distances.py)
+        if dists is None:
+            dists = euclidean_distances(haplo_matrix, np.float64)
 
-    return matrix
+        #running UPGMA
+        tre = linkage(dists, method="average")
+    
+    #finding average branch length
+    avglen = _find_avg_branch(tre)
 
+    if keep_tree:
+        return avglen, tre
 
+    return avglen
 
-def _find_avg_branch(linkage_array):
-    """Helper function that finds the noramlized average branch length from a linakge array"""
 
-    #tree height
-    tree_height = linkage_array[-1, 2]
 
-    #lengths
-    lengths = []
-    for clust in linkage_array:
-        lengths.append(clust[2])
+def _window_stats(haplo_matrix, collapse=False, dists=None, draws=None, keep_tree=False):
+    """
+    Helper function runs UPGMA on a window, on all of its haplotypes or on each draw of a downsampled scan.
 
-    #averaging
-    avg_branch = (sum(lengths) / len(lengths)) / tree_height
+    haplo_matrix (np.ndarray): each row is a site and each column is the haplotype at that site
+    collapse (bool): cluster the distinct haplotypes weighted by their copies, default is False
+    dists (np.ndarray or None): condensed euclidean distances between all haplotypes, default is computing them from the packed haplotypes
+    draws (list of np.ndarray or None): haplotype columns of each draw (see haplotype_matrix/downsampled_upgma.py), default is all haplotypes
+    keep_tree (bool): keep the linkage array of all haplotypes for the linkage archive, default is False
 
-    return avg_branch
+    Returns list of the output values of the window, the average branch length or its mean and standard deviation over the draws,
+    and the linkage array of the window or None without keep_tree
+    """
 
+    if draws is None:
+        if keep_tree:
+            avglen, tre = _runUPGMA(haplo_matrix, collapse, dists, True)
+            return [avglen], tre
+        return [_runUPGMA(haplo_matrix, collapse, dists)], None
 
+    return downsampled_stats(partial(_runUPGMA, collapse=collapse), haplo_matrix, draws), None
 
-def _runUPGMA(haplo_matrix):
-    """
-    Helper function runs UPGMA on haplotypes.
 
-    haplo_matrix (list of lists): each sublist is a site and each sublist element is the haplotype at that site
 
-    Returns float for normalized average branch length #####and ndarray from linkage()
-    """
+def _header(downsample=None):
+    """Helper gives the csv header line, a downsampled scan adds the standard deviation of the average branch length"""
 
-    #converting matrix to array and transposing
-    matrix = np.array(haplo_matrix)
-    matrix = np.transpose(matrix)
+    return ",".join(["CHROM", "START", "END"] + stat_columns(["AVG_branch_length"], downsample)) + "\n"
 
-    #running UPGMA
-    tre = linkage(matrix, method="average", metric="euclidean")
-    
-    #finding average branch length
-    avglen = _find_avg_branch(tre)
 
 
-    return avglen       #, tre
+def _outfile(chrom, SNPwindow_size, SNPwindow_step, manifest=None, downsample=None):
+    """Helper gives the output file name of a scan"""
 
+    return f"{chrom}_window{SNPwindow_size}_step{SNPwindow_step}{manifest_tag(manifest)}{downsample_tag(downsample)}_avg_branch_len.csv"
 
 
-### CLASSES ###
 
-class RecordLoader():
-    def __init__(self, vcfline):
-        """
-        This class is for parsing a vcf record for it to be added to a deque.
-        The class as two attributes:
-        position (int): record position
-        GTs (list of str): list of individual genotypes e.g. ["0|0", "1|0"...]
-        """
+def _check_archive(archive, resume=False, downsample=None):
+    """Helper exits on the settings a linkage archive cannot be written with"""
+
+    if archive and resume:
+        exit("the linkage archive is written from scratch and cannot be resumed, rerun the scan without resume")
+    if archive and downsample is not None:
+        exit("the linkage archive holds the trees of all haplotypes, it cannot be written by a downsampled scan")
 
-        self.position = int(vcfline.strip().split("\t")[1])
-        self.GTs = vcfline.strip().split("\t")[9:]
 
 
+### CLASSES ###
+
 class ArgLoader():
-    def __init__(self, vcfgz_file, windowsize, windowstep):     #, intervals_to_plot=None
+    def __init__(self, vcfgz_file, windowsize, windowstep, decompress_threads=1, manifest=None, checkpoint=None, resume=False, window_threads=1, collapse=False, sliding_dists=False, downsample=None, archive=False):     #, intervals_to_plot=None
         """
         Class used to store arguments for the windowed_UPGMA_scan function which is run using the run_UPGMA_scan main function.
         This is done so that the main function takes a single argument so that it can be run in parallel.
@@ -138,12 +149,30 @@ class ArgLoader():
         vcfgz_file (str): filename or path to file for the vcf to scan
         windowsize (int): SNP window size
         windowstep (int): SNP window step, recommended to be 10% of windowsize
+        decompress_threads (int): number of threads inflating the vcf, default is 1
+        manifest (str or None): sample manifest of the samples to scan, default is all samples
+        checkpoint (int or None): number of windows between checkpoints of the output, default is no checkpoints
+        resume (bool): continue the output of an interrupted scan from its checkpoint, default is False
+        window_threads (int): number of threads running UPGMA on the windows, default is 1
+        collapse (bool): run UPGMA on the distinct haplotypes weighted by their copies, default is False
+        sliding_dists (bool): update the Hamming distances between haplotypes from window to window instead of counting them for every window, default is False
+        downsample (Downsampling or None): run UPGMA on random draws of haplotypes of each window, default is all haplotypes
+        archive (bool): write the linkage array of every window to a linkage archive, default is False
         #####intervals_to_plot (default is None, set to [(int,int,int),...]): genomic intervals (1st and 2nd int) in which to plot some trees. The 3rd int specifies to plot a tree every n windows.
         """
 
         self.vcf = vcfgz_file
         self.winsize = windowsize
         self.winstep = windowstep
+        self.threads = decompress_threads
+        self.manifest = manifest
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.window_threads = window_threads
+        self.collapse = collapse
+        self.sliding_dists = sliding_dists
+        self.downsample = downsample
+        self.archive = archive
         # self.plot_here = intervals_to_plot
 
     def __str__(self):
@@ -154,7 +183,7 @@ class ArgLoader():
 
 ### SLIDING WINDOW SCAN FUNCTION ###
 
-def windowed_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step):     #, plotting_intervals
+def windowed_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step, decompress_threads=1, manifest=None, checkpoint=None, resume=False, window_threads=1, collapse=False, sliding_dists=False, downsample=None, archive=False):     #, plotting_intervals
     """
     Function performs the windowed UPGMA scan on a gizped vcf, and outputs 
     Average Branch Length results to a csv. See other functions for details.
@@ -162,51 +191,110 @@ def windowed_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step):     #, plotting_
     vcfgz (str): gziped vcf file name or path to file.
     SNPwindow_size (int): number of SNPs defining the window size.
     SNPwindow_step (int): number of SNPs to slide window, recommended to be 10% of SNPwindow_size.
+    decompress_threads (int): number of threads inflating the BGZF blocks of the vcf (see haplotype_matrix/bgzf_reader.py), default is 1.
+    manifest (str or None): sample manifest (see read_sample_manifest in haplotype_matrix/hapmatrix.py), UPGMA is only run on the haplotypes of its samples
+        and the manifest name is added to the output file name, default is all samples.
+    checkpoint (int or None): number of windows between checkpoints (see haplotype_matrix/checkpoint.py), the output is then written from scratch
+        instead of appended to and flushed to disk with a checkpoint of the last written window every checkpoint windows, default is no checkpoints.
+    resume (bool): continue the output of an interrupted checkpointed scan, it is truncated to its checkpoint and the scan seeks to the next window
+        with the tabix index (or slices the haplotype matrix), an output without a checkpoint is finished and skipped, default is False.
+    window_threads (int): number of threads running UPGMA on the windows (see haplotype_matrix/window_pool.py), the windows are sliced in order
+        and their lines written in order. Above 1 the vcf is scanned as one shard from its cached positions (see run_UPGMA_shard), default is 1.
+    collapse (bool): cluster the distinct haplotypes of each window weighted by their copies (see haplotype_matrix/collapsed_upgma.py), the distances
+        and clustering then scale with the distinct haplotypes instead of the sample size. The merge heights are the averages of the full tree, but
+        UPGMA of tied distances is not unique and the distinct haplotypes may break ties the other way, default is False.
+    sliding_dists (bool): keep the mismatch counts between haplotypes from window to window, subtracting the SNPs leaving the window and adding
+        those entering it with packed XOR and popcount (see haplotype_matrix/sliding_hamming.py), instead of counting them for every window.
+        The distances are the same so the output is unchanged, default is False.
+    downsample (Downsampling or None): estimate the average branch length from random draws of haplotypes of each window (see haplotype_matrix/downsampled_upgma.py),
+        e.g. Downsampling(500, 10) runs UPGMA on 10 draws of 500 haplotypes and writes the mean and standard deviation over the draws.
+        The draws are seeded by the window so they are the same in every scan mode, sliding_dists is not used as every window draws
+        its own haplotypes, and the draws are tagged in the output file name, default is all haplotypes.
+    archive (bool): also write the linkage array of every window to a linkage archive named after the output e.g. chr2_window1000_step500_linkage.npz
+        (see haplotype_matrix/linkage_archive.py), so that other branch statistics and dendrograms are read from the stored trees instead of
+        running UPGMA again. The archive is written from scratch so it cannot be resumed, and it is not written by downsampled scans, default is False.
     #####plotting_intervals ([(int, int, int)] or None): genomic position intervals (1st and 2nd int) in which to plot UPGMA trees. The 3rd int specifies to plot a tree every n windows.
     """
 
-    #setting up deque for sliding window
-    window_deque = deque()
+    if resume and checkpoint is None:
+        exit("resume needs checkpoint, the number of windows between checkpoints")
+    _check_archive(archive, resume, downsample)
+
+    #continue the output of an interrupted scan from its checkpoint
+    if resume:
+        _single_shard_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step, checkpoint, True, decompress_threads, manifest, window_threads, collapse, sliding_dists, downsample, archive)
+        return
+
+    #read from the bit-packed haplotype matrix if it was built for this vcf
+    if hapmatrix_exists(vcfgz):
+        _hapmatrix_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step, manifest, checkpoint, window_threads, collapse, sliding_dists, downsample, archive)
+        return
+
+    #windows are sliced ahead of the window threads from the cached positions
+    if window_threads > 1:
+        _single_shard_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step, checkpoint, False, decompress_threads, manifest, window_threads, collapse, sliding_dists, downsample, archive)
+        return
+
+    #setting up the array-backed sliding window (see haplotype_matrix/window_buffer.py)
+    window = WindowBuffer()
+    hapsites = window
+
+    #distances kept from window to window, or haplotypes drawn in each window
+    hamming = SlidingHamming() if sliding_dists and downsample is None else None
+    sampler = None if downsample is None else downsample.sampler(vcfgz, manifest)
 
     #window counter
     counter = -1
 
     #open files
     chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
-    with gzip.open(vcfgz, "rt") as vcf, open(f"{chrom}_window{SNPwindow_size}_step{SNPwindow_step}_avg_branch_len.csv", "a") as outcsv:
+    outfile = _outfile(chrom, SNPwindow_size, SNPwindow_step, manifest, downsample)
+    ckpt = None if checkpoint is None else open_checkpoint(outfile, checkpoint)
+    trees = LinkageArchiveWriter(archive_path(outfile), chrom) if archive else None
+    with bgzf_open(vcfgz, "rb", threads=decompress_threads) as vcf, open(outfile, "a" if ckpt is None else ckpt.mode()) as outcsv:
 
         #write header line
-        outcsv.write(",".join(["CHROM", "START", "END", "AVG_branch_length"]) + "\n")
+        outcsv.write(_header(downsample))
+        if ckpt is not None:
+            ckpt.start(outcsv)
 
         #loop through lines
         for line in vcf:
 
+            #select the haplotypes of the manifest samples from the window
+            if line.startswith(b"#CHROM") and manifest is not None:
+                hapsites = SampleView(window, line.decode().strip().split("\t")[9:], read_sample_manifest(manifest))
+                continue
+
             #skip header lines
-            if line.startswith("#"):
+            elif line.startswith(b"#"):
                 continue
 
             #sliding window scan
             else:
 
-                #load record into deque
-                window_deque.append(RecordLoader(line))
+                #load record into window
+                window.append(*parse_record(line))
 
                 #check if window size was reached, if yes, move the window by a step, output results, and continue
-                if len(window_deque) >= SNPwindow_size:
+                if len(window) >= SNPwindow_size:
 
                     #progress window counter (0-based index)
                     counter += 1
 
                     #grab window position
-                    start_pos = window_deque[0].position
-                    end_pos = window_deque[-1].position + 1
+                    lo = window.first
+                    start_pos = window.first_position()
+                    end_pos = window.last_position() + 1
                     # win_pos = (start_pos + end_pos) // 2
 
-                    #construct haplo matrix
-                    hap_m = _construct_matrix(window_deque)
+                    #grab haplo matrix of the window
+                    hap_m = hapsites.sites(window.first, window.num_appended())
 
                     #run UPGMA
-                    avgbranchlen = _runUPGMA(hap_m)     #, tree_array
+                    dists = None if hamming is None else hamming.distances(hap_m, window.first, window.num_appended())
+                    draws = None if sampler is None else sampler.draws(hap_m.shape[1], window.first, window.num_appended())
+                    stats, tree_array = _window_stats(hap_m, collapse, dists, draws, archive)
 
                     # #plot tree?
                     # if plotting_intervals:
@@ -218,30 +306,141 @@ def windowed_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step):     #, plotting_
 
 
                     #sliding to next step
-                    _pop_step(window_deque, SNPwindow_step)
+                    window.pop(SNPwindow_step)
 
                     #write to file
-                    outcsv.write(_joinany(",", [chrom, start_pos, end_pos, avgbranchlen]) + "\n")
+                    outcsv.write(_joinany(",", [chrom, start_pos, end_pos] + stats) + "\n")
+                    if trees is not None:
+                        trees.add(start_pos, end_pos, tree_array)
+                    if ckpt is not None:
+                        ckpt.window_done(outcsv, lo, start_pos)
 
                 else:
                     continue
 
         #clean up last window
-        if len(window_deque) > 0:
+        if len(window) > 0:
             
             #grab window position
-            start_pos = window_deque[0].position
-            end_pos = window_deque[-1].position + 1
-            # win_pos = (window_deque[0].position + window_deque[-1].position) // 2
+            start_pos = window.first_position()
+            end_pos = window.last_position() + 1
+            # win_pos = (window.first_position() + window.last_position()) // 2
 
-            #construct haplo matrix
-            hap_m = _construct_matrix(window_deque)
+            #grab haplo matrix of the window
+            hap_m = hapsites.sites(window.first, window.num_appended())
 
             #run UPGMA
-            avgbranchlen = _runUPGMA(hap_m)     #, tree_array
+            dists = None if hamming is None else hamming.distances(hap_m, window.first, window.num_appended())
+            draws = None if sampler is None else sampler.draws(hap_m.shape[1], window.first, window.num_appended())
+            stats, tree_array = _window_stats(hap_m, collapse, dists, draws, archive)
             
             #write to file
-            outcsv.write(_joinany(",", [chrom, start_pos, end_pos, avgbranchlen]) + "\n")
+            outcsv.write(_joinany(",", [chrom, start_pos, end_pos] + stats) + "\n")
+            if trees is not None:
+                trees.add(start_pos, end_pos, tree_array)
+            if ckpt is not None:
+                ckpt.window_done(outcsv, window.first, start_pos)
+
+    #every window is written
+    if trees is not None:
+        trees.close()
+    if ckpt is not None:
+        ckpt.finish()
+
+
+
+
+def _hapmatrix_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step, manifest=None, checkpoint=None, window_threads=1, collapse=False, sliding_dists=False, downsample=None, archive=False):
+    """
+    Runs the same scan as windowed_UPGMA_scan on the bit-packed haplotype matrix built with
+    haplotype_matrix/hapmatrix.py. Windows are sliced from the memory-mapped matrix instead of parsed from the vcf.
+    """
+
+    #open haplotype matrix
+    hapmat = HapMatrix(vcfgz)
+    hapsites = hapmat if manifest is None else SampleView(hapmat, hapmat.samples, read_sample_manifest(manifest))
+
+    #open files
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    outfile = _outfile(chrom, SNPwindow_size, SNPwindow_step, manifest, downsample)
+    ckpt = None if checkpoint is None else open_checkpoint(outfile, checkpoint)
+    trees = LinkageArchiveWriter(archive_path(outfile), chrom) if archive else None
+    with open(outfile, "a" if ckpt is None else ckpt.mode()) as outcsv:
+
+        #write header line
+        outcsv.write(_header(downsample))
+        if ckpt is not None:
+            ckpt.start(outcsv)
+
+        #loop through windows
+        _write_windows(chrom, hapsites, hapmat.positions, snp_window_bounds(hapmat.num_sites, SNPwindow_size, SNPwindow_step), outcsv, ckpt, window_threads, collapse, sliding_dists,
+                       None if downsample is None else downsample.sampler(vcfgz, manifest), trees)
+
+    if trees is not None:
+        trees.close()
+    if ckpt is not None:
+        ckpt.finish()
+
+
+
+
+def _single_shard_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step, checkpoint=None, resume=False, decompress_threads=1, manifest=None, window_threads=1, collapse=False, sliding_dists=False, downsample=None, archive=False):
+    """
+    Runs windowed_UPGMA_scan as a single shard spanning all of its windows (see run_UPGMA_shard). Used to continue the output
+    of an interrupted checkpointed scan, the shard seeks to the window after the checkpoint with the tabix index, and to
+    scan on window threads, the shard knows the bounds of every window from the cached positions.
+    """
+
+    positions = load_positions(vcfgz, decompress_threads)
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    outfile = _outfile(chrom, SNPwindow_size, SNPwindow_step, manifest, downsample)
+
+    num_windows = len(snp_window_bounds(len(positions), SNPwindow_size, SNPwindow_step))
+    shard = ShardLoader(vcfgz, SNPwindow_size, SNPwindow_step, 0, num_windows, outfile, decompress_threads, manifest, window_threads=window_threads)
+    run_UPGMA_shard(shard, checkpoint, resume, header=True, collapse=collapse, sliding_dists=sliding_dists, downsample=downsample, archive=archive)
+
+
+
+
+def _write_windows(chrom, hapsites, positions, bounds, outcsv, checkpoint=None, window_threads=1, collapse=False, sliding_dists=False, sampler=None, trees=None):
+    """
+    Runs UPGMA on each window of a list of SNP windows and writes the csv lines.
+    Used by the haplotype matrix scan and by the shards of the parallel scan.
+
+    chrom (str): chromosome name for the output
+    hapsites (HapMatrix or ShardSites or SampleView): sites to slice the windows from
+    positions (np.ndarray of int64): positions of all sites
+    bounds (list of (int, int)): [first_site, last_site) index pairs of the windows to scan, in order
+    outcsv (file): open output file
+    checkpoint (ScanCheckpoint or None): checkpoint of the output, counts the written windows, default is no checkpoints
+    window_threads (int): number of threads running UPGMA on the windows, default is 1
+    collapse (bool): run UPGMA on the distinct haplotypes of each window, default is False
+    sliding_dists (bool): update the distances between haplotypes from window to window instead of counting them for every window, default is False
+    sampler (HapSampler or None): draws the haplotypes of each window of a downsampled scan (see haplotype_matrix/downsampled_upgma.py), default is all haplotypes
+    trees (LinkageArchiveWriter or None): linkage archive the tree of each window is added to (see haplotype_matrix/linkage_archive.py), default is no archive
+    """
+
+    #distances kept from window to window, they are updated in window order ahead of the window threads, draws are seeded by window
+    hamming = SlidingHamming() if sliding_dists and sampler is None else None
+    def windows():
+        for lo, hi in bounds:
+            hap_m = hapsites.sites(lo, hi)
+            dists = None if hamming is None else hamming.distances(hap_m, lo, hi)
+            yield (lo, hi), (hap_m, collapse, dists, None if sampler is None else sampler.draws(hap_m.shape[1], lo, hi), trees is not None)
+
+    #slice haplo matrices in order and run UPGMA on the window threads (see haplotype_matrix/window_pool.py)
+    for (lo, hi), (stats, tree_array) in ordered_window_map(_window_stats, windows(), window_threads):
+
+        #grab window position
+        start_pos = int(positions[lo])
+        end_pos = int(positions[hi - 1]) + 1
+
+        #write to file
+        outcsv.write(_joinany(",", [chrom, start_pos, end_pos] + stats) + "\n")
+        if trees is not None:
+            trees.add(start_pos, end_pos, tree_array)
+        if checkpoint is not None:
+            checkpoint.window_done(outcsv, lo, start_pos)
 
 
 
@@ -250,7 +449,56 @@ def windowed_UPGMA_scan(vcfgz, SNPwindow_size, SNPwindow_step):     #, plotting_
 def run_UPGMA_scan(argloader_obj):
     """Main Function that runs windowed_UPGMA_scan with a single argument of the class ArgLoader"""
 
-    windowed_UPGMA_scan(argloader_obj.vcf, argloader_obj.winsize, argloader_obj.winstep)    #, argloader_obj.plot_here
+    windowed_UPGMA_scan(argloader_obj.vcf, argloader_obj.winsize, argloader_obj.winstep, argloader_obj.threads, argloader_obj.manifest,
+                        argloader_obj.checkpoint, argloader_obj.resume, argloader_obj.window_threads, argloader_obj.collapse, argloader_obj.sliding_dists,
+                        argloader_obj.downsample, argloader_obj.archive)    #, argloader_obj.plot_here
+
+
+
+def run_UPGMA_shard(shard, checkpoint=None, resume=False, header=False, collapse=False, sliding_dists=False, downsample=None, archive=False):
+    """
+    Main Function that runs one shard of a SNP window scan with a single argument of the class ShardLoader (see haplotype_matrix/shards.py).
+    With checkpoint the shard output is checkpointed every checkpoint windows, and resume continues it from its checkpoint
+    (see haplotype_matrix/checkpoint.py) or skips it if it is finished. header writes the header line, for a whole scan resumed as one shard.
+    collapse runs UPGMA on the distinct haplotypes of each window (see haplotype_matrix/collapsed_upgma.py), and sliding_dists
+    updates the distances between haplotypes from window to window (see haplotype_matrix/sliding_hamming.py). With downsample
+    UPGMA runs on draws of haplotypes of each window (see haplotype_matrix/downsampled_upgma.py). archive writes the tree of each
+    window to a linkage archive next to the shard output, stitched together with the shard outputs in main (see haplotype_matrix/linkage_archive.py).
+    """
+
+    _check_archive(archive, resume, downsample)
+
+    #windows of the shard
+    positions = load_positions(shard.vcf)
+    bounds = snp_window_bounds(len(positions), shard.winsize, shard.winstep)[shard.first_window:shard.last_window]
+
+    #windows left after the checkpoint of the shard output
+    ckpt = None
+    if checkpoint is not None:
+        ckpt = open_checkpoint(shard.outfile, checkpoint, resume)
+        if ckpt is None:
+            return
+        bounds = ckpt.check(bounds, positions)
+
+    #lines are written without a header and stitched together in main
+    chrom = shard.vcf.split("_")[-1].replace(".vcf.gz", "")
+    trees = LinkageArchiveWriter(archive_path(shard.outfile), chrom) if archive else None
+    with open(shard.outfile, "w" if ckpt is None else ckpt.mode()) as outcsv:
+        if header and (ckpt is None or not ckpt.resumed):
+            outcsv.write(_header(downsample))
+        if ckpt is not None:
+            ckpt.start(outcsv)
+
+        if len(bounds) > 0:
+            #sites from the first to the last window of the shard
+            hapsites = shard_sites(shard, positions, bounds[0][0], bounds[-1][1])
+            _write_windows(chrom, hapsites, positions, bounds, outcsv, ckpt, shard.window_threads, collapse, sliding_dists,
+                           None if downsample is None else downsample.sampler(shard.vcf, shard.manifest), trees)
+
+    if trees is not None:
+        trees.close()
+    if ckpt is not None:
+        ckpt.finish()
 
 
 
@@ -284,18 +532,69 @@ def main():
         "beagle_phased_biallelic_SNPs_1000GP30X_PARchrX.vcf.gz", "beagle_phased_biallelic_SNPs_1000GP30X_nonPARchrX.vcf.gz", "beagle_imputed_males_biallelic_SNPs_1000GP30X_chrY.vcf.gz"
         ]
     windowing = [(1000, 500), (10000, 5000), (100, 50)]    #(100, 10), 
-    loaderlist = []
+    #sample manifest of a subset to scan e.g. a superpopulation panel file, None scans all samples
+    manifest = None
+    #number of windows between checkpoints of the shard outputs, resume continues the shards of an interrupted checkpointed run (see haplotype_matrix/checkpoint.py)
+    checkpoint = None
+    resume = False
+    #RAM the running shards may use together, shards are started longest first while their estimated memory fits (see haplotype_matrix/scheduler.py)
+    ram_budget = 64 * 2 ** 30
+    #tab separated log of the peak RSS and runtime of each shard, None only prints them
+    job_log = None
+    #threads running UPGMA on the windows of each shard, so that the cores stay busy once only a few long shards are left (see haplotype_matrix/window_pool.py)
+    window_threads = 1
+    #UPGMA of the distinct haplotypes of each window weighted by their copies, tied distances may be merged in another order than the full tree (see haplotype_matrix/collapsed_upgma.py)
+    collapse = False
+    #Hamming distances updated from window to window with packed XOR and popcount instead of counted for every window, same output (see haplotype_matrix/sliding_hamming.py)
+    sliding_dists = True
+    #UPGMA on random draws of haplotypes of each window for exploratory runs e.g. Downsampling(500, 10), or Downsampling(500, 10, panel="integrated_call_samples_v3.20130502.ALL.panel")
+    #for draws stratified by superpopulation, the mean and standard deviation over the draws are written, None runs on all haplotypes (see haplotype_matrix/downsampled_upgma.py)
+    downsample = None
+    #linkage array of every window written to one archive per scan e.g. chr2_window1000_step500_linkage.npz, read by first_round_UPGMA_scan/grab_more_branch_stats.py
+    #and plot_selected_dendros.py instead of running UPGMA again, not with resume or downsample (see haplotype_matrix/linkage_archive.py)
+    archive = False
+    _check_archive(archive, resume, downsample)
+
+    pool = Pool(processes=threads)
 
+    #positions of each chromosome, read once and cached next to the vcfs
+    positions = dict(zip(vcflist, pool.map(load_positions, vcflist)))
+    pool.close()
+
+    #chromosomes are split into shards of about the same number of SNPs, a few per process so that they balance out
+    shard_snps = sum([len(p) for p in positions.values()]) // (4 * threads)
+
+    scans = {}
+    jobs, estimates = [], []
     for size, step in windowing:
         for vcffile in vcflist:
-            # chromosome = vcffile.split("_")[-1].replace(".vcf.gz", "")
-            # if chromosome in plot_in_these_intervals:
-            #     loaderlist.append(ArgLoader(vcffile, size, step, intervals_to_plot=plot_in_these_intervals[chromosome]))
-            # else:
-            loaderlist.append(ArgLoader(vcffile, size, step))
-
-    pool = Pool(processes=threads)
-    pool.map(run_UPGMA_scan, loaderlist)
+            chrom = vcffile.split("_")[-1].replace(".vcf.gz", "")
+            outfile = _outfile(chrom, size, step, manifest, downsample)
+            bounds = np.array(snp_window_bounds(len(positions[vcffile]), size, step), dtype=np.int64).reshape(-1, 2)
+            shards = scan_shards(vcffile, size, step, bounds[:, 0], bounds[:, 1], shard_snps, outfile, manifest=manifest, window_threads=window_threads)
+            #scans already stitched by the interrupted run
+            if resume and os.path.exists(outfile) and not any([os.path.exists(shard.outfile) for shard in shards]):
+                continue
+            scans[outfile] = shards
+
+            #estimated memory and runtime of each shard, UPGMA memory grows with the square of the haplotypes
+            num_haps = 2 * len(vcf_samples(vcffile) if manifest is None else read_sample_manifest(manifest))
+            if downsample is not None:
+                num_haps = min(num_haps, downsample.num_haps)
+            for shard in shards:
+                jobs.append(shard)
+                estimates.append(estimate_job("upgma", num_haps, bounds[shard.first_window:shard.last_window, 0], bounds[shard.first_window:shard.last_window, 1]))
+
+    #stitch the shard outputs of each scan in window order as soon as its last shard is done, checkpointed runs write the scan outputs from scratch
+    remaining = {outfile: len(shards) for outfile, shards in scans.items()}
+    scan_of = {shard.outfile: outfile for outfile, shards in scans.items() for shard in shards}
+    for shard, result in run_scheduled(partial(run_UPGMA_shard, checkpoint=checkpoint, resume=resume, collapse=collapse, sliding_dists=sliding_dists, downsample=downsample, archive=archive), jobs, estimates, threads, ram_budget, job_log):
+        outfile = scan_of[shard.outfile]
+        remaining[outfile] -= 1
+        if remaining[outfile] == 0:
+            stitch_shards(scans[outfile], outfile, _header(downsample), mode="a" if checkpoint is None else "w")
+            if archive:
+                stitch_linkage_archives([archive_path(shard.outfile) for shard in scans[outfile]], archive_path(outfile))
 
 
 if __name__ == '__main__':
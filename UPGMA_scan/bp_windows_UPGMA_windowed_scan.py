@@ -1,11 +1,26 @@
-import gzip
+import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.cluster.hierarchy import dendrogram, linkage
-from collections import deque
+from functools import partial
 from multiprocessing import Pool
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from hapmatrix import HapMatrix, hapmatrix_exists, bp_window_bounds, write_empty_windows, load_positions, vcf_samples
+from gt_parser import parse_record
+from bgzf_reader import bgzf_open
+from window_buffer import WindowBuffer
+from shards import ShardLoader, ShardSites, scan_shards, shard_sites, stitch_shards
+from window_kernels import avg_branch
+from checkpoint import open_checkpoint
+from scheduler import estimate_job, run_scheduled
+from window_pool import ordered_window_map
+from collapsed_upgma import collapsed_linkage
+from sliding_hamming import SlidingHamming
+from packed_distances import euclidean_distances
+from downsampled_upgma import downsample_tag, stat_columns, downsampled_stats
+from linkage_archive import LinkageArchiveWriter, archive_path, stitch_linkage_archives
 
 
 ### HELPER FUNCTIONS ###
@@ -20,63 +35,14 @@ def _joinany(sep, mylist):
 
 
 
-def _pop_bp_step(d, step):
-    """
-    Helper function used to pop a number of elements from the left
-    of a deque equal to the step size in. This is done in place.
-    """
-
-    #count how many elements to pop
-    count_ele_to_pop = 0
-    for idx in range(len(d)):
-        if d[idx].position <= step:
-            count_ele_to_pop += 1
-        else:
-            break
-    
-    #pop from left
-    for i in range(count_ele_to_pop):
-        d.popleft()
-
-
-def _construct_matrix(d):
-    """
-    Helper function takes in the window deque and constructs the haplo matrix
-
-    d (deque of RecordLoader objects): window deque
-
-    Returns list of lists: each sublist is a site and each sublist element is the haplotype at that site
-    """
-
-    matrix = []
-    for record in d:
-        hap_ls = []
-        for gt in record.GTs:
-            haps = gt.split("|")
-            for h in haps:
-                hap_ls.append(int(h))
-        matrix.append(hap_ls)
-
-
-    return matrix
-
-
-
 def _find_avg_branch(linkage_array):
-    """Helper function that finds the noramlized average branch length from a linakge array"""
+    """Helper function that finds the noramlized average branch length from a linakge array (see haplotype_matrix/window_kernels.py)"""
 
     #tree height
     tree_height = linkage_array[-1, 2]
 
-    #lengths
-    lengths = []
-    for clust in linkage_array:
-        lengths.append(clust[2])
-
-    #averaging
-    avg_branch = (sum(lengths) / len(lengths)) / tree_height
-
-    return avg_branch, tree_height
+    #averaging the merge heights over the tree height
+    return avg_branch(linkage_array[:, 2]), tree_height
 
 
 def _find_top_branch(linkage_array):
@@ -140,48 +106,101 @@ def _find_top_branch(linkage_array):
 
 
 
-def _runUPGMA(haplo_matrix):
+def _runUPGMA(haplo_matrix, collapse=False, dists=None, keep_tree=False):
     """
     Helper function runs UPGMA on haplotypes.
 
-    haplo_matrix (list of lists): each sublist is a site and each sublist element is the haplotype at that site
+    haplo_matrix (np.ndarray): each row is a site and each column is the haplotype at that site
+    collapse (bool): cluster the distinct haplotypes weighted by their copies instead of every haplotype (see haplotype_matrix/collapsed_upgma.py), default is False
+    dists (np.ndarray or None): condensed euclidean distances between the haplotypes (see haplotype_matrix/sliding_hamming.py), default is computing them from the packed haplotypes
+    keep_tree (bool): also return the linkage array, default is False
 
-    Returns float for normalized average branch length #####and ndarray from linkage()
+    Returns floats for normalized average branch length, normalized longest branch length and tree height, and ndarray from linkage() with keep_tree
     """
 
-    #converting matrix to array and transposing
-    matrix = np.array(haplo_matrix)
-    matrix = np.transpose(matrix)
+    #running UPGMA on the distinct haplotypes
+    if collapse:
+        tre = collapsed_linkage(haplo_matrix, dists)
+
+    else:
+        #distances of the bit-packed haplotypes, in float64 like the linkage (see haplotype_matrix/packed_distances.py)
+        if dists is None:
+            dists = euclidean_distances(haplo_matrix, np.float64)
 
-    #running UPGMA
-    tre = linkage(matrix, method="average", metric="euclidean")
+        #running UPGMA
+        tre = linkage(dists, method="average")
     
     #finding average branch length, tree height, and longest branch
     avglen, tree_height = _find_avg_branch(tre)
     longestbranch = _find_top_branch(tre)
 
+    if keep_tree:
+        return avglen, longestbranch, tree_height, tre
 
     return avglen, longestbranch, tree_height
 
 
 
-### CLASSES ###
+def _window_stats(haplo_matrix, collapse=False, dists=None, draws=None, keep_tree=False):
+    """
+    Helper function runs UPGMA on a window, on all of its haplotypes or on each draw of a downsampled scan.
 
-class RecordLoader():
-    def __init__(self, vcfline):
-        """
-        This class is for parsing a vcf record for it to be added to a deque.
-        The class as two attributes:
-        position (int): record position
-        GTs (list of str): list of individual genotypes e.g. ["0|0", "1|0"...]
-        """
+    haplo_matrix (np.ndarray): each row is a site and each column is the haplotype at that site
+    collapse (bool): cluster the distinct haplotypes weighted by their copies, default is False
+    dists (np.ndarray or None): condensed euclidean distances between all haplotypes, default is computing them from the packed haplotypes
+    draws (list of np.ndarray or None): haplotype columns of each draw (see haplotype_matrix/downsampled_upgma.py), default is all haplotypes
+    keep_tree (bool): keep the linkage array of all haplotypes for the linkage archive, default is False
+
+    Returns list of the branch statistics of the window, or their means and standard deviations over the draws,
+    and the linkage array of the window or None without keep_tree
+    """
+
+    if draws is None:
+        if keep_tree:
+            *stats, tre = _runUPGMA(haplo_matrix, collapse, dists, True)
+            return stats, tre
+        return list(_runUPGMA(haplo_matrix, collapse, dists)), None
+
+    return downsampled_stats(partial(_runUPGMA, collapse=collapse), haplo_matrix, draws, 3), None
+
+
+
+def _columns(downsample=None):
+    """Helper gives the csv columns, a downsampled scan adds the standard deviation of each branch statistic"""
 
-        self.position = int(vcfline.strip().split("\t")[1])
-        self.GTs = vcfline.strip().split("\t")[9:]
+    return ["CHROM", "START", "END"] + stat_columns(["AVG_branch_length", "LONGEST_branch_length", "Tree_Height"], downsample) + ["SNP_density"]
 
 
+
+def _empty_values(downsample=None):
+    """Helper gives the values of an empty window, every statistic and the SNP density are 0"""
+
+    return [0] * (len(_columns(downsample)) - 3)
+
+
+
+def _outfile(chrom, window_size, window_step, downsample=None):
+    """Helper gives the output file name of a scan"""
+
+    return f"{chrom}_window{window_size}_step{window_step}{downsample_tag(downsample)}_avg_branch_len.csv"
+
+
+
+def _check_archive(archive, resume=False, downsample=None):
+    """Helper exits on the settings a linkage archive cannot be written with"""
+
+    if archive and resume:
+        exit("the linkage archive is written from scratch and cannot be resumed, rerun the scan without resume")
+    if archive and downsample is not None:
+        exit("the linkage archive holds the trees of all haplotypes, it cannot be written by a downsampled scan")
+
+
+
+### CLASSES ###
+
 class ArgLoader():
-    def __init__(self, vcfgz_file, windowsize, windowstep):
+    def __init__(self, vcfgz_file, windowsize, windowstep, decompress_threads=1, index_positions=False, window_threads=1, collapse=False, sliding_dists=False, downsample=None, archive=False,
+                 checkpoint=None, resume=False):
         """
         Class used to store arguments for the windowed_UPGMA_scan function which is run using the run_UPGMA_scan main function.
         This is done so that the main function takes a single argument so that it can be run in parallel.
@@ -189,11 +208,29 @@ class ArgLoader():
         vcfgz_file (str): filename or path to file for the vcf to scan
         windowsize (int): SNP window size
         windowstep (int): SNP window step, recommended to be 10% of windowsize
+        decompress_threads (int): number of threads inflating the vcf, default is 1
+        index_positions (bool): find the window bounds from the sorted site positions first, default is False
+        window_threads (int): number of threads running UPGMA on the windows, default is 1
+        collapse (bool): run UPGMA on the distinct haplotypes weighted by their copies, default is False
+        sliding_dists (bool): update the Hamming distances between haplotypes from window to window instead of counting them for every window, default is False
+        downsample (Downsampling or None): run UPGMA on random draws of haplotypes of each window, default is all haplotypes
+        archive (bool): write the linkage array of every non-empty window to a linkage archive, default is False
+        checkpoint (int or None): number of windows between checkpoints of the output, default is no checkpoints
+        resume (bool): continue the output of an interrupted scan from its checkpoint, default is False
         """
 
         self.vcf = vcfgz_file
         self.winsize = windowsize
         self.winstep = windowstep
+        self.threads = decompress_threads
+        self.index_positions = index_positions
+        self.window_threads = window_threads
+        self.collapse = collapse
+        self.sliding_dists = sliding_dists
+        self.downsample = downsample
+        self.archive = archive
+        self.checkpoint = checkpoint
+        self.resume = resume
 
     def __str__(self):
         return self.vcf + "\t" + str(self.winsize) + "\t" + str(self.winstep)
@@ -203,7 +240,8 @@ class ArgLoader():
 
 ### SLIDING WINDOW SCAN FUNCTION ###
 
-def windowed_UPGMA_scan(vcfgz, window_size, window_step):
+def windowed_UPGMA_scan(vcfgz, window_size, window_step, decompress_threads=1, index_positions=False, window_threads=1, collapse=False, sliding_dists=False, downsample=None, archive=False,
+                        checkpoint=None, resume=False):
     """
     Function performs the windowed UPGMA scan on a gizped vcf, and outputs 
     Average Branch Length results to a csv. See other functions for details.
@@ -211,17 +249,67 @@ def windowed_UPGMA_scan(vcfgz, window_size, window_step):
     vcfgz (str): gziped vcf file name or path to file.
     SNPwindow_size (int): number of SNPs defining the window size.
     SNPwindow_step (int): number of SNPs to slide window, recommended to be 10% of SNPwindow_size.
+    decompress_threads (int): number of threads inflating the BGZF blocks of the vcf (see haplotype_matrix/bgzf_reader.py), default is 1.
+    index_positions (bool): load (or cache) the sorted site positions first and find the site bounds of every window with np.searchsorted,
+        so that runs of empty windows are written in one block and UPGMA only runs on non-empty windows, default is False.
+    window_threads (int): number of threads running UPGMA on the windows (see haplotype_matrix/window_pool.py), the windows are sliced in order
+        and their lines written in order. Above 1 the window bounds are found from the positions index as with index_positions, default is 1.
+    collapse (bool): cluster the distinct haplotypes of each window weighted by their copies (see haplotype_matrix/collapsed_upgma.py), the distances
+        and clustering then scale with the distinct haplotypes instead of the sample size. The merge heights are the averages of the full tree, but
+        UPGMA of tied distances is not unique and the distinct haplotypes may break ties the other way, default is False.
+    sliding_dists (bool): keep the mismatch counts between haplotypes from window to window, subtracting the SNPs leaving the window and adding
+        those entering it with packed XOR and popcount (see haplotype_matrix/sliding_hamming.py), instead of counting them for every window.
+        The distances are the same so the output is unchanged, default is False.
+    downsample (Downsampling or None): estimate the branch statistics from random draws of haplotypes of each window (see haplotype_matrix/downsampled_upgma.py),
+        e.g. Downsampling(500, 10) runs UPGMA on 10 draws of 500 haplotypes and writes the mean and standard deviation of each statistic over
+        the draws. The draws are seeded by the window so they are the same in every scan mode, sliding_dists is not used as every window
+        draws its own haplotypes, and the draws are tagged in the output file name, default is all haplotypes.
+    archive (bool): also write the linkage array of every non-empty window to a linkage archive named after the output e.g. chr8_window3000_step1500_linkage.npz
+        (see haplotype_matrix/linkage_archive.py), so that other branch statistics and dendrograms are read from the stored trees instead of running
+        UPGMA again. The archive ends are exclusive (END + 1), it is written from scratch so it cannot be resumed, and it is not written by downsampled scans, default is False.
+    checkpoint (int or None): number of windows between checkpoints (see haplotype_matrix/checkpoint.py), the output is then written from scratch
+        instead of appended to and flushed to disk with a checkpoint of the last written window every checkpoint windows, default is no checkpoints.
+    resume (bool): continue the output of an interrupted checkpointed scan, it is truncated to its checkpoint and the scan seeks to the next window
+        with the tabix index (or slices the haplotype matrix), an output without a checkpoint is finished and skipped, default is False.
     """
 
-    #setting up deque for sliding window
-    window_deque = deque()
+    if resume and checkpoint is None:
+        exit("resume needs checkpoint, the number of windows between checkpoints")
+    _check_archive(archive, resume, downsample)
+
+    #continue the output of an interrupted scan from its checkpoint
+    if resume:
+        _single_shard_UPGMA_scan(vcfgz, window_size, window_step, checkpoint, decompress_threads, window_threads, collapse, sliding_dists, downsample, archive)
+        return
+
+    #read from the bit-packed haplotype matrix if it was built for this vcf
+    if hapmatrix_exists(vcfgz):
+        _hapmatrix_UPGMA_scan(vcfgz, window_size, window_step, window_threads, collapse, sliding_dists, downsample, archive, checkpoint)
+        return
+
+    #stream the sites of the vcf into the windows found from the positions index (see load_positions in haplotype_matrix/hapmatrix.py)
+    if index_positions or window_threads > 1:
+        _indexed_UPGMA_scan(vcfgz, window_size, window_step, decompress_threads, window_threads, collapse, sliding_dists, downsample, archive, checkpoint)
+        return
+
+    #setting up the array-backed sliding window (see haplotype_matrix/window_buffer.py)
+    window = WindowBuffer()
+
+    #distances kept from window to window, or haplotypes drawn in each window
+    hamming = SlidingHamming() if sliding_dists and downsample is None else None
+    sampler = None if downsample is None else downsample.sampler(vcfgz)
 
     #open files
     chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
-    with gzip.open(vcfgz, "rt") as vcf, open(f"{chrom}_window{window_size}_step{window_step}_avg_branch_len.csv", "a") as outcsv:
+    outfile = _outfile(chrom, window_size, window_step, downsample)
+    ckpt = None if checkpoint is None else open_checkpoint(outfile, checkpoint)
+    trees = LinkageArchiveWriter(archive_path(outfile), chrom) if archive else None
+    with bgzf_open(vcfgz, "rb", threads=decompress_threads) as vcf, open(outfile, "a" if ckpt is None else ckpt.mode()) as outcsv:
 
         #write header line
-        outcsv.write(",".join(["CHROM", "START", "END", "AVG_branch_length", "LONGEST_branch_length", "Tree_Height", "SNP_density"]) + "\n")
+        outcsv.write(",".join(_columns(downsample)) + "\n")
+        if ckpt is not None:
+            ckpt.start(outcsv)
 
         #window book keeping
         win_start = 1
@@ -231,39 +319,50 @@ def windowed_UPGMA_scan(vcfgz, window_size, window_step):
         #loop through lines
         for line in vcf:
             #skip header lines
-            if line.startswith("#"):
+            if line.startswith(b"#"):
                 continue
 
             ###sliding window scan###
 
-            #holding on  current record
-            current_record = RecordLoader(line)
+            #parse current record
+            position, haps = parse_record(line)
 
-            if current_record.position < win_start:
+            if position < win_start:
                  exit("Record position before window start position")
             
-            if current_record.position <= win_end:
-                window_deque.append(current_record)
+            if position <= win_end:
+                window.append(position, haps)
                 continue
 
 
             #increment window until position is reached
-            for i in range(win_end, current_record.position, window_step):
+            for i in range(win_end, position, window_step):
 
-                if len(window_deque) == 0:
+                if len(window) == 0:
                     #write to file
-                    outcsv.write(_joinany(",", [chrom, win_start, win_end, 0, 0, 0, 0]) + "\n")
+                    outcsv.write(_joinany(",", [chrom, win_start, win_end] + _empty_values(downsample)) + "\n")
+                    if ckpt is not None:
+                        #the first site after an empty window is the current record
+                        ckpt.window_done(outcsv, window.num_appended(), position)
                 else:
-                    #construct haplo matrix
-                    hap_m = _construct_matrix(window_deque)
+                    #first site of the window for the checkpoints
+                    lo, first_pos = window.first, window.first_position()
+                    #grab haplo matrix of the window
+                    hap_m = window.matrix()
                     #run UPGMA
-                    avgbranchlen, longest_branch_len, height_of_tree = _runUPGMA(hap_m)
+                    dists = None if hamming is None else hamming.distances(hap_m, window.first, window.num_appended())
+                    draws = None if sampler is None else sampler.draws(hap_m.shape[1], window.first, window.num_appended())
+                    stats, tree_array = _window_stats(hap_m, collapse, dists, draws, archive)
                     #find SNP density
-                    snpden = len(window_deque) / window_size
+                    snpden = len(window) / window_size
                     #sliding to next step
-                    _pop_bp_step(window_deque, win_step)
+                    window.pop_to(win_step)
                     #write to file
-                    outcsv.write(_joinany(",", [chrom, win_start, win_end, avgbranchlen, longest_branch_len, height_of_tree, snpden]) + "\n")
+                    outcsv.write(_joinany(",", [chrom, win_start, win_end] + stats + [snpden]) + "\n")
+                    if trees is not None:
+                        trees.add(win_start, win_end + 1, tree_array)
+                    if ckpt is not None:
+                        ckpt.window_done(outcsv, lo, first_pos)
 
                 #increment window
                 win_end = i + window_step
@@ -274,22 +373,211 @@ def windowed_UPGMA_scan(vcfgz, window_size, window_step):
                 # win_end += window_step
                 # win_step += window_step
 
-            #append current record to deque
-            window_deque.append(current_record)
+            #append current record to window
+            window.append(position, haps)
 
 
 
         #clean up last window
-        if len(window_deque) > 0:
+        if len(window) > 0:
             
-            #construct haplo matrix
-            hap_m = _construct_matrix(window_deque)
+            #grab haplo matrix of the window
+            hap_m = window.matrix()
             #run UPGMA
-            avgbranchlen, longest_branch_len, height_of_tree = _runUPGMA(hap_m)
+            dists = None if hamming is None else hamming.distances(hap_m, window.first, window.num_appended())
+            draws = None if sampler is None else sampler.draws(hap_m.shape[1], window.first, window.num_appended())
+            stats, tree_array = _window_stats(hap_m, collapse, dists, draws, archive)
             #find SNP density
-            snpden = len(window_deque) / (win_end - win_start)
+            snpden = len(window) / (win_end - win_start)
             #write to file
-            outcsv.write(_joinany(",", [chrom, win_start, win_end, avgbranchlen, longest_branch_len, height_of_tree, snpden]) + "\n")
+            outcsv.write(_joinany(",", [chrom, win_start, win_end] + stats + [snpden]) + "\n")
+            if trees is not None:
+                trees.add(win_start, win_end + 1, tree_array)
+            if ckpt is not None:
+                ckpt.window_done(outcsv, window.first, window.first_position())
+
+    if trees is not None:
+        trees.close()
+    if ckpt is not None:
+        ckpt.finish()
+
+
+
+
+def _hapmatrix_UPGMA_scan(vcfgz, window_size, window_step, window_threads=1, collapse=False, sliding_dists=False, downsample=None, archive=False, checkpoint=None):
+    """
+    Runs the same scan as windowed_UPGMA_scan on the bit-packed haplotype matrix built with
+    haplotype_matrix/hapmatrix.py. Window bounds are found from the positions array and windows
+    are sliced from the memory-mapped matrix instead of parsed from the vcf.
+    """
+
+    #open haplotype matrix
+    hapmat = HapMatrix(vcfgz)
+
+    #open files
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    outfile = _outfile(chrom, window_size, window_step, downsample)
+    ckpt = None if checkpoint is None else open_checkpoint(outfile, checkpoint)
+    trees = LinkageArchiveWriter(archive_path(outfile), chrom) if archive else None
+    with open(outfile, "a" if ckpt is None else ckpt.mode()) as outcsv:
+
+        #write header line
+        outcsv.write(",".join(_columns(downsample)) + "\n")
+        if ckpt is not None:
+            ckpt.start(outcsv)
+
+        #window bounds
+        bounds = bp_window_bounds(hapmat.positions, window_size, window_step)
+
+        #loop through windows
+        _write_windows(chrom, hapmat, bounds, window_size, 0, len(bounds[0]), outcsv, window_threads, collapse, sliding_dists,
+                       None if downsample is None else downsample.sampler(vcfgz), trees, ckpt, hapmat.positions)
+
+    if trees is not None:
+        trees.close()
+    if ckpt is not None:
+        ckpt.finish()
+
+
+
+
+def _indexed_UPGMA_scan(vcfgz, window_size, window_step, decompress_threads=1, window_threads=1, collapse=False, sliding_dists=False, downsample=None, archive=False, checkpoint=None):
+    """
+    Runs the same scan as windowed_UPGMA_scan with the window bounds found at once from the sorted site positions
+    (see bp_window_bounds in haplotype_matrix/hapmatrix.py), streaming the sites of the non-empty windows from the vcf.
+    """
+
+    positions = load_positions(vcfgz, decompress_threads)
+    bounds = bp_window_bounds(positions, window_size, window_step)
+    hapsites = ShardSites(vcfgz, positions, 0, len(positions), decompress_threads) if len(positions) > 0 else None
+
+    #open files
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    outfile = _outfile(chrom, window_size, window_step, downsample)
+    ckpt = None if checkpoint is None else open_checkpoint(outfile, checkpoint)
+    trees = LinkageArchiveWriter(archive_path(outfile), chrom) if archive else None
+    with open(outfile, "a" if ckpt is None else ckpt.mode()) as outcsv:
+
+        #write header line
+        outcsv.write(",".join(_columns(downsample)) + "\n")
+        if ckpt is not None:
+            ckpt.start(outcsv)
+
+        #loop through windows
+        _write_windows(chrom, hapsites, bounds, window_size, 0, len(bounds[0]), outcsv, window_threads, collapse, sliding_dists,
+                       None if downsample is None else downsample.sampler(vcfgz), trees, ckpt, positions)
+
+    if trees is not None:
+        trees.close()
+    if ckpt is not None:
+        ckpt.finish()
+
+
+
+
+def _single_shard_UPGMA_scan(vcfgz, window_size, window_step, checkpoint, decompress_threads=1, window_threads=1, collapse=False, sliding_dists=False, downsample=None, archive=False):
+    """
+    Continues the output of an interrupted checkpointed windowed_UPGMA_scan as a single shard spanning all of its windows
+    (see run_UPGMA_shard), which seeks to the window after the checkpoint with the tabix index.
+    """
+
+    positions = load_positions(vcfgz, decompress_threads)
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    outfile = _outfile(chrom, window_size, window_step, downsample)
+
+    num_windows = len(bp_window_bounds(positions, window_size, window_step)[0])
+    shard = ShardLoader(vcfgz, window_size, window_step, 0, num_windows, outfile, decompress_threads, window_threads=window_threads)
+    run_UPGMA_shard(shard, checkpoint, resume=True, header=True, collapse=collapse, sliding_dists=sliding_dists, downsample=downsample, archive=archive)
+
+
+
+
+def _write_empty_windows(outcsv, chrom, bounds, first_window, last_window, empty, checkpoint=None, positions=None):
+    """
+    Helper writes a run of empty bp windows in blocks (see write_empty_windows in haplotype_matrix/hapmatrix.py). With a checkpoint the blocks
+    end at the checkpoints, so that each checkpoint is saved right after the line of its window
+    """
+
+    win_starts, win_ends, los, his = bounds
+    if checkpoint is None:
+        write_empty_windows(outcsv, chrom, win_starts[first_window:last_window], win_ends[first_window:last_window], empty)
+        return
+
+    idx = first_window
+    while idx < last_window:
+        end = min(last_window, idx + checkpoint.every - checkpoint.windows % checkpoint.every)
+        write_empty_windows(outcsv, chrom, win_starts[idx:end], win_ends[idx:end], empty)
+        for j in range(idx, end):
+            checkpoint.window_done(outcsv, int(los[j]), int(positions[los[j]]))
+        idx = end
+
+
+
+
+def _write_windows(chrom, hapsites, bounds, window_size, first_window, last_window, outcsv, window_threads=1, collapse=False, sliding_dists=False, sampler=None, trees=None,
+                   checkpoint=None, positions=None):
+    """
+    Runs UPGMA on a range of the bp windows of a chromosome and writes the csv lines.
+    Used by the haplotype matrix scan, the indexed scan and by the shards of the parallel scan.
+    Runs of empty windows are written in one block and UPGMA only runs on the non-empty windows.
+
+    chrom (str): chromosome name for the output
+    hapsites (HapMatrix or ShardSites or None): sites to slice the windows from, None if all windows are empty
+    bounds (tuple of np.ndarray): window starts, window ends, first and last site indexes of all windows of the chromosome (see bp_window_bounds)
+    window_size (int): number of bps defining the window size
+    first_window (int): index of the first window to scan
+    last_window (int): index of the last window to scan (exclusive)
+    outcsv (file): open output file
+    window_threads (int): number of threads running UPGMA on the windows, default is 1
+    collapse (bool): run UPGMA on the distinct haplotypes of each window, default is False
+    sliding_dists (bool): update the distances between haplotypes from window to window instead of counting them for every window, default is False
+    sampler (HapSampler or None): draws the haplotypes of each window of a downsampled scan (see haplotype_matrix/downsampled_upgma.py), default is all haplotypes
+    trees (LinkageArchiveWriter or None): linkage archive the tree of each non-empty window is added to (see haplotype_matrix/linkage_archive.py), default is no archive
+    checkpoint (ScanCheckpoint or None): checkpoint of the output, counts the written windows, default is no checkpoints
+    positions (np.ndarray of int64 or None): positions of all sites, needed by the checkpoints
+    """
+
+    win_starts, win_ends, los, his = bounds
+    last_idx = len(win_starts) - 1
+
+    #index of the next window to write
+    next_idx = first_window
+
+    #values of the empty windows
+    empty = ",".join([str(x) for x in _empty_values(None if sampler is None else sampler.downsample)])
+
+    #non-empty windows, the distances are kept from window to window and updated in window order ahead of the window threads, draws are seeded by window
+    nonempty = first_window + np.flatnonzero(los[first_window:last_window] < his[first_window:last_window])
+    hamming = SlidingHamming() if sliding_dists and sampler is None else None
+    def windows():
+        for idx in nonempty:
+            lo, hi = int(los[idx]), int(his[idx])
+            hap_m = hapsites.sites(lo, hi)
+            dists = None if hamming is None else hamming.distances(hap_m, lo, hi)
+            yield int(idx), (hap_m, collapse, dists, None if sampler is None else sampler.draws(hap_m.shape[1], lo, hi), trees is not None)
+
+    #slice haplo matrices of the non-empty windows in order and run UPGMA on the window threads (see haplotype_matrix/window_pool.py)
+    for idx, (stats, tree_array) in ordered_window_map(_window_stats, windows(), window_threads):
+        win_start, win_end, lo, hi = int(win_starts[idx]), int(win_ends[idx]), int(los[idx]), int(his[idx])
+
+        #write the empty windows before this one in one block
+        _write_empty_windows(outcsv, chrom, bounds, next_idx, idx, empty, checkpoint, positions)
+        next_idx = idx + 1
+
+        #find SNP density, the last window is normalized like the clean up window of the vcf scan
+        if idx == last_idx:
+            snpden = (hi - lo) / (win_end - win_start)
+        else:
+            snpden = (hi - lo) / window_size
+        #write to file
+        outcsv.write(_joinany(",", [chrom, win_start, win_end] + stats + [snpden]) + "\n")
+        if trees is not None:
+            trees.add(win_start, win_end + 1, tree_array)
+        if checkpoint is not None:
+            checkpoint.window_done(outcsv, lo, int(positions[lo]))
+
+    #empty windows after the last non-empty window
+    _write_empty_windows(outcsv, chrom, bounds, next_idx, last_window, empty, checkpoint, positions)
 
 
 
@@ -298,7 +586,57 @@ def windowed_UPGMA_scan(vcfgz, window_size, window_step):
 def run_UPGMA_scan(argloader_obj):
     """Main Function that runs windowed_UPGMA_scan with a single argument of the class ArgLoader"""
 
-    windowed_UPGMA_scan(argloader_obj.vcf, argloader_obj.winsize, argloader_obj.winstep)
+    windowed_UPGMA_scan(argloader_obj.vcf, argloader_obj.winsize, argloader_obj.winstep, argloader_obj.threads, argloader_obj.index_positions, argloader_obj.window_threads, argloader_obj.collapse, argloader_obj.sliding_dists,
+                        argloader_obj.downsample, argloader_obj.archive, argloader_obj.checkpoint, argloader_obj.resume)
+
+
+
+def run_UPGMA_shard(shard, checkpoint=None, resume=False, header=False, collapse=False, sliding_dists=False, downsample=None, archive=False):
+    """
+    Main Function that runs one shard of a bp window scan with a single argument of the class ShardLoader (see haplotype_matrix/shards.py).
+    With checkpoint the shard output is checkpointed every checkpoint windows, and resume continues it from its checkpoint
+    (see haplotype_matrix/checkpoint.py) or skips it if it is finished. header writes the header line, for a whole scan resumed as one shard.
+    collapse runs UPGMA on the distinct haplotypes of each window (see haplotype_matrix/collapsed_upgma.py), and sliding_dists
+    updates the distances between haplotypes from window to window (see haplotype_matrix/sliding_hamming.py). With downsample
+    UPGMA runs on draws of haplotypes of each window (see haplotype_matrix/downsampled_upgma.py). archive writes the tree of each
+    non-empty window to a linkage archive next to the shard output, stitched together with the shard outputs in main (see haplotype_matrix/linkage_archive.py).
+    """
+
+    _check_archive(archive, resume, downsample)
+
+    #windows of the chromosome
+    positions = load_positions(shard.vcf)
+    bounds = bp_window_bounds(positions, shard.winsize, shard.winstep)
+    los, his = bounds[2], bounds[3]
+
+    #windows left after the checkpoint of the shard output
+    first_window = shard.first_window
+    ckpt = None
+    if checkpoint is not None:
+        ckpt = open_checkpoint(shard.outfile, checkpoint, resume)
+        if ckpt is None:
+            return
+        first_window = shard.last_window - len(ckpt.check(list(zip(los[shard.first_window:shard.last_window], his[shard.first_window:shard.last_window])), positions))
+
+    #lines are written without a header and stitched together in main
+    chrom = shard.vcf.split("_")[-1].replace(".vcf.gz", "")
+    trees = LinkageArchiveWriter(archive_path(shard.outfile), chrom) if archive else None
+    with open(shard.outfile, "w" if ckpt is None else ckpt.mode()) as outcsv:
+        if header and (ckpt is None or not ckpt.resumed):
+            outcsv.write(",".join(_columns(downsample)) + "\n")
+        if ckpt is not None:
+            ckpt.start(outcsv)
+
+        if first_window < shard.last_window:
+            #sites from the first to the last window of the shard
+            hapsites = shard_sites(shard, positions, int(los[first_window]), int(his[shard.last_window - 1]))
+            _write_windows(chrom, hapsites, bounds, shard.winsize, first_window, shard.last_window, outcsv, shard.window_threads, collapse, sliding_dists,
+                           None if downsample is None else downsample.sampler(shard.vcf), trees, ckpt, positions)
+
+    if trees is not None:
+        trees.close()
+    if ckpt is not None:
+        ckpt.finish()
 
 
 
@@ -326,13 +664,68 @@ def main():
         "beagle_phased_biallelic_SNPs_1000GP30X_chr19.vcf.gz",
         ]
     
-    loaderlist = []
-
+    window_size, window_step = 3000, 1500
+    processes = 4
+    #RAM the running shards may use together, shards are started longest first while their estimated memory fits (see haplotype_matrix/scheduler.py)
+    ram_budget = 64 * 2 ** 30
+    #tab separated log of the peak RSS and runtime of each shard, None only prints them
+    job_log = None
+    #number of windows between checkpoints of the shard outputs, resume continues the shards of an interrupted checkpointed run (see haplotype_matrix/checkpoint.py)
+    checkpoint = None
+    resume = False
+    #threads running UPGMA on the windows of each shard, so that the cores stay busy once only a few long shards are left (see haplotype_matrix/window_pool.py)
+    window_threads = 1
+    #UPGMA of the distinct haplotypes of each window weighted by their copies, tied distances may be merged in another order than the full tree (see haplotype_matrix/collapsed_upgma.py)
+    collapse = False
+    #Hamming distances updated from window to window with packed XOR and popcount instead of counted for every window, same output (see haplotype_matrix/sliding_hamming.py)
+    sliding_dists = True
+    #UPGMA on random draws of haplotypes of each window for exploratory runs e.g. Downsampling(500, 10), or Downsampling(500, 10, panel="integrated_call_samples_v3.20130502.ALL.panel")
+    #for draws stratified by superpopulation, the mean and standard deviation of each statistic over the draws are written, None runs on all haplotypes (see haplotype_matrix/downsampled_upgma.py)
+    downsample = None
+    #linkage array of every non-empty window written to one archive per chromosome e.g. chr8_window3000_step1500_linkage.npz, read by first_round_UPGMA_scan/grab_more_branch_stats.py
+    #and plot_selected_dendros.py instead of running UPGMA again, not with resume or downsample (see haplotype_matrix/linkage_archive.py)
+    archive = False
+    _check_archive(archive, resume, downsample)
+
+    pool = Pool(processes=processes)
+
+    #positions of each chromosome, read once and cached next to the vcfs
+    positions = dict(zip(vcflist, pool.map(load_positions, vcflist)))
+    pool.close()
+
+    #chromosomes are split into shards of about the same number of SNPs, a few per process so that they balance out
+    shard_snps = sum([len(p) for p in positions.values()]) // (4 * processes)
+
+    scans = {}
+    jobs, estimates = [], []
     for vcffile in vcflist:
-        loaderlist.append(ArgLoader(vcffile, 3000, 1500))
-
-    pool = Pool(processes=4)
-    pool.map(run_UPGMA_scan, loaderlist)
+        chrom = vcffile.split("_")[-1].replace(".vcf.gz", "")
+        outfile = _outfile(chrom, window_size, window_step, downsample)
+        win_starts, win_ends, los, his = bp_window_bounds(positions[vcffile], window_size, window_step)
+        shards = scan_shards(vcffile, window_size, window_step, los, his, shard_snps, outfile, window_threads=window_threads)
+        #scans already stitched by the interrupted run
+        if resume and os.path.exists(outfile) and not any([os.path.exists(shard.outfile) for shard in shards]):
+            continue
+        scans[outfile] = shards
+
+        #estimated memory and runtime of each shard, UPGMA memory grows with the square of the haplotypes
+        num_haps = 2 * len(vcf_samples(vcffile))
+        if downsample is not None:
+            num_haps = min(num_haps, downsample.num_haps)
+        for shard in scans[outfile]:
+            jobs.append(shard)
+            estimates.append(estimate_job("upgma", num_haps, los[shard.first_window:shard.last_window], his[shard.first_window:shard.last_window]))
+
+    #stitch the shard outputs of each scan in window order as soon as its last shard is done, checkpointed runs write the scan outputs from scratch
+    remaining = {outfile: len(shards) for outfile, shards in scans.items()}
+    scan_of = {shard.outfile: outfile for outfile, shards in scans.items() for shard in shards}
+    for shard, result in run_scheduled(partial(run_UPGMA_shard, checkpoint=checkpoint, resume=resume, collapse=collapse, sliding_dists=sliding_dists, downsample=downsample, archive=archive), jobs, estimates, processes, ram_budget, job_log):
+        outfile = scan_of[shard.outfile]
+        remaining[outfile] -= 1
+        if remaining[outfile] == 0:
+            stitch_shards(scans[outfile], outfile, ",".join(_columns(downsample)) + "\n", mode="a" if checkpoint is None else "w")
+            if archive:
+                stitch_linkage_archives([archive_path(shard.outfile) for shard in scans[outfile]], archive_path(outfile))
 
 
 if __name__ == '__main__':
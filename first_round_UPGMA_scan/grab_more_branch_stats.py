@@ -1,7 +1,10 @@
 import os
+import sys
 import glob
 import pandas as pd
 import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from linkage_archive import LinkageArchive
 
 
 def _branch_length(linkage_array, cluster_idx, n):
@@ -129,6 +132,42 @@ def longest_and_avg_braches(directory):
 
 
 
+def archive_branch_stats(archive_file, start=None, end=None):
+    """
+    Outputs the same csv as longest_and_avg_braches from the trees of a linkage archive written by the UPGMA scans
+    (see haplotype_matrix/linkage_archive.py), instead of a directory of .npy files. Only the chunks of the windows
+    overlapping [start, end) are read, so a region is summarized without running UPGMA again.
+    """
+
+    with LinkageArchive(archive_file) as archive:
+
+        #windows of the region, or every window
+        if start is None and end is None:
+            windows = np.arange(len(archive))
+        else:
+            windows = archive.overlapping(0 if start is None else start, np.iinfo(np.int64).max if end is None else end)
+
+        #empty lists for output table
+        pos = []
+        longest_branch = []
+        avg_branch_ls = []
+
+        #looping through windows in order
+        for win_start, win_end, tree in archive.trees(windows):
+            pos.append((win_start + win_end) // 2)
+            longest_branch.append(find_longest_branch(tree))
+            avg_branch_ls.append(find_avg_branch(tree))
+
+    #making df
+    df = pd.DataFrame({"Window":windows, "POS":pos, "Longest_branch_length":longest_branch, "Average_branch_length":avg_branch_ls})
+
+    region = "" if start is None and end is None else f"_from_{start}_to_{end}"
+    name = archive_file.split("/")[-1].replace("_linkage.npz", "")
+    df.to_csv(f"LongestAvg_branch_lengths_{name}{region}.csv", index=False)
+
+
+
+
 
 
 longest_and_avg_braches("clustering_output/200SNP_windows/chr9/inv")
@@ -173,3 +212,8 @@ longest_and_avg_braches("clustering_output/400SNP_windows/chr15.2/inv")
 longest_and_avg_braches("clustering_output/400SNP_windows/chr15.2/control1")
 longest_and_avg_braches("clustering_output/400SNP_windows/chr15.2/control2")
 
+
+
+#from the linkage archive of a UPGMA scan e.g. the chr15.1 inversion region
+# archive_branch_stats("chr15_window200_step100_linkage.npz", 68000000, 69000000)
+
@@ -2,7 +2,10 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.cluster.hierarchy import dendrogram, linkage
+import os
 import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from linkage_archive import LinkageArchive
 sys.setrecursionlimit(10000)
 
 
@@ -53,6 +56,42 @@ def plot6dendros(list_of_npys):
 
 
 
+def plot_archived_dendros(archive_file, positions, title):
+    """
+    Function plots the dendrograms of the windows holding up to 6 genomic positions in a 3x2 grid, like plot6dendros,
+    with the trees read from the linkage archive of a UPGMA scan (see haplotype_matrix/linkage_archive.py)
+    instead of .npy files. Only the chunks of the plotted windows are read.
+    """
+
+    #setup plot
+    fig, axs = plt.subplots(2, 3, figsize=(15, 5))
+
+    with LinkageArchive(archive_file) as archive:
+        for idx, position in enumerate(positions[:6]):
+
+            #find subplot coordinates
+            row, col = idx // 3, idx % 3
+
+            #first window holding the position
+            windows = archive.find(position)
+            if len(windows) == 0:
+                axs[row, col].set_title(f"{position} not in a window")
+                continue
+            win = int(windows[0])
+
+            #plotting
+            dendrogram(archive.linkage(win), ax=axs[row, col])
+            axs[row, col].set_title(f"Window {win} {archive.chrom}:{archive.starts[win]}-{archive.ends[win]}")
+            axs[row, col].set_xticks([])
+
+    plt.suptitle(title.replace("_", " "))
+    plt.tight_layout()
+    plt.savefig(f"{title}.png")
+    plt.clf()
+
+
+
+
 
 
 listoflistfiles = [
@@ -89,4 +128,9 @@ listoflistfiles = [
 
 for lsfile in listoflistfiles:
 
-    plot6dendros(lsfile)
\ No newline at end of file
+    plot6dendros(lsfile)
+
+
+
+#from the linkage archive of a UPGMA scan, windows picked by position
+# plot_archived_dendros("chr15_window200_step100_linkage.npz", [68584965, 68600000, 68700000, 68800000, 68900000, 69000000], "200SNPwin_chr15.1_inv_archive")
\ No newline at end of file
@@ -1,9 +1,13 @@
+import os
+import sys
 import gzip
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.cluster.hierarchy import dendrogram, linkage
 from multiprocessing import Pool
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from packed_distances import euclidean_distances
 
 
 
@@ -186,12 +190,11 @@ def UPGMA_on_SNP_windows(vcfgz, SNPwindow, output_dir):
                     end_pos = _get_record_position(line)
                     pos.append((start_pos + end_pos) // 2)
 
-                    #converting matrix to array and transposing
+                    #converting matrix to array, each row is a site
                     matrix = np.array(matrix)
-                    matrix = np.transpose(matrix)
 
-                    #running UPGMA
-                    tre = linkage(matrix, method="average", metric="euclidean")
+                    #running UPGMA on the distances of the bit-packed haplotypes (see haplotype_matrix/packed_distances.py)
+                    tre = linkage(euclidean_distances(matrix, np.float64), method="average")
                     longest, norm_longest = find_top_branch(tre)
                     longest_branch.append(longest)
                     norm_longest_branch.append(norm_longest)
@@ -219,9 +222,8 @@ def UPGMA_on_SNP_windows(vcfgz, SNPwindow, output_dir):
             pos.append((start_pos + end_pos) // 2)
 
             matrix = np.array(matrix)
-            matrix = np.transpose(matrix)
 
-            tre = linkage(matrix, method="average", metric="euclidean")
+            tre = linkage(euclidean_distances(matrix, np.float64), method="average")
             longest, norm_longest = find_top_branch(tre)
             longest_branch.append(longest)
             norm_longest_branch.append(norm_longest)
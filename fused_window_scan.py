@@ -0,0 +1,520 @@
+"""
+This script takes in a phased and imputed vcf of biallelic SNPs for a single chromosome and computes
+several statistics in each window of defined number of SNPs that slides for a defined number of SNPs,
+from a single pass over the vcf. Each statistic is a kernel that takes the haplotypes of a window from the
+shared sliding window, so the vcf is decompressed and parsed once instead of once per scan.
+
+The kernels wrap the helpers of the single statistic scans:
+    hapcount    number of unique haplotypes and sample size (_count_unique_haps of hapcount_scan.py)
+    UPGMA       average branch length, longest branch length and tree height (_runUPGMA of UPGMA_scan/bp_windows_UPGMA_windowed_scan.py)
+    het         geometric mean and p^10 mean across samples of windowed heterozygosity (_windowed_het of het_and_maf_scans/individual_level_windowed_Het.py)
+    SNV         number of rare (MAF <= 0.01) and common (MAF >= 0.01) variants (_count_rare_SNVs and _count_common_SNPs of variant_density_scan/low_freq_SNV_scan.py)
+
+The program outputs one wide csv (or columnar .npz window table, see haplotype_matrix/window_table.py) per chromosome
+and window configuration with a column per statistic.
+New statistics are added by writing a kernel and registering it in KERNELS.
+"""
+
+import os
+import sys
+import heapq
+import numpy as np
+from contextlib import ExitStack
+from multiprocessing import Pool
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "haplotype_matrix"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "UPGMA_scan"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "het_and_maf_scans"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "variant_density_scan"))
+from hapmatrix import HapMatrix, hapmatrix_exists, snp_window_bounds, load_positions, vcf_samples
+from gt_parser import parse_record
+from bgzf_reader import bgzf_open
+from window_buffer import WindowBuffer
+from shards import ShardGroup, scan_config_shards, shard_sites, stitch_shards
+from window_table import open_window_table
+from scheduler import estimate_job, combine_estimates, run_scheduled
+from window_pool import ordered_window_map
+from hapcount_scan import _count_unique_haps
+from bp_windows_UPGMA_windowed_scan import _runUPGMA
+from individual_level_windowed_Het import _windowed_het
+from low_freq_SNV_scan import _count_rare_SNVs, _count_common_SNPs
+sys.setrecursionlimit(10000)
+
+
+### HELPER FUNCTIONS ###
+
+def _site_MAFs(haplo_matrix):
+    """
+    Helper computes the minor allele frequency of each site of a window, same as _compute_record_MAF
+    of variant_density_scan/low_freq_SNV_scan.py: MAF = min(#of0s, #of1s) / (#of0s + #of1s)
+
+    :param haplo_matrix: each row is a site and each column is the haplotype at that site
+    :type haplo_matrix: np.ndarray
+
+    :returns: minor allele frequency of each site
+    :rtype: np.ndarray of float
+    """
+
+    num_haps = haplo_matrix.shape[1]
+    num1s = np.count_nonzero(haplo_matrix, axis=1)
+
+    return np.minimum(num1s, num_haps - num1s) / num_haps
+
+
+
+def _outfile(chrom, SNPwindow_size, SNPwindow_step, outformat="csv"):
+    """
+    Helper gives the output file name of a window configuration
+    """
+
+    return f"{chrom}_SNPwindow{SNPwindow_size}_SNPstep{SNPwindow_step}_window_stats.{outformat}"
+
+
+
+def _check_outputs(outfiles):
+    """
+    Helper exits if an output of an earlier scan exists. The csvs are appended to, so a rerun would add a second header
+    and every window again, with other columns if the kernels changed.
+
+    :param outfiles: output file names of the scan
+    :type outfiles: list of str
+    """
+
+    for outfile in outfiles:
+        if os.path.exists(outfile):
+            exit(f"{outfile} already exists, remove it to rerun the scan")
+
+
+
+### STATISTIC KERNELS ###
+#each kernel takes the haplotypes of a window (each row is a site and each column is a haplotype, same layout as HapMatrix.sites),
+#the positions of the sites and the ploidy, and returns one value per column it registers in KERNELS
+
+def _hapcount_kernel(haplo_matrix, positions, ploidy):
+    """
+    Kernel counts unique haplotypes and sample size
+    """
+
+    num_haps, sample_size = _count_unique_haps(haplo_matrix)
+
+    return [num_haps, sample_size]
+
+
+
+def _UPGMA_kernel(haplo_matrix, positions, ploidy):
+    """
+    Kernel runs UPGMA on the haplotypes and returns the average branch length, longest branch length and tree height
+    """
+
+    avgbranchlen, longest_branch_len, height_of_tree = _runUPGMA(haplo_matrix)
+
+    return [avgbranchlen, longest_branch_len, height_of_tree]
+
+
+
+def _het_kernel(haplo_matrix, positions, ploidy):
+    """
+    Kernel computes the windowed heterozygosity of each sample and returns its geometric mean and p^10 mean across samples.
+    A sample is heterozygous where its two haplotypes differ, so haploid chromosomes get nan.
+    """
+
+    if ploidy != 2:
+        return [np.nan, np.nan]
+
+    #HomHet data of the window
+    homhet_chunk = haplo_matrix[:, 0::2] != haplo_matrix[:, 1::2]
+    chunk_length = int(positions[-1]) - int(positions[0]) + 1
+
+    #the geometric mean is only taken over heterozygous samples
+    if not homhet_chunk.any():
+        return [np.nan, 0.0]
+
+    winHets, geomean, p10mean = _windowed_het(homhet_chunk, chunk_length)
+
+    return [geomean, p10mean]
+
+
+
+def _SNV_kernel(haplo_matrix, positions, ploidy, maf_thresh=0.01):
+    """
+    Kernel counts variants below (rare SNVs) and above (common SNPs) the MAF threshold
+    """
+
+    mafs = _site_MAFs(haplo_matrix)
+
+    return [_count_rare_SNVs(mafs, maf_thresh), _count_common_SNPs(mafs, maf_thresh)]
+
+
+
+#kernel name: (output columns, kernel function)
+KERNELS = {
+    "hapcount": (["hapcount", "sample_size"], _hapcount_kernel),
+    "UPGMA": (["AVG_branch_length", "LONGEST_branch_length", "Tree_Height"], _UPGMA_kernel),
+    "het": (["Het_geometric_mean", "Het_p10_mean"], _het_kernel),
+    "SNV": (["rare_SNV_count", "common_SNP_count"], _SNV_kernel),
+}
+
+
+
+### CLASSES ###
+
+class ArgLoader():
+    def __init__(self, vcfgz_file, windowing, kernels=tuple(KERNELS), decompress_threads=1, outformat="csv", window_threads=1):
+        """
+        Class used to store arguments for the fused_window_scan function which is run using the run_fused_scan main function.
+        This is done so that the main function takes a single argument so that it can be run in parallel using multiprocessing.Pool
+
+        :param vcfgz_file: filename or path to file for the vcf to scan
+        :type vcfgz_file: str
+        :param windowing: (SNP window size, SNP window step) of each window configuration to scan
+        :type windowing: list of (int, int)
+        :param kernels: names of the statistic kernels to run (see KERNELS), defaults to all of them
+        :type kernels: list of str, optional
+        :param decompress_threads: number of threads inflating the vcf, defaults to 1
+        :type decompress_threads: int, optional
+        :param outformat: "csv" for text csvs or "npz" for columnar window tables, defaults to "csv"
+        :type outformat: str, optional
+        :param window_threads: number of threads running the kernels on the windows of the haplotype matrix, defaults to 1
+        :type window_threads: int, optional
+
+        Attributes:
+            vcf (str): holds the vcf filename for run_fused_scan to parse
+            windowing (list of (int, int)): holds the window configurations for run_fused_scan to parse
+            kernels (list of str): holds the kernel names for run_fused_scan to parse
+            threads (int): holds the number of decompression threads for run_fused_scan to parse
+            outformat (str): holds the output format for run_fused_scan to parse
+            window_threads (int): holds the number of window threads for run_fused_scan to parse
+        """
+
+        self.vcf = vcfgz_file
+        self.windowing = windowing
+        self.kernels = kernels
+        self.threads = decompress_threads
+        self.outformat = outformat
+        self.window_threads = window_threads
+
+    def __str__(self):
+        return self.vcf + "\t" + str(self.windowing) + "\t" + str(self.kernels)
+
+
+
+
+### SLIDING WINDOW SCAN FUNCTION ###
+
+def _columns(kernels):
+    """
+    Helper builds the output columns for a list of kernel names
+    """
+
+    columns = ["CHROM", "START", "END", "SNP_density"]
+    for name in kernels:
+        columns += KERNELS[name][0]
+
+    return columns
+
+
+
+def fused_window_scan(vcfgz, windowing, kernels=tuple(KERNELS), decompress_threads=1, outformat="csv", window_threads=1):
+    """
+    Function computes every statistic kernel in sliding SNP windows from a single pass over a gziped vcf.
+    Every window configuration is served from the same pass and written to its own csv.
+
+    :param vcfgz: gziped vcf file name or path to file
+    :type vcfgz: str
+    :param windowing: (SNP window size, SNP window step) of each window configuration
+    :type windowing: list of (int, int)
+    :param kernels: names of the statistic kernels to run (see KERNELS), defaults to all of them
+    :type kernels: list of str, optional
+    :param decompress_threads: number of threads inflating the BGZF blocks of the vcf (see haplotype_matrix/bgzf_reader.py)
+    :type decompress_threads: int, optional
+    :param outformat: "csv" appends to text csvs, "npz" writes columnar window tables (see haplotype_matrix/window_table.py), defaults to "csv".
+        Outputs of an earlier scan are refused instead of appended to
+    :type outformat: str, optional
+    :param window_threads: number of threads running the kernels on the windows sliced from the haplotype matrix (see haplotype_matrix/window_pool.py),
+        the vcf pass hands each window to the kernels as soon as it is complete and runs them in order, defaults to 1
+    :type window_threads: int, optional
+
+    :returns: writes an output csv (or window table) per window configuration
+    :rtype: None
+    """
+
+    for name in kernels:
+        if name not in KERNELS:
+            exit(f"{name} is not a statistic kernel, choose from {list(KERNELS)}")
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    _check_outputs([_outfile(chrom, size, step, outformat) for size, step in windowing])
+
+    #read from the bit-packed haplotype matrix if it was built for this vcf
+    if hapmatrix_exists(vcfgz):
+        _hapmatrix_fused_scan(vcfgz, windowing, kernels, outformat, window_threads)
+        return
+
+    #setting up the array-backed sliding window shared by the window configurations and the kernels (see haplotype_matrix/window_buffer.py)
+    window = WindowBuffer()
+    #site index of the next window start of each configuration
+    next_lo = [0] * len(windowing)
+    num_samples = None
+
+    #open files
+    with bgzf_open(vcfgz, "rb", threads=decompress_threads) as vcf, ExitStack() as outfiles:
+
+        #open a csv per window configuration and write header lines
+        outcsvs = []
+        for SNPwindow_size, SNPwindow_step in windowing:
+            outcsvs.append(outfiles.enter_context(open_window_table(_outfile(chrom, SNPwindow_size, SNPwindow_step, outformat), _columns(kernels), outformat)))
+
+        #loop through lines
+        for line in vcf:
+
+            #grab number of samples from the header
+            if line.startswith(b"#CHROM"):
+                num_samples = len(line.rstrip().split(b"\t")) - 9
+                continue
+
+            #skip header lines
+            elif line.startswith(b"#"):
+                continue
+
+            #sliding window scan
+            else:
+
+                #load record into window
+                window.append(*parse_record(line))
+                num_sites = window.num_appended()
+
+                #check if the window size of each configuration was reached, if yes, output results and move that window by a step
+                for c, (SNPwindow_size, SNPwindow_step) in enumerate(windowing):
+                    if next_lo[c] + SNPwindow_size <= num_sites:
+                        _write_windows(chrom, window, [(next_lo[c], next_lo[c] + SNPwindow_size)], kernels, num_samples, outcsvs[c])
+                        next_lo[c] += SNPwindow_step
+
+                #sliding to the earliest next window start
+                window.pop(min(next_lo) - window.first)
+
+        #clean up last window of each configuration
+        num_sites = window.num_appended()
+        for c in range(len(windowing)):
+            if next_lo[c] < num_sites:
+                _write_windows(chrom, window, [(next_lo[c], num_sites)], kernels, num_samples, outcsvs[c])
+
+
+
+
+def _hapmatrix_fused_scan(vcfgz, windowing, kernels, outformat="csv", window_threads=1):
+    """
+    Runs the same scan as fused_window_scan on the bit-packed haplotype matrix built with
+    haplotype_matrix/hapmatrix.py. Windows are sliced from the memory-mapped matrix instead of parsed from the vcf.
+    """
+
+    #open haplotype matrix
+    hapmat = HapMatrix(vcfgz)
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+
+    for SNPwindow_size, SNPwindow_step in windowing:
+
+        #open files and write header line
+        with open_window_table(_outfile(chrom, SNPwindow_size, SNPwindow_step, outformat), _columns(kernels), outformat) as outcsv:
+
+            #loop through windows
+            _write_windows(chrom, hapmat, snp_window_bounds(hapmat.num_sites, SNPwindow_size, SNPwindow_step), kernels, len(hapmat.samples), outcsv, window_threads)
+
+
+
+
+def _window_stats(hap_m, positions, kernels, num_samples):
+    """
+    Helper runs every kernel on the haplotypes of a window, returns the window position, SNP density and the kernel columns of its row
+    """
+
+    #grab window position
+    start_pos = int(positions[0])
+    end_pos = int(positions[-1]) + 1
+
+    #compute SNP density
+    snpden = hap_m.shape[0] / (end_pos - start_pos)
+    ploidy = hap_m.shape[1] // num_samples
+
+    #run every kernel on the same window
+    row = [start_pos, end_pos, snpden]
+    for name in kernels:
+        row += KERNELS[name][1](hap_m, positions, ploidy)
+
+    return row
+
+
+
+def _write_windows(chrom, hapsites, bounds, kernels, num_samples, outcsv, window_threads=1):
+    """
+    Runs the statistic kernels on each window of a list of SNP windows and writes the csv rows.
+    Used by the vcf scan and the haplotype matrix scan, see _write_config_windows for the parameters.
+    """
+
+    _write_config_windows(chrom, hapsites, [bounds], kernels, num_samples, [outcsv], window_threads)
+
+
+
+
+def _write_config_windows(chrom, hapsites, config_bounds, kernels, num_samples, outcsvs, window_threads=1):
+    """
+    Runs the statistic kernels on the windows of one or more window configurations and writes the csv rows of each configuration
+    to its own output. The windows are sliced in order of their first site, so the shards of the parallel scan serve every
+    configuration from one pass over their sites.
+
+    :param chrom: chromosome name for the output
+    :type chrom: str
+    :param hapsites: sites to slice the windows from, by site index on the chromosome
+    :type hapsites: WindowBuffer or HapMatrix or ShardSites
+    :param config_bounds: [first_site, last_site) index pairs of the windows to scan, in order, for each configuration
+    :type config_bounds: list of list of (int, int)
+    :param kernels: names of the statistic kernels to run
+    :type kernels: list of str
+    :param num_samples: number of samples in the vcf, used to find the ploidy
+    :type num_samples: int
+    :param outcsvs: open output table of each configuration
+    :type outcsvs: list of TextTableWriter or WindowTableWriter
+    :param window_threads: number of threads running the kernels on the windows, defaults to 1
+    :type window_threads: int, optional
+    """
+
+    #windows of all configurations merged by their first site
+    merged = heapq.merge(*[[(lo, c, hi) for lo, hi in bounds] for c, bounds in enumerate(config_bounds)])
+
+    #slice haplo matrices and positions in order and run the kernels on the window threads (see haplotype_matrix/window_pool.py)
+    windows = ((c, (hapsites.sites(lo, hi), hapsites.site_positions(lo, hi), kernels, num_samples)) for lo, c, hi in merged)
+    for c, stats in ordered_window_map(_window_stats, windows, window_threads):
+
+        #write to file
+        outcsvs[c].write_row([chrom] + stats)
+
+
+
+
+### MAIN FUNCTION ###
+def run_fused_scan(argloader_obj):
+    """
+    Main Function that runs fused_window_scan with a single argument of the class ArgLoader
+    """
+
+    fused_window_scan(argloader_obj.vcf, argloader_obj.windowing, argloader_obj.kernels, argloader_obj.threads, argloader_obj.outformat, argloader_obj.window_threads)
+
+
+
+def run_fused_shard(shard):
+    """
+    Main Function that runs one shard of a fused SNP window scan with a single argument of the class ShardLoader, or the shards of every
+    window configuration covering the same sites with a ShardGroup (see haplotype_matrix/shards.py). The sites of the group are read once
+    and the csv rows of each configuration are written without a header to the output of its shard, which are stitched together in main.
+    All of the kernels are run.
+    """
+
+    shards = shard.shards if isinstance(shard, ShardGroup) else [shard]
+
+    #windows of each shard
+    positions = load_positions(shard.vcf)
+    config_bounds = [snp_window_bounds(len(positions), config_shard.winsize, config_shard.winstep)[config_shard.first_window:config_shard.last_window]
+                     for config_shard in shards]
+
+    chrom = shard.vcf.split("_")[-1].replace(".vcf.gz", "")
+    with ExitStack() as outfiles:
+        outcsvs = [outfiles.enter_context(open_window_table(config_shard.outfile, _columns(list(KERNELS)), config_shard.outformat, header=False, mode="w"))
+                   for config_shard in shards]
+
+        windowed = [bounds for bounds in config_bounds if len(bounds) > 0]
+        if len(windowed) > 0:
+            #sites from the first to the last window of the shards
+            hapsites = shard_sites(shard, positions, min([bounds[0][0] for bounds in windowed]), max([bounds[-1][1] for bounds in windowed]))
+            _write_config_windows(chrom, hapsites, config_bounds, list(KERNELS), len(vcf_samples(shard.vcf)), outcsvs, shard.window_threads)
+
+
+
+# args = ArgLoader("test1.vcf.gz", [(1000, 100)])
+# run_fused_scan(args)
+
+
+
+### PARALLELIZATION ###
+
+def main():
+
+    vcflist = [
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr1.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr2.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr3.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr4.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr5.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr6.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr7.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr8.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr9.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr10.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr11.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr12.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr13.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr14.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr15.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr16.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr17.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr18.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr19.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr20.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr21.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr22.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_nonPAR_chrX.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_PAR_chrX.vcf.gz",
+        "beagle_imputed_males_biallelic_SNPs_1000GP30X_chrY.vcf.gz"
+        ]
+
+    windowing = [(1000, 100), (10000, 1000)]
+    processes = 25
+    #"npz" writes columnar window tables that the downstream scripts load without parsing text (see haplotype_matrix/window_table.py)
+    outformat = "csv"
+    #RAM the running shards may use together, shards are started longest first while their estimated memory fits (see haplotype_matrix/scheduler.py)
+    ram_budget = 64 * 2 ** 30
+    #tab separated log of the peak RSS and runtime of each shard, None only prints them
+    job_log = None
+    #threads running the kernels on the windows of each shard, so that the cores stay busy once only a few long shards are left (see haplotype_matrix/window_pool.py)
+    window_threads = 1
+
+    #the stitched csvs are appended to, outputs of an earlier run are refused before any shard is scanned
+    _check_outputs([_outfile(vcffile.split("_")[-1].replace(".vcf.gz", ""), size, step, outformat) for vcffile in vcflist for size, step in windowing])
+
+    pool = Pool(processes=processes)
+
+    #positions of each chromosome, read once and cached next to the vcfs
+    positions = dict(zip(vcflist, pool.map(load_positions, vcflist)))
+    pool.close()
+
+    #chromosomes are split into shards of about the same number of SNPs, a few per process so that they balance out
+    shard_snps = sum([len(p) for p in positions.values()]) // (4 * processes)
+
+    scans = {}
+    jobs, estimates = [], []
+    for vcffile in vcflist:
+        chrom = vcffile.split("_")[-1].replace(".vcf.gz", "")
+        outfiles = [_outfile(chrom, size, step, outformat) for size, step in windowing]
+        bounds = [np.array(snp_window_bounds(len(positions[vcffile]), size, step), dtype=np.int64).reshape(-1, 2) for size, step in windowing]
+
+        #the shards of every window configuration are cut at the same sites, so that each job reads its sites once for all of the configurations
+        config_shards = scan_config_shards(vcffile, windowing, [b[:, 0] for b in bounds], [b[:, 1] for b in bounds], shard_snps, outfiles,
+                                           outformat=outformat, window_threads=window_threads)
+        scans.update(zip(outfiles, config_shards))
+
+        #estimated memory and runtime of each group of shards, UPGMA memory grows with the square of the haplotypes
+        num_haps = 2 * len(vcf_samples(vcffile))
+        for group in zip(*config_shards):
+            jobs.append(ShardGroup(list(group)))
+            estimates.append(combine_estimates([estimate_job("fused", num_haps, bounds[c][shard.first_window:shard.last_window, 0], bounds[c][shard.first_window:shard.last_window, 1])
+                                                for c, shard in enumerate(group)]))
+
+    #stitch the shard outputs of each scan in window order as soon as its last shard is done
+    remaining = {outfile: len(shards) for outfile, shards in scans.items()}
+    scan_of = {shard.outfile: outfile for outfile, shards in scans.items() for shard in shards}
+    for group, result in run_scheduled(run_fused_shard, jobs, estimates, processes, ram_budget, job_log):
+        for shard in group.shards:
+            outfile = scan_of[shard.outfile]
+            remaining[outfile] -= 1
+            if remaining[outfile] == 0:
+                stitch_shards(scans[outfile], outfile, ",".join(_columns(list(KERNELS))) + "\n")
+
+
+if __name__ == '__main__':
+    main()
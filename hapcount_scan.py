@@ -5,220 +5,529 @@ of SNPs that slides for a defined number of SNPs. The program outputs a bedfile
 the windowed results. This can be run on multiple vcfs at once using mutliprocessing.
 """
 
-import gzip
+import os
+import sys
+import heapq
 import pandas as pd
 import numpy as np
-from collections import deque
+from contextlib import ExitStack
+from functools import partial
 from multiprocessing import Pool
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "haplotype_matrix"))
+from hapmatrix import HapMatrix, SampleView, hapmatrix_exists, snp_window_bounds, load_positions, read_sample_manifest, manifest_tag, vcf_samples
+from gt_parser import parse_record
+from bgzf_reader import bgzf_open
+from window_buffer import WindowBuffer
+from shards import ShardLoader, ShardGroup, scan_config_shards, shard_sites, stitch_shards
+from window_table import open_window_table
+from hap_hash import RollingHapCounter
+from pbwt import PBWT, pbwt_window_counts
+from hap_sketch import SketchHapCounter
+from hap_groups import HapGroups, read_sample_groups, hap_class_ids
+from hap_spectrum import unique_hap_counts, spectrum_columns, spectrum_stats
+from checkpoint import open_checkpoint
+from scheduler import estimate_job, combine_estimates, run_scheduled
+from window_pool import ordered_window_map
 
 
 ### HELPER FUNCTIONS ###
 
-def _joinany(sep, mylist):
+def _count_unique_haps(haplo_matrix):
     """
-    Helper function to join a list by a sep regardless of element types
+    Helper counts unique haplotypes and sample size of a given window.
+    
+    :param haplo_matrix: each row is a site and each column is the haplotype at that site
+    :type haplo_matrix: np.ndarray
+
+    :returns: number of unique haplotypes and total number of haplotypes (sample size) in the haplo_matrix
+    :rtype: int, int
     """
 
-    strs = [str(x) for x in mylist]
 
-    return sep.join(strs)
+    #packing the alleles of each haplotype into bytes, one row per haplotype
+    packed = np.packbits(np.asarray(haplo_matrix, dtype=np.uint8).T, axis=1)
 
+    #counting sample size
+    num_samples = len(packed)
+    if packed.shape[1] == 0:
+        return min(num_samples, 1), num_samples
 
+    #uniquify, each packed row is viewed as a single bytes scalar so rows are compared with memcmp
+    rows = np.ascontiguousarray(packed).view(np.dtype((np.void, packed.shape[1])))
+    uniq_rows = np.unique(rows)
 
-def _pop_step(d, step):
-    """
-    Helper function used to pop a number of elements from the left
-    of a deque equal to the step size in. This is done in place.
-    """
+    #counting unique haplotypes
+    num_uniq_haps = len(uniq_rows)
 
-    for i in range(step):
-        d.popleft()
 
+    return num_uniq_haps, num_samples
 
-def _construct_matrix(d):
-    """
-    Helper function takes in the window deque and constructs the haplo matrix
-    
-    :param d: window deque
-    :type d: deque of RecordLoader objects
 
-    :returns: each sublist is a site and each sublist element is the haplotype at that site
-    :rtype: list of lists
-    """
- 
 
-    matrix = []
-    for record in d:
-        hap_ls = []
-        for gt in record.GTs:
-            haps = gt.split("|")
-            for h in haps:
-                hap_ls.append(int(h))
-        matrix.append(hap_ls)
+def _hap_counter(incremental, verify, pbwt, approx=None, sketch="kmv"):
+    """
+    Helper picks the haplotype counter of a window configuration, None sorts every window with _count_unique_haps
+    """
 
+    if approx is not None:
+        return SketchHapCounter(approx, sketch)
+    elif pbwt:
+        return PBWT()
+    elif incremental:
+        return RollingHapCounter(verify)
 
-    return matrix
+    return None
 
 
 
-def _count_unique_haps(haplo_matrix):
+def _sliced_windows(hapsites, config_bounds, slice_sites=True):
     """
-    Helper counts unique haplotypes and sample size of a given window.
-    
-    :param haplo_matrix: each sublist is a site and each sublist element is the haplotype at that site
-    :type haplo_matrix: list of lists
-
-    :returns: number of unique haplotypes and total number of haplotypes (sample size) in the haplo_matrix
-    :rtype: int, int
+    Helper slices the windows of one or more window configurations in order of their first site, so that one pass over the sites serves
+    every configuration and the windows of each configuration stay in order. Yields the configuration, window index, site bounds and
+    start and end positions of each window with its haplotypes
     """
 
+    #windows of all configurations merged by their first site
+    windows = heapq.merge(*[[(lo, c, i, hi) for i, (lo, hi) in enumerate(bounds)] for c, bounds in enumerate(config_bounds)])
+    for lo, c, i, hi in windows:
 
-    #converting matrix to array and transposing
-    matrix = np.array(haplo_matrix)
-    matrix = np.transpose(matrix)
+        #slice haplo matrix
+        hap_m = hapsites.sites(lo, hi) if slice_sites else None
 
-    #counting sample size
-    num_samples = len(matrix)
+        #grab window position
+        positions = hapsites.site_positions(lo, hi)
 
-    #uniquify
-    uniq_matrix = np.unique(matrix, axis=0)
+        yield (c, i, lo, hi, int(positions[0]), int(positions[-1]) + 1), hap_m
 
-    #counting unique haplotypes
-    num_uniq_haps = len(uniq_matrix)
 
 
-    return num_uniq_haps, num_samples
+def _columns(approx=None, hapgroups=None, spectrum=False):
+    """
+    Helper gives the output columns, the spectrum adds the haplotype frequency spectrum statistics, the approximate scan adds
+    the relative standard error of the counts and the group counts add the distinct haplotypes and sample size of each group
+    """
 
+    columns = ["#CHROM", "START", "END", "SNP_density", "hapcount", "sample_size"]
+    if spectrum:
+        columns += spectrum_columns()
+    if approx is not None:
+        columns.append("hapcount_rse")
+    if hapgroups is not None:
+        columns += hapgroups.columns()
 
+    return columns
 
-### CLASSES ###
 
-class RecordLoader():
-    def __init__(self, vcfline):
-        """
-        This class is for parsing a vcf record for it to be added to a deque.
-        
-        :param vcfline: record line from vcf to be parsed
-        :type vcfline: str
 
-        Attributes:
-            position (int): record position
-            GTs (list of str): list of individual genotypes e.g. ["0|0", "1|0"...]
-        """
+def _hap_groups(vcfgz, groups, group_column, manifest):
+    """
+    Helper reads the sample groups of a scan from a panel file (see haplotype_matrix/hap_groups.py), None without a panel file
+    """
 
+    if groups is None:
+        return None
 
-        self.position = int(vcfline.strip().split("\t")[1])
-        self.GTs = vcfline.strip().split("\t")[9:]
+    return HapGroups(vcf_samples(vcfgz), read_sample_groups(groups, group_column), None if manifest is None else read_sample_manifest(manifest))
 
 
 
+### CLASSES ###
+
 class ArgLoader():
-    def __init__(self, vcfgz_file, windowsize, windowstep):
+    def __init__(self, vcfgz_file, windowing, decompress_threads=1, manifest=None, outformat="bed", incremental=True, verify=False, pbwt=False, spectrum=False,
+                 approx=None, sketch="kmv", groups=None, group_column=2, checkpoint=None, resume=False, window_threads=1):
         """
         Class used to store arguments for the SNPwindow_hap_counter function which is run using the run_hapcount_scan main function.
         This is done so that the main function takes a single argument so that it can be run in parallel using multiprocessing.Pool
         
         :param vcfgz_file: filename or path to file for the vcf to scan
         :type vcfgz_file: str
-        :param windowsize: SNP window size
-        :type windowsize: int
-        :param windowstep: SNP window step, recommended to be 10% of windowsize
-        :type windowstep: int
+        :param windowing: (SNP window size, SNP window step) of each window configuration to scan, step recommended to be 10% of size
+        :type windowing: list of (int, int)
+        :param decompress_threads: number of threads inflating the vcf, defaults to 1
+        :type decompress_threads: int, optional
+        :param manifest: sample manifest of the samples to scan, defaults to all samples
+        :type manifest: str, optional
+        :param outformat: "bed" for text bedfiles or "npz" for columnar window tables, defaults to "bed"
+        :type outformat: str, optional
+        :param incremental: count haplotypes with rolling hashes, defaults to True
+        :type incremental: bool, optional
+        :param verify: check the rolling hashes for collisions, defaults to False
+        :type verify: bool, optional
+        :param pbwt: count haplotypes with the PBWT instead, defaults to False
+        :type pbwt: bool, optional
+        :param spectrum: also write the haplotype frequency spectrum statistics, defaults to False
+        :type spectrum: bool, optional
+        :param approx: relative standard error of approximate counts, defaults to exact counts
+        :type approx: float, optional
+        :param sketch: sketch of the approximate counts, "kmv" or "hll", defaults to "kmv"
+        :type sketch: str, optional
+        :param groups: panel file with the group of each sample, defaults to no group counts
+        :type groups: str, optional
+        :param group_column: column of the group in the panel file, defaults to 2 (super_pop)
+        :type group_column: int, optional
+        :param checkpoint: number of windows between checkpoints of the outputs, defaults to no checkpoints
+        :type checkpoint: int, optional
+        :param resume: continue the outputs of an interrupted scan from their checkpoints, defaults to False
+        :type resume: bool, optional
+        :param window_threads: number of threads sorting the windows of the haplotype matrix when incremental is False, defaults to 1
+        :type window_threads: int, optional
 
         Attributes:
             vcf (str): holds the vcf filename for run_hapcount_scan to parse
-            winsize (int): holds the window size for run_hapcount_scan to parse
-            winstep (int): holds the window step for run_hapcount_scan to parse
+            windowing (list of (int, int)): holds the window configurations for run_hapcount_scan to parse
+            threads (int): holds the number of decompression threads for run_hapcount_scan to parse
+            manifest (str or None): holds the sample manifest for run_hapcount_scan to parse
+            outformat (str): holds the output format for run_hapcount_scan to parse
+            incremental (bool): holds the counting method for run_hapcount_scan to parse
+            verify (bool): holds the collision check for run_hapcount_scan to parse
+            pbwt (bool): holds the PBWT backend switch for run_hapcount_scan to parse
+            spectrum (bool): holds the spectrum switch for run_hapcount_scan to parse
+            approx (float or None): holds the relative error of the approximate counts for run_hapcount_scan to parse
+            sketch (str): holds the sketch of the approximate counts for run_hapcount_scan to parse
+            groups (str or None): holds the panel file of the group counts for run_hapcount_scan to parse
+            group_column (int): holds the group column of the panel file for run_hapcount_scan to parse
+            checkpoint (int or None): holds the number of windows between checkpoints for run_hapcount_scan to parse
+            resume (bool): holds the resume switch for run_hapcount_scan to parse
+            window_threads (int): holds the number of window threads for run_hapcount_scan to parse
         """
 
         self.vcf = vcfgz_file
-        self.winsize = windowsize
-        self.winstep = windowstep
+        self.windowing = windowing
+        self.threads = decompress_threads
+        self.manifest = manifest
+        self.outformat = outformat
+        self.incremental = incremental
+        self.verify = verify
+        self.pbwt = pbwt
+        self.spectrum = spectrum
+        self.approx = approx
+        self.sketch = sketch
+        self.groups = groups
+        self.group_column = group_column
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.window_threads = window_threads
 
     def __str__(self):
-        return self.vcf + "\t" + str(self.winsize) + "\t" + str(self.winstep)
+        return self.vcf + "\t" + str(self.windowing)
 
 
 
 
 ### SLIDING WINDOW SCAN FUNCTION ###
 
-def SNPwindow_hap_counter(vcfgz, SNPwindow_size, SNPwindow_step):
+def SNPwindow_hap_counter(vcfgz, windowing, decompress_threads=1, manifest=None, outformat="bed", incremental=True, verify=False, pbwt=False, spectrum=False,
+                          approx=None, sketch="kmv", groups=None, group_column=2, checkpoint=None, resume=False, window_threads=1):
     """
     Function counts unique haplotypes in sliding windows on a gizped vcf. See other functions for details.
+    Every window configuration is served from the same pass over the vcf and written to its own bedfile.
     
     :param vcfgz: gziped vcf file name or path to file
     :type vcfgz: str
-    :param SNPwindow_size: number of SNPs defining the window size
-    :type SNPwindow_size: int
-    :param SNPwindow_step: number of SNPs to slide window, recommended to be 10% of SNPwindow_size
-    :type SNPwindow_step: int
+    :param windowing: (SNP window size, SNP window step) of each window configuration, the step is recommended to be 10% of the size
+    :type windowing: list of (int, int)
+    :param decompress_threads: number of threads inflating the BGZF blocks of the vcf (see haplotype_matrix/bgzf_reader.py)
+    :type decompress_threads: int, optional
+    :param manifest: sample manifest (see read_sample_manifest in haplotype_matrix/hapmatrix.py), only the haplotypes of its samples are counted
+        and the manifest name is added to the output file names, defaults to all samples
+    :type manifest: str, optional
+    :param outformat: "bed" appends to text bedfiles, "npz" writes columnar window tables (see haplotype_matrix/window_table.py), defaults to "bed"
+    :type outformat: str, optional
+    :param incremental: count haplotypes with a RollingHapCounter (see haplotype_matrix/hap_hash.py) per window configuration that updates
+        the haplotype hashes by the sites leaving and entering the window instead of sorting every window, defaults to True
+    :type incremental: bool, optional
+    :param verify: compare the haplotypes sharing a rolling hash and count the window exactly if they differ, defaults to False
+    :type verify: bool, optional
+    :param pbwt: count haplotypes with a PBWT (see haplotype_matrix/pbwt.py) fed every site of the chromosome once,
+        the windows of every configuration are counted from its divergence array, defaults to False
+    :type pbwt: bool, optional
+    :param spectrum: also write the haplotype diversity, entropy, H1, H12, H2/H1, top haplotype frequencies and the run-length encoded
+        haplotype frequency spectrum of each window (see haplotype_matrix/hap_spectrum.py), taken from the same grouping that counts
+        the unique haplotypes, defaults to False
+    :type spectrum: bool, optional
+    :param approx: relative standard error of approximate counts e.g. 0.01, the distinct rolling hashes of each window are counted with a
+        fixed size sketch (see haplotype_matrix/hap_sketch.py) instead of exactly and the error is written in a hapcount_rse column,
+        overrides incremental and pbwt, defaults to exact counts
+    :type approx: float, optional
+    :param sketch: sketch of the approximate counts, "kmv" (k minimum values) or "hll" (HyperLogLog), defaults to "kmv"
+    :type sketch: str, optional
+    :param groups: panel file with the group of each sample (e.g. the 1000 Genomes panel file, see read_sample_groups in haplotype_matrix/hap_groups.py),
+        the distinct haplotypes and sample size of each group are also written, counted from the distinct haplotype ids of the same grouping
+        that counts all haplotypes, defaults to no group counts
+    :type groups: str, optional
+    :param group_column: column of the group in the panel file, 0 based, defaults to 2 (super_pop)
+    :type group_column: int, optional
+    :param checkpoint: number of windows between checkpoints (see haplotype_matrix/checkpoint.py), the outputs are then written from scratch
+        instead of appended to and flushed to disk with a checkpoint of the last written window every `checkpoint` windows, defaults to no checkpoints
+    :type checkpoint: int, optional
+    :param resume: continue the outputs of an interrupted checkpointed scan: each output is truncated to its checkpoint and the scan seeks
+        to the next window with the tabix index (or slices the haplotype matrix), outputs without a checkpoint are finished and skipped, defaults to False
+    :type resume: bool, optional
+    :param window_threads: number of threads sorting the windows when incremental is False (see haplotype_matrix/window_pool.py), used when the
+        windows are sliced from the haplotype matrix or a resumed scan, the rolling hash, PBWT and sketch counters count the windows in order, defaults to 1
+    :type window_threads: int, optional
     
-    :returns: appends to output bedfile
+    :returns: appends to an output bedfile (or writes a window table) per window configuration
     :rtype: None
     """
 
-    #setting up deque for sliding window
-    window_deque = deque()
+    if spectrum and approx is not None:
+        exit("The haplotype frequency spectrum needs exact counts, approx has to be None")
+    if groups is not None and approx is not None:
+        exit("The group counts need exact counts, approx has to be None")
+    if (checkpoint is not None or resume) and outformat == "npz":
+        exit("Checkpoints need text outputs, outformat has to be bed")
+    if resume and checkpoint is None:
+        exit("resume needs checkpoint, the number of windows between checkpoints")
+
+    #continue the outputs of an interrupted scan from their checkpoints
+    if resume:
+        _resume_hap_counter(vcfgz, windowing, checkpoint, decompress_threads, manifest, incremental, verify, pbwt, spectrum, approx, sketch, groups, group_column, window_threads)
+        return
+
+    #read from the bit-packed haplotype matrix if it was built for this vcf
+    if hapmatrix_exists(vcfgz):
+        _hapmatrix_hap_counter(vcfgz, windowing, manifest, outformat, incremental, verify, pbwt, spectrum, approx, sketch, groups, group_column, checkpoint, window_threads)
+        return
+
+    #setting up the array-backed sliding window shared by the window configurations (see haplotype_matrix/window_buffer.py)
+    window = WindowBuffer()
+    hapsites = window
+    #site index of the next window start of each configuration
+    next_lo = [0] * len(windowing)
+    #incremental haplotype counter of each configuration, the configurations share one PBWT fed every site
+    sweep = PBWT() if pbwt and approx is None else None
+    counters = [sweep if sweep is not None else _hap_counter(incremental, verify, False, approx, sketch) for c in windowing]
+    #group of each haplotype for the group counts
+    hapgroups = _hap_groups(vcfgz, groups, group_column, manifest)
+    #checkpoint of each configuration (see haplotype_matrix/checkpoint.py)
+    ckpts = [None] * len(windowing)
 
     #open files
     chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
-    with gzip.open(vcfgz, "rt") as vcf, open(f"{chrom}_SNPwindow{SNPwindow_size}_SNPstep{SNPwindow_step}_hap_counts.bed", "a") as outbed:
-
-        #write header line
-        outbed.write("\t".join(["#CHROM", "START", "END", "SNP_density", "hapcount", "sample_size"]) + "\n")
+    with bgzf_open(vcfgz, "rb", threads=decompress_threads) as vcf, ExitStack() as outfiles:
+
+        #open a bedfile per window configuration and write header lines
+        outbeds = []
+        for c, (SNPwindow_size, SNPwindow_step) in enumerate(windowing):
+            outfile = f"{chrom}_SNPwindow{SNPwindow_size}_SNPstep{SNPwindow_step}{manifest_tag(manifest)}_hap_counts.{outformat}"
+            if checkpoint is None:
+                outbeds.append(outfiles.enter_context(open_window_table(outfile, _columns(approx, hapgroups, spectrum), outformat, sep="\t")))
+            else:
+                ckpts[c] = open_checkpoint(outfile, checkpoint)
+                outbeds.append(outfiles.enter_context(open_window_table(outfile, _columns(approx, hapgroups, spectrum), outformat, sep="\t", mode=ckpts[c].mode())))
+                ckpts[c].start(outbeds[c].outfile)
 
         #loop through lines
         for line in vcf:
 
+            #select the haplotypes of the manifest samples from the window
+            if line.startswith(b"#CHROM") and manifest is not None:
+                hapsites = SampleView(window, line.decode().strip().split("\t")[9:], read_sample_manifest(manifest))
+                continue
+
             #skip header lines
-            if line.startswith("#"):
+            elif line.startswith(b"#"):
                 continue
 
             #sliding window scan
             else:
 
-                #load record into deque
-                window_deque.append(RecordLoader(line))
+                #load record into window
+                window.append(*parse_record(line))
+                num_sites = window.num_appended()
+                if sweep is not None:
+                    sweep.update(hapsites.sites(num_sites - 1, num_sites))
+
+                #check if the window size of each configuration was reached, if yes, output results and move that window by a step
+                for c, (SNPwindow_size, SNPwindow_step) in enumerate(windowing):
+                    if next_lo[c] + SNPwindow_size <= num_sites:
+                        _write_windows(chrom, hapsites, [(next_lo[c], next_lo[c] + SNPwindow_size)], outbeds[c], counters[c], hapgroups=hapgroups, checkpoint=ckpts[c], spectrum=spectrum)
+                        next_lo[c] += SNPwindow_step
 
-                #check if window size was reached, if yes, move the window by a step, output results, and continue
-                if len(window_deque) >= SNPwindow_size:
+                #sliding to the earliest next window start
+                window.pop(min(next_lo) - window.first)
 
-                    #grab window position
-                    start_pos = window_deque[0].position
-                    end_pos = window_deque[-1].position + 1
-                    
-                    #construct haplo matrix
-                    hap_m = _construct_matrix(window_deque)
-                    #count haps
-                    num_haps, sample_size = _count_unique_haps(hap_m)
-                    #compute SNP density
-                    snpden = SNPwindow_size / (end_pos - start_pos)
-                    #sliding to next step
-                    _pop_step(window_deque, SNPwindow_step)
+        #clean up last window of each configuration
+        num_sites = window.num_appended()
+        for c in range(len(windowing)):
+            if next_lo[c] < num_sites:
+                _write_windows(chrom, hapsites, [(next_lo[c], num_sites)], outbeds[c], counters[c], hapgroups=hapgroups, checkpoint=ckpts[c], spectrum=spectrum)
 
-                    #write to file
-                    outbed.write(_joinany("\t", [chrom, start_pos, end_pos, snpden, num_haps, sample_size]) + "\n")
+    #every window is written
+    for ckpt in ckpts:
+        if ckpt is not None:
+            ckpt.finish()
 
-                else:
-                    continue
 
-        #clean up last window
-        if len(window_deque) > 0:
-            
-            #grab window position
-            start_pos = window_deque[0].position
-            end_pos = window_deque[-1].position + 1
 
-            #construct haplo matrix
-            hap_m = _construct_matrix(window_deque)
-            #count haps
-            num_haps, sample_size = _count_unique_haps(hap_m)
-            #compute SNP density
-            snpden = len(window_deque) / (end_pos - start_pos)
-            
-            #write to file
-            outbed.write(_joinany("\t", [chrom, start_pos, end_pos, snpden, num_haps, sample_size]) + "\n")
+
+def _hapmatrix_hap_counter(vcfgz, windowing, manifest=None, outformat="bed", incremental=True, verify=False, pbwt=False, spectrum=False, approx=None, sketch="kmv",
+                           groups=None, group_column=2, checkpoint=None, window_threads=1):
+    """
+    Runs the same scan as SNPwindow_hap_counter on the bit-packed haplotype matrix built with
+    haplotype_matrix/hapmatrix.py. Windows are sliced from the memory-mapped matrix instead of parsed from the vcf.
+    With pbwt the windows of every configuration are counted from one sweep and are not sliced, unless they are also counted per group.
+    """
+
+    #open haplotype matrix
+    hapmat = HapMatrix(vcfgz)
+    hapsites = hapmat if manifest is None else SampleView(hapmat, hapmat.samples, read_sample_manifest(manifest))
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    windows = [snp_window_bounds(hapmat.num_sites, SNPwindow_size, SNPwindow_step) for SNPwindow_size, SNPwindow_step in windowing]
+    hapgroups = _hap_groups(vcfgz, groups, group_column, manifest)
+
+    #count the windows of all configurations from one PBWT sweep (see haplotype_matrix/pbwt.py)
+    counts = [None] * len(windowing)
+    if pbwt and approx is None and hapgroups is None:
+        all_bounds = [bounds for config_bounds in windows for bounds in config_bounds]
+        if spectrum:
+            all_counts, sample_size, spectra = pbwt_window_counts(hapsites, all_bounds, return_counts=True)
+        else:
+            all_counts, sample_size = pbwt_window_counts(hapsites, all_bounds)
+            spectra = [None] * len(all_bounds)
+        window_counts = [(int(num_haps), sample_size, hap_counts) for num_haps, hap_counts in zip(all_counts, spectra)]
+        offsets = np.cumsum([0] + [len(config_bounds) for config_bounds in windows])
+        counts = [window_counts[offsets[c]:offsets[c + 1]] for c in range(len(windowing))]
+
+    for c, (SNPwindow_size, SNPwindow_step) in enumerate(windowing):
+
+        #open files and write header line
+        outfile = f"{chrom}_SNPwindow{SNPwindow_size}_SNPstep{SNPwindow_step}{manifest_tag(manifest)}_hap_counts.{outformat}"
+        ckpt = None if checkpoint is None else open_checkpoint(outfile, checkpoint)
+        with open_window_table(outfile, _columns(approx, hapgroups, spectrum), outformat, sep="\t", mode="a" if ckpt is None else ckpt.mode()) as outbed:
+            if ckpt is not None:
+                ckpt.start(outbed.outfile)
+
+            #loop through windows
+            _write_windows(chrom, hapsites, windows[c], outbed, _hap_counter(incremental, verify, pbwt, approx, sketch), counts[c], hapgroups, ckpt, window_threads, spectrum)
+
+        if ckpt is not None:
+            ckpt.finish()
+
+
+
+
+def _resume_hap_counter(vcfgz, windowing, checkpoint, decompress_threads=1, manifest=None, incremental=True, verify=False, pbwt=False, spectrum=False, approx=None, sketch="kmv",
+                        groups=None, group_column=2, window_threads=1):
+    """
+    Continues the bedfiles of an interrupted checkpointed SNPwindow_hap_counter scan. The window configurations are resumed together as a group
+    of shards each spanning all of the windows of its configuration (see run_hapcount_shard), which seeks to the earliest window after
+    the checkpoints with the tabix index and serves every configuration from one pass over the remaining sites.
+    """
+
+    positions = load_positions(vcfgz, decompress_threads)
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+
+    shards = []
+    for SNPwindow_size, SNPwindow_step in windowing:
+        outfile = f"{chrom}_SNPwindow{SNPwindow_size}_SNPstep{SNPwindow_step}{manifest_tag(manifest)}_hap_counts.bed"
+        num_windows = len(snp_window_bounds(len(positions), SNPwindow_size, SNPwindow_step))
+        shards.append(ShardLoader(vcfgz, SNPwindow_size, SNPwindow_step, 0, num_windows, outfile, decompress_threads, manifest, "bed", window_threads))
+
+    run_hapcount_shard(ShardGroup(shards), incremental, verify, pbwt, spectrum, approx, sketch, groups, group_column, checkpoint, resume=True, header=True)
+
+
+
+
+def _write_windows(chrom, hapsites, bounds, outbed, counter=None, counts=None, hapgroups=None, checkpoint=None, window_threads=1, spectrum=False):
+    """
+    Counts haplotypes in each window of a list of SNP windows and writes the bed rows.
+    Used by the vcf scan and the haplotype matrix scan, see _write_config_windows for the parameters.
+    """
+
+    _write_config_windows(chrom, hapsites, [bounds], [outbed], [counter], None if counts is None else [counts], hapgroups, [checkpoint], window_threads, spectrum)
+
+
+
+
+def _write_config_windows(chrom, hapsites, config_bounds, outbeds, counters, counts=None, hapgroups=None, checkpoints=None, window_threads=1, spectrum=False):
+    """
+    Counts haplotypes in the windows of one or more window configurations and writes the bed rows of each configuration to its own output.
+    The windows are sliced in order of their first site (see _sliced_windows), so the shards of the parallel scan serve every configuration
+    from one pass over their sites, and the counter of each configuration gets its windows in order.
+
+    :param chrom: chromosome name for the output
+    :type chrom: str
+    :param hapsites: sites to slice the windows from, by site index on the chromosome
+    :type hapsites: WindowBuffer or HapMatrix or ShardSites or SampleView
+    :param config_bounds: [first_site, last_site) index pairs of the windows to scan, in order, for each configuration
+    :type config_bounds: list of list of (int, int)
+    :param outbeds: open output table of each configuration
+    :type outbeds: list of TextTableWriter or WindowTableWriter
+    :param counters: incremental haplotype counter of each configuration, None sorts every window with _count_unique_haps.
+        A SketchHapCounter also writes the relative standard error of its estimates
+    :type counters: list of RollingHapCounter or PBWT or SketchHapCounter or None
+    :param counts: (number of unique haplotypes, sample size, copies of each distinct haplotype or None without spectrum) of each window
+        of each configuration if they were already counted, the windows are then not sliced
+    :type counts: list of list of (int, int, np.ndarray or None), optional
+    :param hapgroups: group of each haplotype to also write the counts of each group, defaults to no group counts
+    :type hapgroups: HapGroups, optional
+    :param checkpoints: checkpoint of the text output of each configuration, counts the written windows, defaults to no checkpoints
+    :type checkpoints: list of ScanCheckpoint or None, optional
+    :param window_threads: number of threads sorting the windows when there are no counters, defaults to 1
+    :type window_threads: int, optional
+    :param spectrum: also write the haplotype frequency spectrum statistics, from the copies of each distinct haplotype found by the same
+        grouping that counts the unique haplotypes (see haplotype_matrix/hap_spectrum.py), defaults to False
+    :type spectrum: bool, optional
+    """
+
+    if checkpoints is None:
+        checkpoints = [None] * len(config_bounds)
+
+    windows = _sliced_windows(hapsites, config_bounds, counts is None)
+
+    #sorting a window does not depend on the previous windows, so the windows are sorted on the window threads (see haplotype_matrix/window_pool.py)
+    #while the incremental counters update their state window after window in order
+    threaded = counts is None and all([counter is None for counter in counters])
+    if threaded:
+        if hapgroups is not None:
+            kernel = hap_class_ids
+        elif spectrum:
+            kernel = unique_hap_counts
+        else:
+            kernel = _count_unique_haps
+        windows = ordered_window_map(kernel, ((key, (hap_m,)) for key, hap_m in windows), window_threads)
+
+    for (c, i, lo, hi, start_pos, end_pos), hap_m in windows:
+        counter = counters[c]
+
+        #count haps, with the copies of each distinct haplotype for the spectrum
+        hap_counts = None
+        if counts is not None:
+            num_haps, sample_size, hap_counts = counts[c][i]
+        elif hapgroups is not None:
+            #distinct haplotype id of each haplotype for the group counts, already found on the window threads without a counter
+            hap_ids = hap_m if threaded else counter.count(hap_m, lo, hi, return_ids=True)[-1]
+            num_haps, sample_size = int(hap_ids.max()) + 1, len(hap_ids)
+            if spectrum:
+                hap_counts = np.bincount(hap_ids)
+        elif threaded and spectrum:
+            #copies counted on the window threads
+            hap_counts = hap_m
+            num_haps, sample_size = len(hap_counts), int(hap_counts.sum())
+        elif threaded:
+            #counted on the window threads
+            num_haps, sample_size = hap_m
+        elif spectrum:
+            num_haps, sample_size, hap_counts = counter.count(hap_m, lo, hi, return_counts=True)
+        else:
+            num_haps, sample_size = counter.count(hap_m, lo, hi)
+        #compute SNP density
+        snpden = (hi - lo) / (end_pos - start_pos)
+
+        #write to file
+        row = [chrom, start_pos, end_pos, snpden, num_haps, sample_size]
+        if spectrum:
+            row += spectrum_stats(hap_counts)
+        if isinstance(counter, SketchHapCounter):
+            row.append(counter.error)
+        if hapgroups is not None:
+            row += hapgroups.count(hap_ids)
+        outbeds[c].write_row(row)
+        if checkpoints[c] is not None:
+            checkpoints[c].window_done(outbeds[c].outfile, lo, start_pos)
 
 
 
@@ -229,11 +538,71 @@ def run_hapcount_scan(argloader_obj):
     Main Function that runs SNPwindow_hap_counter with a single argument of the class ArgLoader
     """
 
-    SNPwindow_hap_counter(argloader_obj.vcf, argloader_obj.winsize, argloader_obj.winstep)
+    SNPwindow_hap_counter(argloader_obj.vcf, argloader_obj.windowing, argloader_obj.threads, argloader_obj.manifest, argloader_obj.outformat,
+                          argloader_obj.incremental, argloader_obj.verify, argloader_obj.pbwt, argloader_obj.spectrum, argloader_obj.approx, argloader_obj.sketch,
+                          argloader_obj.groups, argloader_obj.group_column, argloader_obj.checkpoint, argloader_obj.resume, argloader_obj.window_threads)
+
+
+
+def run_hapcount_shard(shard, incremental=True, verify=False, pbwt=False, spectrum=False, approx=None, sketch="kmv", groups=None, group_column=2,
+                       checkpoint=None, resume=False, header=False):
+    """
+    Main Function that runs one shard of a SNP window scan with a single argument of the class ShardLoader, or the shards of every window
+    configuration covering the same sites with a ShardGroup (see haplotype_matrix/shards.py). The sites of the group are read once and the windows
+    of each configuration are written without a header to the output of its shard, which are stitched together in main.
+    The windows of each configuration are counted with a RollingHapCounter unless incremental is False, or with a PBWT if pbwt is True,
+    or estimated with a SketchHapCounter if approx is given. spectrum also writes the haplotype frequency spectrum statistics, which need exact counts.
+    With a panel file in groups the counts of each group are also written. With checkpoint each shard output is checkpointed every `checkpoint` windows, and resume continues it from its checkpoint
+    (see haplotype_matrix/checkpoint.py) or skips it if it is finished. header writes the header lines, for a whole scan resumed as one group.
+    """
+
+    if spectrum and approx is not None:
+        exit("The haplotype frequency spectrum needs exact counts, approx has to be None")
+
+    shards = shard.shards if isinstance(shard, ShardGroup) else [shard]
+    positions = load_positions(shard.vcf)
+
+    #windows of each shard, left after the checkpoint of its output
+    todo, config_bounds, ckpts = [], [], []
+    for config_shard in shards:
+        bounds = snp_window_bounds(len(positions), config_shard.winsize, config_shard.winstep)[config_shard.first_window:config_shard.last_window]
+        ckpt = None
+        if checkpoint is not None:
+            if config_shard.outformat == "npz":
+                exit("Checkpoints need text outputs, outformat has to be bed")
+            ckpt = open_checkpoint(config_shard.outfile, checkpoint, resume)
+            if ckpt is None:
+                continue
+            bounds = ckpt.check(bounds, positions)
+        todo.append(config_shard)
+        config_bounds.append(bounds)
+        ckpts.append(ckpt)
+
+    chrom = shard.vcf.split("_")[-1].replace(".vcf.gz", "")
+    hapgroups = _hap_groups(shard.vcf, groups, group_column, shard.manifest)
+    with ExitStack() as outfiles:
+
+        outbeds = []
+        for config_shard, ckpt in zip(todo, ckpts):
+            outbeds.append(outfiles.enter_context(open_window_table(config_shard.outfile, _columns(approx, hapgroups, spectrum), config_shard.outformat, sep="\t",
+                                                                    header=header and (ckpt is None or not ckpt.resumed), mode="w" if ckpt is None else ckpt.mode())))
+            if ckpt is not None:
+                ckpt.start(outbeds[-1].outfile)
+
+        windowed = [bounds for bounds in config_bounds if len(bounds) > 0]
+        if len(windowed) > 0:
+            #sites from the first to the last window of the shards
+            hapsites = shard_sites(shard, positions, min([bounds[0][0] for bounds in windowed]), max([bounds[-1][1] for bounds in windowed]))
+            _write_config_windows(chrom, hapsites, config_bounds, outbeds, [_hap_counter(incremental, verify, pbwt, approx, sketch) for config_shard in todo],
+                                  hapgroups=hapgroups, checkpoints=ckpts, window_threads=shard.window_threads, spectrum=spectrum)
+
+    for ckpt in ckpts:
+        if ckpt is not None:
+            ckpt.finish()
 
 
 
-# args = ArgLoader("test1.vcf.gz", 100, 10)
+# args = ArgLoader("test1.vcf.gz", [(100, 10)])
 # run_hapcount_scan(args)
 
 
@@ -270,19 +639,88 @@ def main():
         "beagle_imputed_males_biallelic_SNPs_1000GP30X_chrY.vcf.gz"
         ]
     
-    loaderlist = []
-
-    for vcffile in vcflist:
-        loaderlist.append(ArgLoader(vcffile, 1000, 100))
+    windowing = [(1000, 100), (10000, 1000)]
+    processes = 25
+    #sample manifest of a subset to scan e.g. a superpopulation panel file, None scans all samples
+    manifest = None
+    #"npz" writes columnar window tables that the downstream scripts load without parsing text (see haplotype_matrix/window_table.py)
+    outformat = "bed"
+    #haplotypes are counted with rolling hashes, verify compares the haplotypes sharing a hash (see haplotype_matrix/hap_hash.py)
+    incremental = True
+    verify = False
+    #the PBWT counts the windows of a shard from one sweep over its sites instead (see haplotype_matrix/pbwt.py)
+    pbwt = False
+    #haplotype diversity, entropy, Garud's H statistics and the haplotype frequency spectrum of each window, from the same grouping (see haplotype_matrix/hap_spectrum.py)
+    spectrum = False
+    #relative error of approximate counts from fixed size sketches of the rolling hashes for very large cohorts, None counts exactly (see haplotype_matrix/hap_sketch.py)
+    approx = None
+    sketch = "kmv"
+    #panel file to also count the haplotypes of each superpopulation in the same pass e.g. "integrated_call_samples_v3.20130502.ALL.panel", None skips the group counts
+    groups = None
+    group_column = 2
+    #number of windows between checkpoints of the shard outputs, resume continues the shards of an interrupted checkpointed run (see haplotype_matrix/checkpoint.py)
+    checkpoint = None
+    resume = False
+    #RAM the running shards may use together, shards are started longest first while their estimated memory fits (see haplotype_matrix/scheduler.py)
+    ram_budget = 64 * 2 ** 30
+    #tab separated log of the peak RSS and runtime of each shard, None only prints them
+    job_log = None
+    #threads sorting the windows of each shard when incremental is False, so that the cores stay busy once only a few long shards are left (see haplotype_matrix/window_pool.py)
+    window_threads = 1
+
+    if spectrum and approx is not None:
+        exit("The haplotype frequency spectrum needs exact counts, approx has to be None")
+    if groups is not None and approx is not None:
+        exit("The group counts need exact counts, approx has to be None")
+
+    pool = Pool(processes=processes)
+
+    #positions of each chromosome, read once and cached next to the vcfs
+    positions = dict(zip(vcflist, pool.map(load_positions, vcflist)))
+    pool.close()
+
+    #chromosomes are split into shards of about the same number of SNPs, a few per process so that they balance out
+    shard_snps = sum([len(p) for p in positions.values()]) // (4 * processes)
+
+    scans = {}
+    jobs, estimates = [], []
     for vcffile in vcflist:
-        loaderlist.append(ArgLoader(vcffile, 10000, 1000))
-
-    # print(len(loaderlist))
-    # for l in loaderlist:
-    #     print(l)
-
-    pool = Pool(processes=25)
-    pool.map(run_hapcount_scan, loaderlist)
+        chrom = vcffile.split("_")[-1].replace(".vcf.gz", "")
+        outfiles = [f"{chrom}_SNPwindow{size}_SNPstep{step}{manifest_tag(manifest)}_hap_counts.{outformat}" for size, step in windowing]
+        bounds = [np.array(snp_window_bounds(len(positions[vcffile]), size, step), dtype=np.int64).reshape(-1, 2) for size, step in windowing]
+
+        #the shards of every window configuration are cut at the same sites, so that each job reads its sites once for all of the configurations
+        config_shards = scan_config_shards(vcffile, windowing, [b[:, 0] for b in bounds], [b[:, 1] for b in bounds], shard_snps, outfiles,
+                                           manifest=manifest, outformat=outformat, window_threads=window_threads)
+        configs = []
+        for c, outfile in enumerate(outfiles):
+            #scans already stitched by the interrupted run
+            if resume and os.path.exists(outfile) and not any([os.path.exists(shard.outfile) for shard in config_shards[c]]):
+                continue
+            scans[outfile] = (vcffile, config_shards[c])
+            configs.append(c)
+        if len(configs) == 0:
+            continue
+
+        #estimated memory and runtime of each group of shards
+        num_haps = 2 * len(vcf_samples(vcffile) if manifest is None else read_sample_manifest(manifest))
+        for group in zip(*[config_shards[c] for c in configs]):
+            jobs.append(ShardGroup(list(group)))
+            estimates.append(combine_estimates([estimate_job("hapcount", num_haps, bounds[c][shard.first_window:shard.last_window, 0], bounds[c][shard.first_window:shard.last_window, 1])
+                                                for c, shard in zip(configs, group)]))
+
+    #stitch the shard outputs of each scan in window order as soon as its last shard is done, checkpointed runs write the scan outputs from scratch
+    remaining = {outfile: len(shards) for outfile, (vcffile, shards) in scans.items()}
+    scan_of = {shard.outfile: outfile for outfile, (vcffile, shards) in scans.items() for shard in shards}
+    run_shard = partial(run_hapcount_shard, incremental=incremental, verify=verify, pbwt=pbwt, spectrum=spectrum, approx=approx, sketch=sketch, groups=groups, group_column=group_column,
+                        checkpoint=checkpoint, resume=resume)
+    for group, result in run_scheduled(run_shard, jobs, estimates, processes, ram_budget, job_log):
+        for shard in group.shards:
+            outfile = scan_of[shard.outfile]
+            remaining[outfile] -= 1
+            if remaining[outfile] == 0:
+                vcffile, shards = scans[outfile]
+                stitch_shards(shards, outfile, "\t".join(_columns(approx, _hap_groups(vcffile, groups, group_column, manifest), spectrum)) + "\n", mode="a" if checkpoint is None else "w")
 
 
 if __name__ == '__main__':
@@ -1,60 +1,36 @@
-import gzip
+import os
+import sys
 import pandas as pd
 import numpy as np
-from collections import deque
+from contextlib import ExitStack
 from multiprocessing import Pool
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from hapmatrix import HapMatrix, hapmatrix_exists, bp_window_bounds, load_positions, vcf_samples
+from gt_parser import parse_record
+from bgzf_reader import bgzf_open
+from window_buffer import WindowBuffer
+from shards import ShardSites
+from window_table import open_window_table
+from pbwt import PBWT, pbwt_window_counts
+from hap_spectrum import unique_hap_counts, spectrum_columns, spectrum_stats
+from scheduler import estimate_job, combine_estimates, run_scheduled
 
 
 ### HELPER FUNCTIONS ###
 
-def _joinany(sep, mylist):
-    """Function to join a list by a sep regardless of element types"""
+def _outfile(chrom, window_size, window_step, outformat="csv"):
+    """Helper gives the output file name of a window configuration"""
 
-    strs = [str(x) for x in mylist]
+    return f"{chrom}_BPwindow{window_size}_BPstep{window_step}_hap_counts.{outformat}"
 
-    return sep.join(strs)
 
 
+def _check_outputs(outfiles):
+    """Helper exits if an output of an earlier scan exists, the scans append to their outputs so it would get a second header and its windows twice"""
 
-def _pop_bp_step(d, step):
-    """
-    Helper function used to pop a number of elements from the left
-    of a deque equal to the step size in. This is done in place.
-    """
-
-    #count how many elements to pop
-    count_ele_to_pop = 0
-    for idx in range(len(d)):
-        if d[idx].position <= step:
-            count_ele_to_pop += 1
-        else:
-            break
-    
-    #pop from left
-    for i in range(count_ele_to_pop):
-        d.popleft()
-
-
-def _construct_matrix(d):
-    """
-    Helper function takes in the window deque and constructs the haplo matrix
-
-    d (deque of RecordLoader objects): window deque
-
-    Returns list of lists: each sublist is a site and each sublist element is the haplotype at that site
-    """
-
-    matrix = []
-    for record in d:
-        hap_ls = []
-        for gt in record.GTs:
-            haps = gt.split("|")
-            for h in haps:
-                hap_ls.append(int(h))
-        matrix.append(hap_ls)
-
-
-    return matrix
+    for outfile in outfiles:
+        if os.path.exists(outfile):
+            exit(f"{outfile} already exists, remove it to rerun the scan")
 
 
 
@@ -62,26 +38,28 @@ def _count_unique_haps(haplo_matrix):
     """
     Helper counts unique haplotypes and sample size of a given window.
     
-    :param haplo_matrix: each sublist is a site and each sublist element is the haplotype at that site
-    :type haplo_matrix: list of lists
+    :param haplo_matrix: each row is a site and each column is the haplotype at that site
+    :type haplo_matrix: np.ndarray
 
     :returns: number of unique haplotypes and total number of haplotypes (sample size) in the haplo_matrix
     :rtype: int, int
     """
 
 
-    #converting matrix to array and transposing
-    matrix = np.array(haplo_matrix)
-    matrix = np.transpose(matrix)
+    #packing the alleles of each haplotype into bytes, one row per haplotype
+    packed = np.packbits(np.asarray(haplo_matrix, dtype=np.uint8).T, axis=1)
 
     #counting sample size
-    num_samples = len(matrix)
+    num_samples = len(packed)
+    if packed.shape[1] == 0:
+        return min(num_samples, 1), num_samples
 
-    #uniquify
-    uniq_matrix = np.unique(matrix, axis=0)
+    #uniquify, each packed row is viewed as a single bytes scalar so rows are compared with memcmp
+    rows = np.ascontiguousarray(packed).view(np.dtype((np.void, packed.shape[1])))
+    uniq_rows = np.unique(rows)
 
     #counting unique haplotypes
-    num_uniq_haps = len(uniq_matrix)
+    num_uniq_haps = len(uniq_rows)
 
 
     return num_uniq_haps, num_samples
@@ -90,124 +68,270 @@ def _count_unique_haps(haplo_matrix):
 
 ### CLASSES ###
 
-class RecordLoader():
-    def __init__(self, vcfline):
-        """
-        This class is for parsing a vcf record for it to be added to a deque.
-        The class as two attributes:
-        position (int): record position
-        GTs (list of str): list of individual genotypes e.g. ["0|0", "1|0"...]
-        """
-
-        self.position = int(vcfline.strip().split("\t")[1])
-        self.GTs = vcfline.strip().split("\t")[9:]
-
-
 class ArgLoader():
-    def __init__(self, vcfgz_file, windowsize, windowstep):
+    def __init__(self, vcfgz_file, windowing, decompress_threads=1, index_positions=False, outformat="csv", pbwt=False, spectrum=False):
         """
         Class used to store arguments for the windowed_UPGMA_scan function which is run using the run_hapcount_scan main function.
         This is done so that the main function takes a single argument so that it can be run in parallel.
 
         vcfgz_file (str): filename or path to file for the vcf to scan
-        windowsize (int): SNP window size
-        windowstep (int): SNP window step, recommended to be 10% of windowsize
+        windowing (list of (int, int)): (bp window size, bp window step) of each window configuration
+        decompress_threads (int): number of threads inflating the vcf, default is 1
+        index_positions (bool): find the window bounds from the sorted site positions first, default is False
+        outformat (str): "csv" for text csvs or "npz" for columnar window tables, default is "csv"
+        pbwt (bool): count haplotypes with the PBWT, default is False
+        spectrum (bool): also write the haplotype frequency spectrum statistics, default is False
         """
 
         self.vcf = vcfgz_file
-        self.winsize = windowsize
-        self.winstep = windowstep
+        self.windowing = windowing
+        self.threads = decompress_threads
+        self.index_positions = index_positions
+        self.outformat = outformat
+        self.pbwt = pbwt
+        self.spectrum = spectrum
+
+    def outfiles(self):
+        """Output file name of each window configuration"""
+
+        chrom = self.vcf.split("_")[-1].replace(".vcf.gz", "")
+
+        return [_outfile(chrom, size, step, self.outformat) for size, step in self.windowing]
 
     def __str__(self):
-        return self.vcf + "\t" + str(self.winsize) + "\t" + str(self.winstep)
+        return self.vcf + "\t" + str(self.windowing)
+
+
+
+class WindowConfig():
+    def __init__(self, window_size, window_step, outcsv):
+        """
+        Class used to hold the window book keeping of one window configuration while the vcf is scanned,
+        so that several configurations can slide over the same window buffer.
+
+        window_size (int): number of bps defining the window size
+        window_step (int): number of bps to slide window
+        outcsv (TextTableWriter or WindowTableWriter): open output table of the configuration
+        """
+
+        self.size = window_size
+        self.step = window_step
+        self.outcsv = outcsv
+
+        #window book keeping
+        self.win_start = 1
+        self.win_end = window_size
+        self.win_step = window_step
+
+        #site index of the first site of the window
+        self.lo = 0
 
 
 
 
 ### SLIDING WINDOW SCAN FUNCTION ###
 
-def BPwindow_hap_counter(vcfgz, window_size, window_step):
+def BPwindow_hap_counter(vcfgz, windowing, decompress_threads=1, index_positions=False, outformat="csv", pbwt=False, spectrum=False):
     """
     Function counts unique haplotypes in sliding windows on a gizped vcf. See other functions for details.
+    Every window configuration is served from the same pass over the vcf and written to its own csv.
     
     vcfgz (str): gziped vcf file name or path to file.
-    SNPwindow_size (int): number of SNPs defining the window size.
-    SNPwindow_step (int): number of SNPs to slide window, recommended to be 10% of SNPwindow_size.
+    windowing (list of (int, int)): (bp window size, bp window step) of each window configuration.
+    decompress_threads (int): number of threads inflating the BGZF blocks of the vcf (see haplotype_matrix/bgzf_reader.py), default is 1.
+    index_positions (bool): load (or cache) the sorted site positions first and find the site bounds of every window with np.searchsorted,
+        so that runs of empty windows are written in one block and haplotypes are only counted in non-empty windows, default is False.
+    outformat (str): "csv" appends to text csvs, "npz" writes columnar window tables (see haplotype_matrix/window_table.py), default is "csv".
+    pbwt (bool): count haplotypes with a PBWT (see haplotype_matrix/pbwt.py) fed every site of the chromosome once, the windows of every
+        configuration are counted from its divergence array instead of sorting every window, default is False.
+    spectrum (bool): also write the haplotype diversity, entropy, H1, H12, H2/H1, top haplotype frequencies and the run-length encoded
+        haplotype frequency spectrum of each window (see haplotype_matrix/hap_spectrum.py), taken from the same grouping that counts
+        the unique haplotypes, default is False.
     """
 
-    #setting up deque for sliding window
-    window_deque = deque()
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    _check_outputs([_outfile(chrom, size, step, outformat) for size, step in windowing])
+
+    #read from the bit-packed haplotype matrix if it was built for this vcf
+    if hapmatrix_exists(vcfgz):
+        hapmat = HapMatrix(vcfgz)
+        _indexed_hap_counter(vcfgz, windowing, hapmat, hapmat.positions, outformat, pbwt, spectrum)
+        return
+
+    #stream the sites of the vcf into the windows found from the positions index (see load_positions in haplotype_matrix/hapmatrix.py)
+    if index_positions:
+        positions = load_positions(vcfgz, decompress_threads)
+        hapsites = ShardSites(vcfgz, positions, 0, len(positions), decompress_threads) if len(positions) > 0 else None
+        _indexed_hap_counter(vcfgz, windowing, hapsites, positions, outformat, pbwt, spectrum)
+        return
+
+    #setting up the array-backed sliding window shared by the window configurations (see haplotype_matrix/window_buffer.py)
+    window = WindowBuffer()
+    #PBWT fed every site, shared by the window configurations
+    sweep = PBWT() if pbwt else None
 
     #open files
-    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
-    with gzip.open(vcfgz, "rt") as vcf, open(f"{chrom}_BPwindow{window_size}_BPstep{window_step}_hap_counts.csv", "a") as outcsv:
+    with bgzf_open(vcfgz, "rb", threads=decompress_threads) as vcf, ExitStack() as outfiles:
 
-        #write header line
-        outcsv.write(",".join(["#CHROM", "START", "END", "SNP_density", "hapcount", "prop_unique", "sample_size"]) + "\n")
-
-        #window book keeping
-        win_start = 1
-        win_end = window_size
-        win_step = window_step
+        #open a csv per window configuration and write header lines
+        configs = []
+        for window_size, window_step in windowing:
+            outcsv = outfiles.enter_context(open_window_table(_outfile(chrom, window_size, window_step, outformat), ["#CHROM", "START", "END", "SNP_density", "hapcount", "prop_unique", "sample_size"] + (spectrum_columns() if spectrum else []), outformat))
+            configs.append(WindowConfig(window_size, window_step, outcsv))
 
         #loop through lines
         for line in vcf:
             #skip header lines
-            if line.startswith("#"):
+            if line.startswith(b"#"):
                 continue
 
             ###sliding window scan###
 
-            #holding on  current record
-            current_record = RecordLoader(line)
+            #parse current record
+            position, haps = parse_record(line)
+            num_sites = window.num_appended()
 
-            if current_record.position < win_start:
-                 exit("Record position before window start position")
-            
-            if current_record.position <= win_end:
-                window_deque.append(current_record)
-                continue
+            for config in configs:
+
+                if position < config.win_start:
+                     exit("Record position before window start position")
 
+                #increment window until position is reached
+                for i in range(config.win_end, position, config.step):
+
+                    #count haps and write to file
+                    _write_window(chrom, window, config.win_start, config.win_end, config.lo, num_sites, config.size, config.outcsv, sweep, spectrum=spectrum)
 
-            #increment window until position is reached
-            for i in range(win_end, current_record.position, window_step):
-
-                if len(window_deque) == 0:
-                    #write to file
-                    outcsv.write(_joinany(",", [chrom, win_start, win_end, 0, 0]) + "\n")
-                else:
-                    #construct haplo matrix
-                    hap_m = _construct_matrix(window_deque)
-                    #count haps
-                    num_haps, sample_size = _count_unique_haps(hap_m)
-                    proportion_haps = num_haps / sample_size
-                    #compute SNP density
-                    snpden = len(window_deque) / window_size
                     #sliding to next step
-                    _pop_bp_step(window_deque, win_step)
-                    #write to file
-                    outcsv.write(_joinany(",", [chrom, win_start, win_end, snpden, num_haps, proportion_haps, sample_size]) + "\n")
+                    config.lo += int(np.searchsorted(window.site_positions(config.lo, num_sites), config.win_step, side="right"))
+
+                    #increment window
+                    config.win_end = i + config.step
+                    config.win_start = config.win_end - config.size + 1
+                    config.win_step = config.win_start + config.step
+
+            #append current record to window and drop the sites before the window of every configuration
+            window.append(position, haps)
+            if sweep is not None:
+                sweep.update(haps[np.newaxis])
+            window.pop(min([config.lo for config in configs]) - window.first)
+
+        #clean up last window of each configuration
+        num_sites = window.num_appended()
+        for config in configs:
+            if config.lo < num_sites:
+                _write_window(chrom, window, config.win_start, config.win_end, config.lo, num_sites, config.win_end - config.win_start, config.outcsv, sweep, spectrum=spectrum)
+
+
 
-                #increment window
-                win_end = i + window_step
-                win_start = win_end - window_size + 1
-                win_step = win_start + window_step
 
-            #append current record to deque
-            window_deque.append(current_record)
+def _indexed_hap_counter(vcfgz, windowing, hapsites, positions, outformat="csv", pbwt=False, spectrum=False):
+    """
+    Runs the same scan as BPwindow_hap_counter with the window bounds of every configuration found at once from
+    the sorted site positions (see bp_window_bounds in haplotype_matrix/hapmatrix.py). Runs of empty windows are
+    written in one block and haplotypes are only counted in the non-empty windows. The non-empty windows of all
+    configurations are visited in order of their first site, so the sites can be streamed once from the vcf.
+
+    vcfgz (str): gziped vcf file name or path to file.
+    windowing (list of (int, int)): (bp window size, bp window step) of each window configuration.
+    hapsites (HapMatrix or ShardSites): sites to slice the windows from, by site index on the chromosome
+    positions (np.ndarray): sorted positions of all sites of the chromosome
+    outformat (str): "csv" or "npz", default is "csv"
+    pbwt (bool): count the non-empty windows of all configurations from one PBWT sweep, default is False
+    spectrum (bool): also write the haplotype frequency spectrum statistics, default is False
+    """
+
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+
+    #open files
+    with ExitStack() as outfiles:
 
-        #clean up last window
-        if len(window_deque) > 0:
-            
-            #construct haplo matrix
-            hap_m = _construct_matrix(window_deque)
-            #count haps
-            num_haps, sample_size = _count_unique_haps(hap_m)
-            proportion_haps = num_haps / sample_size
-            #compute SNP density
-            snpden = len(window_deque) / (win_end - win_start)
-            #write to file
-            outcsv.write(_joinany(",", [chrom, win_start, win_end, snpden, num_haps, proportion_haps, sample_size]) + "\n")
+        #open a csv per window configuration, write header lines and find window bounds
+        outcsvs, bounds, nonempty = [], [], []
+        for window_size, window_step in windowing:
+            outcsvs.append(outfiles.enter_context(open_window_table(_outfile(chrom, window_size, window_step, outformat), ["#CHROM", "START", "END", "SNP_density", "hapcount", "prop_unique", "sample_size"] + (spectrum_columns() if spectrum else []), outformat)))
+            bounds.append(bp_window_bounds(positions, window_size, window_step))
+            nonempty.append(np.flatnonzero(bounds[-1][2] < bounds[-1][3]))
+
+        #non-empty windows of every configuration in order of their first site
+        configs = np.concatenate([np.full(len(idxs), c, dtype=np.int64) for c, idxs in enumerate(nonempty)])
+        idxs = np.concatenate(nonempty)
+        order = np.argsort(np.concatenate([bounds[c][2][nonempty[c]] for c in range(len(windowing))]), kind="stable")
+
+        #index of the next window to write of each configuration
+        next_idx = [0] * len(windowing)
+
+        #count the non-empty windows of all configurations from one PBWT sweep (see haplotype_matrix/pbwt.py)
+        counts = None
+        if pbwt:
+            all_counts, sample_size, spectra = pbwt_window_counts(hapsites, np.stack([np.concatenate([bounds[c][2][idxs] for c, idxs in enumerate(nonempty)]),
+                                                                                      np.concatenate([bounds[c][3][idxs] for c, idxs in enumerate(nonempty)])], axis=1), return_counts=True)
+            counts = [(int(all_counts[w]), sample_size, spectra[w]) for w in order]
+
+        for w, (c, idx) in enumerate(zip(configs[order], idxs[order])):
+            win_starts, win_ends, los, his = bounds[c]
+
+            #write the empty windows before this one in one block
+            outcsvs[c].write_block(chrom, win_starts[next_idx[c]:idx], win_ends[next_idx[c]:idx], [0, 0])
+
+            #the last window is normalized like the clean up window of the vcf scan
+            win_start, win_end = int(win_starts[idx]), int(win_ends[idx])
+            norm = win_end - win_start if idx == len(win_starts) - 1 else windowing[c][0]
+            _write_window(chrom, hapsites, win_start, win_end, int(los[idx]), int(his[idx]), norm, outcsvs[c], counts=None if counts is None else counts[w], spectrum=spectrum)
+            next_idx[c] = idx + 1
+
+        #empty windows after the last non-empty window
+        for c in range(len(windowing)):
+            win_starts, win_ends = bounds[c][0], bounds[c][1]
+            outcsvs[c].write_block(chrom, win_starts[next_idx[c]:], win_ends[next_idx[c]:], [0, 0])
+
+
+
+
+def _write_window(chrom, hapsites, win_start, win_end, lo, hi, norm, outcsv, counter=None, counts=None, spectrum=False):
+    """
+    Counts haplotypes in a bp window and writes the csv row. Used by both the vcf scan and the indexed scan.
+
+    chrom (str): chromosome name for the output
+    hapsites (WindowBuffer or HapMatrix or ShardSites): sites to slice the window from, by site index on the chromosome
+    win_start (int): window start position
+    win_end (int): window end position
+    lo (int): index of the first site of the window
+    hi (int): index after the last site of the window
+    norm (int): number of bps the SNP density is normalized by
+    outcsv (TextTableWriter or WindowTableWriter): open output table
+    counter (PBWT or None): PBWT fed the sites up to hi, default is sorting the window with _count_unique_haps
+    counts ((int, int, np.ndarray) or None): number of unique haplotypes, sample size and copies of each distinct haplotype if the window
+        was already counted, it is then not sliced
+    spectrum (bool): also write the haplotype frequency spectrum statistics, default is False
+    """
+
+    if lo == hi:
+        #write to file
+        outcsv.write_row([chrom, win_start, win_end, 0, 0])
+        return
+
+    #count haps, with the copies of each distinct haplotype for the spectrum
+    hap_counts = None
+    if counts is not None:
+        num_haps, sample_size, hap_counts = counts
+    elif counter is not None:
+        num_haps, sample_size = counter.num_distinct(lo), len(counter.prefix)
+        if spectrum:
+            hap_counts = counter.group_sizes(lo)
+    elif spectrum:
+        #slice haplo matrix
+        hap_counts = unique_hap_counts(hapsites.sites(lo, hi))
+        num_haps, sample_size = len(hap_counts), int(hap_counts.sum())
+    else:
+        #slice haplo matrix
+        hap_m = hapsites.sites(lo, hi)
+        num_haps, sample_size = _count_unique_haps(hap_m)
+    proportion_haps = num_haps / sample_size
+    #compute SNP density
+    snpden = (hi - lo) / norm
+    #write to file
+    outcsv.write_row([chrom, win_start, win_end, snpden, num_haps, proportion_haps, sample_size] + (spectrum_stats(hap_counts) if spectrum else []))
 
 
 
@@ -216,11 +340,11 @@ def BPwindow_hap_counter(vcfgz, window_size, window_step):
 def run_hapcount_scan(argloader_obj):
     """Main Function that runs windowed_UPGMA_scan with a single argument of the class ArgLoader"""
 
-    BPwindow_hap_counter(argloader_obj.vcf, argloader_obj.winsize, argloader_obj.winstep)
+    BPwindow_hap_counter(argloader_obj.vcf, argloader_obj.windowing, argloader_obj.threads, argloader_obj.index_positions, argloader_obj.outformat, argloader_obj.pbwt, argloader_obj.spectrum)
 
 
 
-# args = ArgLoader("test1.vcf.gz", 100, 10)
+# args = ArgLoader("test1.vcf.gz", [(100, 10)])
 # run_hapcount_scan(args)
 
 
@@ -242,15 +366,35 @@ def main():
     
     loaderlist = []
 
-    loaderlist.append(ArgLoader("beagle_phased_biallelic_SNPs_1000GP30X_chr2.vcf.gz", 10000, 1000))
+    loaderlist.append(ArgLoader("beagle_phased_biallelic_SNPs_1000GP30X_chr2.vcf.gz", [(10000, 1000)], index_positions=True))
 
+    #both window configurations come out of one pass over each vcf, empty windows across gaps are written in blocks
     for vcffile in vcflist:
-        loaderlist.append(ArgLoader(vcffile, 10000, 1000))
-    for vcffile in vcflist:
-        loaderlist.append(ArgLoader(vcffile, 100000, 10000))
-
-    pool = Pool(processes=19)
-    pool.map(run_hapcount_scan, loaderlist)
+        loaderlist.append(ArgLoader(vcffile, [(10000, 1000), (100000, 10000)], index_positions=True))
+
+    #outputs of an earlier run are refused before any chromosome is scanned
+    _check_outputs([outfile for argloader in loaderlist for outfile in argloader.outfiles()])
+
+    processes = 10
+    #RAM the running chromosomes may use together, chromosomes are started longest first while their estimated memory fits (see haplotype_matrix/scheduler.py)
+    ram_budget = 64 * 2 ** 30
+    #tab separated log of the peak RSS and runtime of each chromosome, None only prints them
+    job_log = None
+
+    #positions of each chromosome, read once and cached next to the vcfs
+    pool = Pool(processes=processes)
+    positions = pool.map(load_positions, [argloader.vcf for argloader in loaderlist])
+    pool.close()
+
+    #estimated memory and runtime of each chromosome, its window configurations share one pass over the vcf
+    estimates = []
+    for argloader, chrom_positions in zip(loaderlist, positions):
+        num_haps = 2 * len(vcf_samples(argloader.vcf))
+        config_bounds = [bp_window_bounds(chrom_positions, size, step) for size, step in argloader.windowing]
+        estimates.append(combine_estimates([estimate_job("hapcount", num_haps, los, his) for win_starts, win_ends, los, his in config_bounds]))
+
+    #chromosomes run longest first within the RAM budget, each one is logged as it finishes
+    list(run_scheduled(run_hapcount_scan, loaderlist, estimates, processes, ram_budget, job_log))
 
 
 if __name__ == '__main__':
@@ -1,8 +1,20 @@
-import gzip
+import os
+import sys
 import pandas as pd
 import numpy as np
-from collections import deque
+from contextlib import ExitStack
 from multiprocessing import Pool
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from hapmatrix import HapMatrix, SampleView, hapmatrix_exists, snp_window_bounds, read_sample_manifest, manifest_tag, vcf_samples, load_positions
+from gt_parser import parse_record
+from bgzf_reader import bgzf_open
+from window_buffer import WindowBuffer
+from hap_hash import RollingHapCounter
+from pbwt import PBWT
+from hap_sketch import SketchHapCounter
+from hap_groups import HapGroups, read_sample_groups, hap_class_ids
+from hap_spectrum import spectrum_columns, spectrum_stats
+from scheduler import estimate_job, combine_estimates, run_scheduled
 
 
 ### HELPER FUNCTIONS ###
@@ -16,171 +28,312 @@ def _joinany(sep, mylist):
 
 
 
-def _pop_step(d, step):
+def _count_unique_haps(haplo_matrix):
     """
-    Helper function used to pop a number of elements from the left
-    of a deque equal to the step size in. This is done in place.
+    Helper counts unique haplotypes in a given window.
+
+    haplo_matrix (np.ndarray): each row is a site and each column is the haplotype at that site
+
+    Returns number of unique haplotypes in the haplo_matrix
     """
 
-    for i in range(step):
-        d.popleft()
+    #packing the alleles of each haplotype into bytes, one row per haplotype
+    packed = np.packbits(np.asarray(haplo_matrix, dtype=np.uint8).T, axis=1)
+    if packed.shape[1] == 0:
+        return min(len(packed), 1)
 
+    #uniquify, each packed row is viewed as a single bytes scalar so rows are compared with memcmp
+    rows = np.ascontiguousarray(packed).view(np.dtype((np.void, packed.shape[1])))
+    uniq_rows = np.unique(rows)
 
-def _construct_matrix(d):
-    """
-    Helper function takes in the window deque and constructs the haplo matrix
+    #counting unique haplotypes
+    num_uniq_haps = len(uniq_rows)
 
-    d (deque of RecordLoader objects): window deque
 
-    Returns list of lists: each sublist is a site and each sublist element is the haplotype at that site
-    """
+    return num_uniq_haps
 
-    matrix = []
-    for record in d:
-        hap_ls = []
-        for gt in record.GTs:
-            haps = gt.split("|")
-            for h in haps:
-                hap_ls.append(int(h))
-        matrix.append(hap_ls)
 
 
-    return matrix
+def _hap_counter(incremental, verify, pbwt, approx=None, sketch="kmv"):
+    """Helper picks the haplotype counter of a window configuration, None sorts every window with _count_unique_haps"""
 
+    if approx is not None:
+        return SketchHapCounter(approx, sketch)
+    elif pbwt:
+        return PBWT()
+    elif incremental:
+        return RollingHapCounter(verify)
 
+    return None
 
-def _count_unique_haps(haplo_matrix):
-    """
-    Helper counts unique haplotypes in a given window.
 
-    haplo_matrix (list of lists): each sublist is a site and each sublist element is the haplotype at that site
 
-    Returns number of unique haplotypes in the haplo_matrix
-    """
+def _outfile(chrom, SNPwindow_size, SNPwindow_step, manifest=None):
+    """Helper gives the output file name of a window configuration"""
 
-    #converting matrix to array and transposing
-    matrix = np.array(haplo_matrix)
-    matrix = np.transpose(matrix)
+    return f"{chrom}_SNPwindow{SNPwindow_size}_SNPstep{SNPwindow_step}{manifest_tag(manifest)}_hap_counts.csv"
 
-    #uniquify
-    uniq_matrix = np.unique(matrix, axis=0)
 
-    #counting unique haplotypes
-    num_uniq_haps = len(uniq_matrix)
 
+def _check_outputs(outfiles):
+    """Helper exits if an output of an earlier scan exists, the scans append to their outputs so it would get a second header and its windows twice"""
 
-    return num_uniq_haps
+    for outfile in outfiles:
+        if os.path.exists(outfile):
+            exit(f"{outfile} already exists, remove it to rerun the scan")
 
 
 
-### CLASSES ###
+def _columns(spectrum=False, approx=None, hapgroups=None):
+    """Helper gives the output columns"""
 
-class RecordLoader():
-    def __init__(self, vcfline):
-        """
-        This class is for parsing a vcf record for it to be added to a deque.
-        The class as two attributes:
-        position (int): record position
-        GTs (list of str): list of individual genotypes e.g. ["0|0", "1|0"...]
-        """
+    columns = ["CHROM", "START", "END", "NUM_uniq_haps", "SNP_density"]
+    if spectrum:
+        columns += spectrum_columns()
+    if approx is not None:
+        columns.append("hapcount_rse")
+    if hapgroups is not None:
+        columns += hapgroups.columns()
+
+    return columns
+
+
+
+def _hap_groups(vcfgz, groups, group_column, manifest):
+    """Helper reads the sample groups of a scan from a panel file, None without a panel file"""
+
+    if groups is None:
+        return None
 
-        self.position = int(vcfline.strip().split("\t")[1])
-        self.GTs = vcfline.strip().split("\t")[9:]
+    return HapGroups(vcf_samples(vcfgz), read_sample_groups(groups, group_column), None if manifest is None else read_sample_manifest(manifest))
 
 
+
+### CLASSES ###
+
 class ArgLoader():
-    def __init__(self, vcfgz_file, windowsize, windowstep):
+    def __init__(self, vcfgz_file, windowing, decompress_threads=1, manifest=None, incremental=True, verify=False, pbwt=False, spectrum=False, approx=None, sketch="kmv",
+                 groups=None, group_column=2):
         """
         Class used to store arguments for the windowed_UPGMA_scan function which is run using the run_hapcount_scan main function.
         This is done so that the main function takes a single argument so that it can be run in parallel.
 
         vcfgz_file (str): filename or path to file for the vcf to scan
-        windowsize (int): SNP window size
-        windowstep (int): SNP window step, recommended to be 10% of windowsize
+        windowing (list of (int, int)): (SNP window size, SNP window step) of each window configuration, step recommended to be 10% of size
+        decompress_threads (int): number of threads inflating the vcf, default is 1
+        manifest (str or None): sample manifest of the samples to scan, default is all samples
+        incremental (bool): count haplotypes with rolling hashes, default is True
+        verify (bool): check the rolling hashes for collisions, default is False
+        pbwt (bool): count haplotypes with the PBWT instead, default is False
+        spectrum (bool): also write the haplotype frequency spectrum statistics, default is False
+        approx (float or None): relative standard error of approximate counts, default is exact counts
+        sketch (str): sketch of the approximate counts, "kmv" or "hll", default is "kmv"
+        groups (str or None): panel file with the group of each sample, default is no group counts
+        group_column (int): column of the group in the panel file, default is 2 (super_pop)
         """
 
         self.vcf = vcfgz_file
-        self.winsize = windowsize
-        self.winstep = windowstep
+        self.windowing = windowing
+        self.threads = decompress_threads
+        self.manifest = manifest
+        self.incremental = incremental
+        self.verify = verify
+        self.pbwt = pbwt
+        self.spectrum = spectrum
+        self.approx = approx
+        self.sketch = sketch
+        self.groups = groups
+        self.group_column = group_column
+
+    def outfiles(self):
+        """Output file name of each window configuration"""
+
+        chrom = self.vcf.split("_")[-1].replace(".vcf.gz", "")
+
+        return [_outfile(chrom, size, step, self.manifest) for size, step in self.windowing]
 
     def __str__(self):
-        return self.vcf + "\t" + str(self.winsize) + "\t" + str(self.winstep)
+        return self.vcf + "\t" + str(self.windowing)
 
 
 
 
 ### SLIDING WINDOW SCAN FUNCTION ###
 
-def SNPwindow_hap_counter(vcfgz, SNPwindow_size, SNPwindow_step):
+def SNPwindow_hap_counter(vcfgz, windowing, decompress_threads=1, manifest=None, incremental=True, verify=False, pbwt=False, spectrum=False,
+                          approx=None, sketch="kmv", groups=None, group_column=2):
     """
     Function counts unique haplotypes in sliding windows on a gizped vcf. See other functions for details.
+    Every window configuration is served from the same pass over the vcf and written to its own csv.
     
     vcfgz (str): gziped vcf file name or path to file.
-    SNPwindow_size (int): number of SNPs defining the window size.
-    SNPwindow_step (int): number of SNPs to slide window, recommended to be 10% of SNPwindow_size.
+    windowing (list of (int, int)): (SNP window size, SNP window step) of each window configuration, the step is recommended to be 10% of the size.
+    decompress_threads (int): number of threads inflating the BGZF blocks of the vcf (see haplotype_matrix/bgzf_reader.py), default is 1.
+    manifest (str or None): sample manifest (see read_sample_manifest in haplotype_matrix/hapmatrix.py), only the haplotypes of its samples are counted
+        and the manifest name is added to the output file names, default is all samples.
+    incremental (bool): count haplotypes with a RollingHapCounter (see haplotype_matrix/hap_hash.py) per window configuration that updates
+        the haplotype hashes by the sites leaving and entering the window instead of sorting every window, default is True.
+    verify (bool): compare the haplotypes sharing a rolling hash and count the window exactly if they differ, default is False.
+    pbwt (bool): count haplotypes with a PBWT (see haplotype_matrix/pbwt.py) fed every site of the chromosome once,
+        the windows of every configuration are counted from its divergence array, default is False.
+    spectrum (bool): also write the haplotype diversity, entropy, H1, H12, H2/H1, top haplotype frequencies and the run-length encoded
+        haplotype frequency spectrum of each window (see haplotype_matrix/hap_spectrum.py), taken from the same grouping that counts
+        the unique haplotypes, default is False.
+    approx (float or None): relative standard error of approximate counts e.g. 0.01, the distinct rolling hashes of each window are counted with a
+        fixed size sketch (see haplotype_matrix/hap_sketch.py) and the error is written in a hapcount_rse column, overrides incremental and pbwt,
+        default is exact counts.
+    sketch (str): sketch of the approximate counts, "kmv" (k minimum values) or "hll" (HyperLogLog), default is "kmv".
+    groups (str or None): panel file with the group of each sample (e.g. the 1000 Genomes panel file, see read_sample_groups in
+        haplotype_matrix/hap_groups.py), the distinct haplotypes and number of haplotypes of each group are also written, counted from
+        the distinct haplotype ids of the same grouping that counts all haplotypes, default is no group counts.
+    group_column (int): column of the group in the panel file, 0 based, default is 2 (super_pop).
     """
 
-    #setting up deque for sliding window
-    window_deque = deque()
+    if spectrum and approx is not None:
+        exit("The haplotype frequency spectrum needs exact counts, approx has to be None")
+    if groups is not None and approx is not None:
+        exit("The group counts need exact counts, approx has to be None")
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    _check_outputs([_outfile(chrom, size, step, manifest) for size, step in windowing])
+
+    #read from the bit-packed haplotype matrix if it was built for this vcf
+    if hapmatrix_exists(vcfgz):
+        _hapmatrix_hap_counter(vcfgz, windowing, manifest, incremental, verify, pbwt, spectrum, approx, sketch, groups, group_column)
+        return
+
+    #setting up the array-backed sliding window shared by the window configurations (see haplotype_matrix/window_buffer.py)
+    window = WindowBuffer()
+    hapsites = window
+    #site index of the next window start of each configuration
+    next_lo = [0] * len(windowing)
+    #incremental haplotype counter of each configuration, the configurations share one PBWT fed every site
+    sweep = PBWT() if pbwt and approx is None else None
+    counters = [sweep if sweep is not None else _hap_counter(incremental, verify, False, approx, sketch) for c in windowing]
+    #group of each haplotype for the group counts
+    hapgroups = _hap_groups(vcfgz, groups, group_column, manifest)
 
     #open files
-    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
-    with gzip.open(vcfgz, "rt") as vcf, open(f"{chrom}_SNPwindow{SNPwindow_size}_SNPstep{SNPwindow_step}_hap_counts.csv", "a") as outcsv:
+    with bgzf_open(vcfgz, "rb", threads=decompress_threads) as vcf, ExitStack() as outfiles:
 
-        #write header line
-        outcsv.write(",".join(["CHROM", "START", "END", "NUM_uniq_haps", "SNP_density"]) + "\n")
+        #open a csv per window configuration and write header lines
+        outcsvs = []
+        for SNPwindow_size, SNPwindow_step in windowing:
+            outcsv = outfiles.enter_context(open(_outfile(chrom, SNPwindow_size, SNPwindow_step, manifest), "a"))
+            outcsv.write(",".join(_columns(spectrum, approx, hapgroups)) + "\n")
+            outcsvs.append(outcsv)
 
         #loop through lines
         for line in vcf:
 
+            #select the haplotypes of the manifest samples from the window
+            if line.startswith(b"#CHROM") and manifest is not None:
+                hapsites = SampleView(window, line.decode().strip().split("\t")[9:], read_sample_manifest(manifest))
+                continue
+
             #skip header lines
-            if line.startswith("#"):
+            elif line.startswith(b"#"):
                 continue
 
             #sliding window scan
             else:
 
-                #load record into deque
-                window_deque.append(RecordLoader(line))
-
-                #check if window size was reached, if yes, move the window by a step, output results, and continue
-                if len(window_deque) >= SNPwindow_size:
-
-                    #grab window position
-                    start_pos = window_deque[0].position
-                    end_pos = window_deque[-1].position + 1
-                    
-                    #construct haplo matrix
-                    hap_m = _construct_matrix(window_deque)
-                    #count haps
-                    num_haps = _count_unique_haps(hap_m)
-                    #compute SNP density
-                    snpden = SNPwindow_size / (end_pos - start_pos)
-                    #sliding to next step
-                    _pop_step(window_deque, SNPwindow_step)
-
-                    #write to file
-                    outcsv.write(_joinany(",", [chrom, start_pos, end_pos, num_haps, snpden]) + "\n")
-
-                else:
-                    continue
-
-        #clean up last window
-        if len(window_deque) > 0:
-            
-            #grab window position
-            start_pos = window_deque[0].position
-            end_pos = window_deque[-1].position + 1
-
-            #construct haplo matrix
-            hap_m = _construct_matrix(window_deque)
-            #count haps
+                #load record into window
+                window.append(*parse_record(line))
+                num_sites = window.num_appended()
+                if sweep is not None:
+                    sweep.update(hapsites.sites(num_sites - 1, num_sites))
+
+                #check if the window size of each configuration was reached, if yes, output results and move that window by a step
+                for c, (SNPwindow_size, SNPwindow_step) in enumerate(windowing):
+                    if next_lo[c] + SNPwindow_size <= num_sites:
+                        _write_windows(chrom, hapsites, [(next_lo[c], next_lo[c] + SNPwindow_size)], outcsvs[c], counters[c], spectrum, hapgroups)
+                        next_lo[c] += SNPwindow_step
+
+                #sliding to the earliest next window start
+                window.pop(min(next_lo) - window.first)
+
+        #clean up last window of each configuration
+        num_sites = window.num_appended()
+        for c in range(len(windowing)):
+            if next_lo[c] < num_sites:
+                _write_windows(chrom, hapsites, [(next_lo[c], num_sites)], outcsvs[c], counters[c], spectrum, hapgroups)
+
+
+
+
+def _hapmatrix_hap_counter(vcfgz, windowing, manifest=None, incremental=True, verify=False, pbwt=False, spectrum=False, approx=None, sketch="kmv",
+                           groups=None, group_column=2):
+    """
+    Runs the same scan as SNPwindow_hap_counter on the bit-packed haplotype matrix built with
+    haplotype_matrix/hapmatrix.py. Windows are sliced from the memory-mapped matrix instead of parsed from the vcf.
+    """
+
+    #open haplotype matrix
+    hapmat = HapMatrix(vcfgz)
+    hapsites = hapmat if manifest is None else SampleView(hapmat, hapmat.samples, read_sample_manifest(manifest))
+    chrom = vcfgz.split("_")[-1].replace(".vcf.gz", "")
+    hapgroups = _hap_groups(vcfgz, groups, group_column, manifest)
+
+    for SNPwindow_size, SNPwindow_step in windowing:
+
+        #open files
+        with open(_outfile(chrom, SNPwindow_size, SNPwindow_step, manifest), "a") as outcsv:
+
+            #write header line
+            outcsv.write(",".join(_columns(spectrum, approx, hapgroups)) + "\n")
+
+            #loop through windows
+            counter = _hap_counter(incremental, verify, pbwt, approx, sketch)
+            _write_windows(chrom, hapsites, snp_window_bounds(hapmat.num_sites, SNPwindow_size, SNPwindow_step), outcsv, counter, spectrum, hapgroups)
+
+
+
+
+def _write_windows(chrom, hapsites, bounds, outcsv, counter=None, spectrum=False, hapgroups=None):
+    """
+    Counts haplotypes in each window of a list of SNP windows and writes the csv lines.
+    Used by both the vcf scan and the haplotype matrix scan.
+
+    chrom (str): chromosome name for the output
+    hapsites (WindowBuffer or HapMatrix or SampleView): sites to slice the windows from, by site index on the chromosome
+    bounds (list of (int, int)): [first_site, last_site) index pairs of the windows to scan, in order
+    outcsv (file): open output file
+    counter (RollingHapCounter or PBWT or SketchHapCounter or None): incremental haplotype counter of the windows, default is sorting every window
+        with _count_unique_haps. A SketchHapCounter also writes the relative standard error of its estimates
+    spectrum (bool): also write the haplotype frequency spectrum statistics, default is False
+    hapgroups (HapGroups or None): group of each haplotype to also write the counts of each group, default is no group counts
+    """
+
+    for lo, hi in bounds:
+
+        #slice haplo matrix
+        hap_m = hapsites.sites(lo, hi)
+
+        #grab window position
+        positions = hapsites.site_positions(lo, hi)
+        start_pos = int(positions[0])
+        end_pos = int(positions[-1]) + 1
+
+        #count haps, with the distinct haplotype id of each haplotype for the spectrum and the group counts
+        extra = []
+        if spectrum or hapgroups is not None:
+            hap_ids = hap_class_ids(hap_m) if counter is None else counter.count(hap_m, lo, hi, return_ids=True)[-1]
+            num_haps = int(hap_ids.max()) + 1
+            if spectrum:
+                extra += spectrum_stats(np.bincount(hap_ids))
+            if hapgroups is not None:
+                extra += hapgroups.count(hap_ids)
+        elif counter is None:
             num_haps = _count_unique_haps(hap_m)
-            #compute SNP density
-            snpden = len(window_deque) / (end_pos - start_pos)
-            
-            #write to file
-            outcsv.write(_joinany(",", [chrom, start_pos, end_pos, num_haps, snpden]) + "\n")
+        else:
+            num_haps = counter.count(hap_m, lo, hi)[0]
+            if isinstance(counter, SketchHapCounter):
+                extra = [counter.error]
+        #compute SNP density
+        snpden = (hi - lo) / (end_pos - start_pos)
+
+        #write to file
+        outcsv.write(_joinany(",", [chrom, start_pos, end_pos, num_haps, snpden] + extra) + "\n")
 
 
 
@@ -189,11 +342,12 @@ def SNPwindow_hap_counter(vcfgz, SNPwindow_size, SNPwindow_step):
 def run_hapcount_scan(argloader_obj):
     """Main Function that runs windowed_UPGMA_scan with a single argument of the class ArgLoader"""
 
-    SNPwindow_hap_counter(argloader_obj.vcf, argloader_obj.winsize, argloader_obj.winstep)    #, argloader_obj.plot_here
+    SNPwindow_hap_counter(argloader_obj.vcf, argloader_obj.windowing, argloader_obj.threads, argloader_obj.manifest, argloader_obj.incremental, argloader_obj.verify, argloader_obj.pbwt, argloader_obj.spectrum,
+                          argloader_obj.approx, argloader_obj.sketch, argloader_obj.groups, argloader_obj.group_column)    #, argloader_obj.plot_here
 
 
 
-# args = ArgLoader("test1.vcf.gz", 100, 10)
+# args = ArgLoader("test1.vcf.gz", [(100, 10)])
 # run_hapcount_scan(args)
 
 
@@ -211,13 +365,34 @@ def main():
         "beagle_phased_biallelic_SNPs_1000GP30X_PARchrX.vcf.gz", "beagle_phased_biallelic_SNPs_1000GP30X_nonPARchrX.vcf.gz", "beagle_imputed_males_biallelic_SNPs_1000GP30X_chrY.vcf.gz"
         ]
     
+    processes = 10
+    #RAM the running chromosomes may use together, chromosomes are started longest first while their estimated memory fits (see haplotype_matrix/scheduler.py)
+    ram_budget = 64 * 2 ** 30
+    #tab separated log of the peak RSS and runtime of each chromosome, None only prints them
+    job_log = None
+
     loaderlist = []
 
     for vcffile in vcflist:
-        loaderlist.append(ArgLoader(vcffile, 1000, 500))
+        loaderlist.append(ArgLoader(vcffile, [(1000, 500)]))
+
+    #outputs of an earlier run are refused before any chromosome is scanned
+    _check_outputs([outfile for argloader in loaderlist for outfile in argloader.outfiles()])
+
+    #positions of each chromosome, read once and cached next to the vcfs
+    pool = Pool(processes=processes)
+    positions = pool.map(load_positions, vcflist)
+    pool.close()
+
+    #estimated memory and runtime of each chromosome, its window configurations share one pass over the vcf
+    estimates = []
+    for argloader, chrom_positions in zip(loaderlist, positions):
+        num_haps = 2 * len(vcf_samples(argloader.vcf))
+        config_bounds = [np.array(snp_window_bounds(len(chrom_positions), size, step), dtype=np.int64).reshape(-1, 2) for size, step in argloader.windowing]
+        estimates.append(combine_estimates([estimate_job("hapcount", num_haps, bounds[:, 0], bounds[:, 1]) for bounds in config_bounds]))
 
-    pool = Pool(processes=10)
-    pool.map(run_hapcount_scan, loaderlist)
+    #chromosomes run longest first within the RAM budget, each one is logged as it finishes
+    list(run_scheduled(run_hapcount_scan, loaderlist, estimates, processes, ram_budget, job_log))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,224 @@
+"""
+Parallel reader for BGZF compressed vcfs (the .vcf.gz files written by bcftools -Oz / bgzip).
+
+gzip.open inflates a file on a single thread. A BGZF file is a series of independent gzip blocks of at
+most 64 KB that each record their own compressed size, so the raw file can be split on block boundaries
+without inflating anything. The reader splits the file into batches of blocks, inflates the batches in a
+thread pool (zlib releases the GIL while inflating) and yields the decompressed bytes or lines in file order.
+Files that are plain gzip and not BGZF are read with gzip.open instead.
+"""
+
+import gzip
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+### HELPER FUNCTIONS ###
+
+def _is_bgzf(path):
+    """
+    Helper function that checks if the first block of a file has the BGZF "BC" extra subfield
+    """
+
+    with open(path, "rb") as f:
+        header = f.read(18)
+
+    return len(header) == 18 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+
+def _split_blocks(raw, start):
+    """
+    Helper function that finds the complete BGZF blocks in a buffer of raw compressed bytes.
+
+    :param raw: raw compressed bytes
+    :type raw: bytes
+    :param start: offset in raw of the first block
+    :type start: int
+
+    :returns: (data start, data end) offsets of the deflate data of each complete block, and the offset of the first incomplete block
+    :rtype: list of (int, int), int
+    """
+
+    spans = []
+    offset = start
+    while offset + 18 <= len(raw):
+
+        #header: gzip magic and flags, then XLEN, then the "BC" subfield holding the block size - 1
+        xlen = struct.unpack_from("<H", raw, offset + 10)[0]
+        if raw[offset:offset + 4] != b"\x1f\x8b\x08\x04" or raw[offset + 12:offset + 14] != b"BC":
+            raise ValueError(f"Not a BGZF block at compressed offset {offset}")
+        block_size = struct.unpack_from("<H", raw, offset + 16)[0] + 1
+
+        #incomplete block, wait for more bytes
+        if offset + block_size > len(raw):
+            break
+
+        #deflate data sits between the extra field and the CRC32/ISIZE footer
+        data_start = offset + 12 + xlen
+        data_end = offset + block_size - 8
+        spans.append((data_start, data_end))
+        offset += block_size
+
+    return spans, offset
+
+
+
+def _inflate_blocks(raw, spans):
+    """
+    Helper function that inflates a batch of BGZF blocks and joins the decompressed bytes. Run in the thread pool.
+    """
+
+    return b"".join([zlib.decompress(raw[s:e], -15) for s, e in spans])
+
+
+
+### CLASSES ###
+
+class BGZFReader():
+    def __init__(self, path, mode="rb", threads=4, blocks_per_batch=64, voffset=0):
+        """
+        This class reads a BGZF file by inflating batches of blocks in a thread pool.
+        Use it like gzip.open: as a context manager that is iterated over line by line.
+        Reading can start part way into the file from a tabix virtual offset.
+
+        :param path: BGZF file name or path to file
+        :type path: str
+        :param mode: "rb" to yield bytes lines, "rt" to yield str lines
+        :type mode: str
+        :param threads: number of inflating threads
+        :type threads: int
+        :param blocks_per_batch: number of blocks (up to 64 KB each) inflated per thread pool task
+        :type blocks_per_batch: int
+        :param voffset: virtual offset to start reading from (compressed block offset << 16 | offset within the block)
+        :type voffset: int, optional
+
+        Attributes:
+            path (str): file being read
+            text (bool): whether lines are decoded to str
+            threads (int): number of inflating threads
+            blocks_per_batch (int): number of blocks per thread pool task
+            voffset (int): virtual offset reading starts from
+        """
+
+        self.path = path
+        self.text = mode == "rt"
+        self.threads = max(1, threads)
+        self.blocks_per_batch = blocks_per_batch
+        self.voffset = voffset
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+    def chunks(self):
+        """
+        Yields the decompressed bytes of the file in order from the virtual offset, one batch of blocks at a time.
+        """
+
+        #the first batch starts with the block holding the virtual offset
+        skip = self.voffset & 0xFFFF
+        for chunk in self._batches():
+            if skip > 0:
+                chunk = chunk[skip:]
+                skip = 0
+            yield chunk
+
+
+    def _batches(self):
+        """
+        Yields the decompressed batches of blocks in order, starting at the block the virtual offset points to.
+        Up to 2 batches per thread are inflating while the caller works on the current one.
+        """
+
+        read_size = self.blocks_per_batch * 65536
+        in_flight = deque()
+
+        with open(self.path, "rb") as f, ThreadPoolExecutor(max_workers=self.threads) as pool:
+
+            f.seek(self.voffset >> 16)
+            leftover = b""
+            while True:
+
+                #read the next raw chunk and split it on block boundaries
+                new_raw = f.read(read_size)
+                raw = leftover + new_raw
+                spans, end = _split_blocks(raw, 0)
+                leftover = raw[end:]
+
+                for b in range(0, len(spans), self.blocks_per_batch):
+                    in_flight.append(pool.submit(_inflate_blocks, raw, spans[b:b + self.blocks_per_batch]))
+
+                    #hand back finished batches in order once enough are queued
+                    while len(in_flight) > 2 * self.threads:
+                        yield in_flight.popleft().result()
+
+                #end of file, hand back the rest
+                if len(new_raw) == 0:
+                    while len(in_flight) > 0:
+                        yield in_flight.popleft().result()
+
+                if len(new_raw) == 0:
+                    break
+
+            if len(leftover) > 0:
+                raise ValueError(f"Truncated BGZF block at the end of {self.path}")
+
+
+    def __iter__(self):
+        """
+        Yields the lines of the file in order, with their line endings, like iterating over gzip.open
+        """
+
+        remainder = b""
+        for chunk in self.chunks():
+            lines = (remainder + chunk).splitlines(keepends=True)
+            if len(lines) == 0:
+                continue
+
+            #last line may continue in the next chunk
+            if lines[-1].endswith(b"\n"):
+                remainder = b""
+            else:
+                remainder = lines.pop()
+
+            if self.text:
+                for line in lines:
+                    yield line.decode()
+            else:
+                yield from lines
+
+        if len(remainder) > 0:
+            yield remainder.decode() if self.text else remainder
+
+
+
+### OPEN FUNCTION ###
+
+def bgzf_open(path, mode="rb", threads=4):
+    """
+    Opens a vcf.gz for reading line by line. BGZF files get inflated in parallel with BGZFReader
+    and other gzip files fall back to gzip.open.
+
+    :param path: gziped file name or path to file
+    :type path: str
+    :param mode: "rb" or "rt"
+    :type mode: str
+    :param threads: number of inflating threads
+    :type threads: int
+
+    :returns: file object to iterate over line by line
+    :rtype: BGZFReader or gzip.GzipFile
+    """
+
+    if _is_bgzf(path):
+        return BGZFReader(path, mode=mode, threads=threads)
+    else:
+        return gzip.open(path, mode)
@@ -0,0 +1,196 @@
+"""
+Checkpoints of long running window scans, so that a scan stopped by a crash or preemption is resumed where it
+stopped instead of deleting its partial output and starting over.
+
+A scan writes its windows in order to a text output. Every `every` windows the output is flushed and a checkpoint
+is written next to it (outfile.ckpt, replaced atomically) holding:
+    windows     number of windows written
+    offset      byte offset of the output after the last written window
+    site        index of the first site of the last written window
+    position    bp position of that site, the position the vcf is seeked to with the tabix index
+A first checkpoint is written right after the header and the checkpoint is removed once the scan is done,
+so an output without a checkpoint is finished.
+
+Resuming truncates the output to the checkpoint offset, which drops the rows (and the partial line) written after it,
+and continues from window `windows` without writing the header again. The sliding window itself is not saved: the sites
+of the next window are read again by seeking into the vcf with the tabix index (ShardSites in shards.py) or slicing the
+haplotype matrix, and the rolling hash and PBWT counters rebuild their state from the first window they count, the same
+way the shards of a parallel scan start in the middle of a chromosome.
+"""
+
+import os
+import json
+
+
+### HELPER FUNCTIONS ###
+
+def checkpoint_path(outfile):
+    """
+    Returns the checkpoint file name of a scan output
+    """
+
+    return outfile + ".ckpt"
+
+
+
+def read_checkpoint(outfile):
+    """
+    Reads the checkpoint of a scan output.
+
+    :param outfile: scan output file name or path to file
+    :type outfile: str
+
+    :returns: checkpoint fields (see the module docstring), None if the output has no checkpoint
+    :rtype: dict or None
+    """
+
+    if not os.path.exists(checkpoint_path(outfile)):
+        return None
+
+    with open(checkpoint_path(outfile), "r") as ckptfile:
+        return json.load(ckptfile)
+
+
+
+def open_checkpoint(outfile, every, resume=False):
+    """
+    Sets up the checkpoints of a scan output. Resuming truncates the output to its checkpoint.
+
+    :param outfile: scan output file name or path to file
+    :type outfile: str
+    :param every: number of windows between checkpoints
+    :type every: int
+    :param resume: continue the output from its checkpoint, defaults to starting the output over
+    :type resume: bool, optional
+
+    :returns: checkpoint of the scan, None if resume and the output is already finished
+    :rtype: ScanCheckpoint or None
+    """
+
+    if every is None or every < 1:
+        exit("The number of windows between checkpoints has to be at least 1")
+
+    state = read_checkpoint(outfile) if resume else None
+
+    #finished output
+    if resume and state is None and os.path.exists(outfile):
+        return None
+
+    if state is None:
+        return ScanCheckpoint(outfile, every)
+
+    #drop what was written after the checkpoint
+    with open(outfile, "r+b") as out:
+        out.truncate(state["offset"])
+
+    return ScanCheckpoint(outfile, every, state)
+
+
+
+### CLASSES ###
+
+class ScanCheckpoint():
+    def __init__(self, outfile, every, state=None):
+        """
+        This class counts the windows written to a scan output and checkpoints the output every few windows.
+
+        :param outfile: scan output file name or path to file
+        :type outfile: str
+        :param every: number of windows between checkpoints
+        :type every: int
+        :param state: checkpoint fields of a resumed output (see read_checkpoint), defaults to a new output
+        :type state: dict, optional
+
+        Attributes:
+            windows (int): number of windows written
+            site (int or None): index of the first site of the last written window
+            position (int or None): bp position of that site
+            resumed (bool): the output is continued from a checkpoint, it is opened in append mode without a header
+        """
+
+        self.outfile = outfile
+        self.every = every
+        self.resumed = state is not None
+        self.windows = state["windows"] if self.resumed else 0
+        self.site = state["site"] if self.resumed else None
+        self.position = state["position"] if self.resumed else None
+
+
+    def mode(self):
+        """
+        File mode to open the output with, "a" to continue a resumed output and "w" to start it over
+        """
+
+        return "a" if self.resumed else "w"
+
+
+    def check(self, bounds, positions):
+        """
+        Checks that the checkpoint was written by a scan with the same windows and returns the windows left to scan.
+
+        :param bounds: [first_site, last_site) index pairs of all windows of the scan, in order
+        :type bounds: list of (int, int)
+        :param positions: positions of all sites
+        :type positions: np.ndarray of int64
+
+        :returns: windows left to scan
+        :rtype: list of (int, int)
+        """
+
+        if self.windows > 0:
+            if self.windows > len(bounds) or bounds[self.windows - 1][0] != self.site or int(positions[self.site]) != self.position:
+                exit(f"The checkpoint of {self.outfile} does not match the windows of the scan, remove it to start the scan over")
+
+        return bounds[self.windows:]
+
+
+    def start(self, out):
+        """
+        Writes the first checkpoint after the header of a new output, a resumed output already has one
+        """
+
+        if not self.resumed:
+            self.save(out)
+
+
+    def window_done(self, out, site, position):
+        """
+        Counts a written window and checkpoints the output every `every` windows.
+
+        :param out: open output file
+        :type out: file
+        :param site: index of the first site of the window
+        :type site: int
+        :param position: bp position of that site
+        :type position: int
+        """
+
+        self.windows += 1
+        self.site = site
+        self.position = position
+
+        if self.windows % self.every == 0:
+            self.save(out)
+
+
+    def save(self, out):
+        """
+        Flushes the output to disk and replaces the checkpoint
+        """
+
+        out.flush()
+        os.fsync(out.fileno())
+
+        state = {"windows": self.windows, "offset": out.tell(), "site": self.site, "position": self.position}
+        with open(checkpoint_path(self.outfile) + ".tmp", "w") as ckptfile:
+            json.dump(state, ckptfile)
+        os.replace(checkpoint_path(self.outfile) + ".tmp", checkpoint_path(self.outfile))
+
+
+    def finish(self):
+        """
+        Removes the checkpoint once every window of the scan is written
+        """
+
+        if os.path.exists(checkpoint_path(self.outfile)):
+            os.remove(checkpoint_path(self.outfile))
@@ -0,0 +1,117 @@
+"""
+UPGMA of the haplotypes of a window with identical haplotypes collapsed.
+
+A window of a few thousand SNPs usually holds a few hundred distinct haplotypes out of the 6404 of the cohort.
+Identical haplotypes are at the same distance from every cluster until they are merged, so the distances of UPGMA are
+only held for the distinct haplotypes and the clusters merged so far (average_linkage in window_kernels.py), while the
+nearest neighbor chain of scipy's linkage still walks and merges the haplotypes themselves in scipy's order. Distances
+are averaged in the same order as scipy, so the result is scipy.cluster.hierarchy.linkage(haplotypes, method="average",
+metric="euclidean") to the last bit, ties included, and _find_avg_branch and _find_top_branch of the UPGMA scans read it
+unchanged, while the distances and the clustering scale with the number of distinct haplotypes instead of the sample
+size. When the distances between all haplotypes of the window are already known (the sliding Hamming distances of
+sliding_hamming.py) those of the distinct haplotypes are picked from them instead of counting them again.
+"""
+
+import numpy as np
+from scipy.spatial.distance import squareform
+from window_kernels import average_linkage
+from packed_distances import euclidean_distances
+
+
+### HELPER FUNCTIONS ###
+
+def collapse_haplotypes(haplo_matrix):
+    """
+    Finds the distinct haplotypes of a window.
+
+    :param haplo_matrix: each row is a site and each column is the haplotype at that site
+    :type haplo_matrix: np.ndarray
+
+    :returns: distinct haplotypes (one row per haplotype, sorted by their packed bytes), index of the first copy of each
+        distinct haplotype, index of the distinct haplotype of each haplotype and number of copies of each distinct haplotype
+    :rtype: np.ndarray of uint8, np.ndarray of int64, np.ndarray of int64, np.ndarray of int64
+    """
+
+    haps = np.ascontiguousarray(np.asarray(haplo_matrix, dtype=np.uint8).T)
+
+    #each packed row is viewed as a single bytes scalar so rows are compared with memcmp (see _count_unique_haps in hapcount_scan.py)
+    packed = np.packbits(haps, axis=1)
+    rows = np.ascontiguousarray(packed).view(np.dtype((np.void, packed.shape[1]))).ravel()
+    uniq_rows, first, inverse, counts = np.unique(rows, return_index=True, return_inverse=True, return_counts=True)
+
+    return haps[first], first.astype(np.int64), inverse.ravel().astype(np.int64), counts.astype(np.int64)
+
+
+
+def _pick_dists(hap_dists, num_haps, first):
+    """
+    Helper picks the condensed distances between the distinct haplotypes out of the condensed distances between all
+    haplotypes, each distinct haplotype stands for its first copy
+    """
+
+    rows, cols = np.triu_indices(len(first), k=1)
+    i, j = np.minimum(first[rows], first[cols]), np.maximum(first[rows], first[cols])
+
+    #position of pair i < j in the condensed order of pdist
+    return hap_dists[num_haps * i - i * (i + 1) // 2 + j - i - 1]
+
+
+
+def _label(merges, counts):
+    """
+    Helper sorts the merges by height and names the clusters like scipy's linkage: cluster i of the sorted merges is
+    number of points + i, the smaller id comes first and the size column counts the points of the merged cluster
+    """
+
+    num_points = len(counts)
+    merges = merges[np.argsort(merges[:, 2], kind="mergesort")]
+
+    #union find of the cluster slots
+    parent = np.arange(2 * num_points - 1)
+    size = np.concatenate([counts, np.zeros(num_points - 1, dtype=np.int64)])
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    for i in range(len(merges)):
+        x_root, y_root = find(int(merges[i, 0])), find(int(merges[i, 1]))
+        merges[i, 0], merges[i, 1] = min(x_root, y_root), max(x_root, y_root)
+        parent[x_root] = parent[y_root] = num_points + i
+        size[num_points + i] = size[x_root] + size[y_root]
+        merges[i, 3] = size[num_points + i]
+
+    return merges
+
+
+
+### COLLAPSED UPGMA ###
+
+def collapsed_linkage(haplo_matrix, hap_dists=None):
+    """
+    Runs UPGMA on the haplotypes of a window with the distances of the distinct haplotypes only.
+
+    :param haplo_matrix: each row is a site and each column is the haplotype at that site
+    :type haplo_matrix: np.ndarray
+    :param hap_dists: condensed euclidean distances between all haplotypes of the window (see SlidingHamming in sliding_hamming.py),
+        defaults to computing the distances between the distinct haplotypes from their packed sites (see packed_distances.py)
+    :type hap_dists: np.ndarray of float64, optional
+
+    :returns: linkage of all haplotypes, the same as scipy.cluster.hierarchy.linkage(haplo_matrix.T, method="average", metric="euclidean")
+    :rtype: np.ndarray of float64
+    """
+
+    uniq_haps, first, inverse, counts = collapse_haplotypes(haplo_matrix)
+    num_haps = len(inverse)
+
+    #UPGMA of all haplotypes on the distances of the distinct ones
+    if hap_dists is None:
+        dists = euclidean_distances(uniq_haps.T, np.float64)
+    else:
+        dists = _pick_dists(hap_dists, num_haps, first)
+
+    return _label(average_linkage(squareform(dists), inverse), np.ones(num_haps, dtype=np.int64))
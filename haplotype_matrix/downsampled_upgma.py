@@ -0,0 +1,231 @@
+"""
+Approximate UPGMA branch statistics from random subsets of the haplotypes of each window.
+
+UPGMA of all 6404 haplotypes of a window costs haplotypes^2 in memory and time. For exploratory genome-wide runs the
+branch statistics can instead be estimated from k haplotypes drawn per window, about (6404 / k)^2 times cheaper,
+and the draw repeated r times: the scans then write the mean of each statistic over the draws and its standard
+deviation, so the error of the estimate is measured window by window.
+
+The draws are reproducible: the random generator of a window is seeded with the seed of the scan and the site bounds
+of the window, so a window gets the same haplotypes whether it is scanned serially, in a shard, on a window thread or
+after a resume. With a panel file the draws are stratified: every group (e.g. the superpopulations of the 1000
+Genomes panel, see read_sample_groups in hap_groups.py) gets a share of the k haplotypes proportional to its size, so
+every population is represented in every draw. Haplotypes of samples missing from the panel form a group of their own.
+
+Small draws often hold a single haplotype in windows with few sites. Their tree has height 0 and the normalized branch
+statistics are 0 / 0, so these draws are skipped: the mean and standard deviation are taken over the other draws, and
+every statistic of a window is nan when all of its draws are skipped.
+"""
+
+import numpy as np
+from hapmatrix import vcf_samples, read_sample_manifest
+from hap_groups import read_sample_groups
+
+
+### HELPER FUNCTIONS ###
+
+def downsample_tag(downsample):
+    """
+    Output file name tag of a downsampled scan e.g. "_downsample500x10", empty for a scan of all haplotypes.
+
+    :param downsample: downsampling of the scan, None for all haplotypes
+    :type downsample: Downsampling or None
+
+    :returns: file name tag
+    :rtype: str
+    """
+
+    if downsample is None:
+        return ""
+
+    return f"_downsample{downsample.num_haps}x{downsample.repeats}" + ("_stratified" if downsample.panel is not None else "")
+
+
+
+def stat_columns(names, downsample):
+    """
+    Output columns of the branch statistics, a downsampled scan writes the mean of each statistic followed by its standard deviation over the draws.
+
+    :param names: column names of the statistics
+    :type names: list of str
+    :param downsample: downsampling of the scan, None for all haplotypes
+    :type downsample: Downsampling or None
+
+    :returns: column names
+    :rtype: list of str
+    """
+
+    if downsample is None:
+        return list(names)
+
+    return [column for name in names for column in [name, f"{name}_sd"]]
+
+
+
+def downsampled_stats(stats_func, haplo_matrix, draws, num_stats=1):
+    """
+    Runs a window statistic on each draw of haplotypes and summarizes the draws. Draws of identical haplotypes
+    are skipped, their tree has height 0 (see the module docstring).
+
+    :param stats_func: statistic of a window e.g. _runUPGMA of the UPGMA scans, returning a number or a tuple of numbers
+    :type stats_func: callable
+    :param haplo_matrix: each row is a site and each column is the haplotype at that site
+    :type haplo_matrix: np.ndarray
+    :param draws: haplotype columns of each draw (see HapSampler.draws)
+    :type draws: list of np.ndarray
+    :param num_stats: number of statistics stats_func returns, defaults to 1
+    :type num_stats: int, optional
+
+    :returns: mean and standard deviation (0 for a single draw) over the draws of each statistic, in the order of stat_columns,
+        nan if every draw is skipped
+    :rtype: list of float
+    """
+
+    #draws with more than one distinct haplotype
+    subsets = [haplo_matrix[:, idx] for idx in draws]
+    subsets = [hap_m for hap_m in subsets if not (hap_m == hap_m[:, :1]).all()]
+    if len(subsets) == 0:
+        return [np.nan] * (2 * num_stats)
+
+    stats = np.array([np.atleast_1d(stats_func(hap_m)) for hap_m in subsets], dtype=np.float64)
+
+    means = stats.mean(axis=0)
+    sds = stats.std(axis=0, ddof=1) if len(subsets) > 1 else np.zeros(stats.shape[1])
+
+    return [float(x) for pair in zip(means, sds) for x in pair]
+
+
+
+def _allocate(num_haps, sizes):
+    """
+    Helper splits num_haps draws between groups in proportion to their sizes, rounding by largest remainder
+    """
+
+    quotas = num_haps * sizes / sizes.sum()
+    shares = np.floor(quotas).astype(np.int64)
+    leftover = num_haps - int(shares.sum())
+    shares[np.argsort(-(quotas - shares), kind="stable")[:leftover]] += 1
+
+    return shares
+
+
+
+### CLASSES ###
+
+class Downsampling():
+    def __init__(self, num_haps, repeats=1, seed=0, panel=None, group_column=2):
+        """
+        This class holds the settings of a downsampled UPGMA scan, so that they are passed on to the scan functions and the shards as one argument.
+
+        :param num_haps: number of haplotypes drawn per window, windows with fewer haplotypes use all of them
+        :type num_haps: int
+        :param repeats: number of draws per window, defaults to 1
+        :type repeats: int, optional
+        :param seed: random seed of the scan, defaults to 0
+        :type seed: int, optional
+        :param panel: panel file with the group of each sample to stratify the draws by, defaults to simple random draws
+        :type panel: str, optional
+        :param group_column: column of the group in the panel file, 0 based, defaults to 2 (super_pop)
+        :type group_column: int, optional
+        """
+
+        if num_haps < 2:
+            exit("UPGMA needs at least 2 haplotypes per draw")
+        if repeats < 1:
+            exit("repeats has to be at least 1")
+
+        self.num_haps = num_haps
+        self.repeats = repeats
+        self.seed = seed
+        self.panel = panel
+        self.group_column = group_column
+
+
+    def __str__(self):
+        return f"{self.num_haps} haplotypes x {self.repeats} draws"
+
+
+    def sampler(self, vcfgz, manifest=None):
+        """
+        Sampler of the windows of one scan.
+
+        :param vcfgz: gziped vcf file name or path to file, read for its sample names when the draws are stratified
+        :type vcfgz: str
+        :param manifest: sample manifest of the scan (see read_sample_manifest in hapmatrix.py), defaults to all samples
+        :type manifest: str, optional
+
+        :returns: sampler drawing the haplotypes of each window
+        :rtype: HapSampler
+        """
+
+        if self.panel is None:
+            return HapSampler(self)
+
+        #samples in the column order of the scanned haplotypes
+        samples = vcf_samples(vcfgz)
+        if manifest is not None:
+            keep = set(read_sample_manifest(manifest))
+            samples = [sample for sample in samples if sample in keep]
+
+        sample_groups = read_sample_groups(self.panel, self.group_column)
+        names = sorted(set(sample_groups.values()))
+        index = {name: g for g, name in enumerate(names)}
+
+        return HapSampler(self, np.array([index.get(sample_groups.get(sample), -1) for sample in samples], dtype=np.int64))
+
+
+
+
+class HapSampler():
+    def __init__(self, downsample, sample_labels=None):
+        """
+        This class draws the haplotypes of each window of a scan. The haplotypes are labelled with their group on the
+        first window, once the number of haplotypes per sample is known.
+
+        :param downsample: settings of the downsampled scan
+        :type downsample: Downsampling
+        :param sample_labels: group index of each sample of the scan, -1 if it is in no group, defaults to simple random draws
+        :type sample_labels: np.ndarray, optional
+
+        Attributes:
+            labels (np.ndarray of int64 or None): group index of each haplotype of the scan, None before the first window or without groups
+        """
+
+        self.downsample = downsample
+        self.labels = None
+        self._sample_labels = sample_labels
+
+
+    def draws(self, num_haps, lo, hi):
+        """
+        Draws the haplotypes of a window.
+
+        :param num_haps: number of haplotypes of the window
+        :type num_haps: int
+        :param lo: index of the first site of the window
+        :type lo: int
+        :param hi: index after the last site of the window
+        :type hi: int
+
+        :returns: sorted haplotype columns of each draw
+        :rtype: list of np.ndarray of int64
+        """
+
+        k = min(self.downsample.num_haps, num_haps)
+
+        #generator of this window only, so that draws do not depend on the order windows are scanned in
+        rng = np.random.default_rng([self.downsample.seed, lo, hi])
+
+        if self._sample_labels is None:
+            return [np.sort(rng.choice(num_haps, k, replace=False)) for r in range(self.downsample.repeats)]
+
+        if self.labels is None:
+            ploidy = num_haps // len(self._sample_labels)
+            self.labels = np.repeat(self._sample_labels, ploidy)
+
+        #haplotypes of each group, share of the draws of each group
+        groups = [np.flatnonzero(self.labels == g) for g in np.unique(self.labels)]
+        shares = _allocate(k, np.array([len(haps) for haps in groups], dtype=np.float64))
+
+        return [np.sort(np.concatenate([rng.choice(haps, share, replace=False) for haps, share in zip(groups, shares)]))
+                for r in range(self.downsample.repeats)]
@@ -0,0 +1,92 @@
+"""
+Byte-level parser for the records of the phased biallelic vcfs. Each record is parsed once into a
+uint8 haplotype row with a single vectorized pass over the line bytes instead of splitting every
+genotype on "|" in Python.
+
+Every allele in a GT column is a single digit followed by exactly one separator byte ("|", "/", tab or
+the newline), so once the offset of the first genotype column is known the alleles are every other byte
+from that offset. This holds for diploid ("0|1") and haploid ("0") genotypes alike.
+"""
+
+import numpy as np
+
+
+def gt_column_offset(line):
+    """
+    Finds the byte offset of the first genotype column (the 10th column) of a vcf record.
+
+    :param line: record line from vcf opened in binary mode
+    :type line: bytes
+
+    :returns: offset of the first genotype byte
+    :rtype: int
+    """
+
+    offset = -1
+    for i in range(9):
+        offset = line.index(b"\t", offset + 1)
+
+    return offset + 1
+
+
+
+def parse_position(line):
+    """
+    Grabs the position (2nd column) of a vcf record.
+
+    :param line: record line from vcf opened in binary mode
+    :type line: bytes
+
+    :returns: record position
+    :rtype: int
+    """
+
+    first_tab = line.index(b"\t")
+    second_tab = line.index(b"\t", first_tab + 1)
+
+    return int(line[first_tab + 1:second_tab])
+
+
+
+def parse_haps(line, offset=None):
+    """
+    Turns the genotype columns of a vcf record into a haplotype row in one vectorized pass.
+    The haplotypes are ordered the same way as _construct_matrix in the scanners
+    e.g. "0|1\\t1|1\\n" -> [0, 1, 1, 1]
+
+    :param line: record line from vcf opened in binary mode
+    :type line: bytes
+    :param offset: offset of the first genotype byte, found with gt_column_offset if not given
+    :type offset: int, optional
+
+    :returns: haplotype row for the site
+    :rtype: np.ndarray of uint8
+    """
+
+    if offset is None:
+        offset = gt_column_offset(line)
+
+    #alleles sit on every other byte from the first genotype
+    gt_bytes = np.frombuffer(line, dtype=np.uint8, offset=offset)
+    haps = gt_bytes[0::2] - 48
+
+    #anything other than 0 or 1 means a missing, multi-digit or malformed genotype
+    if len(haps) > 0 and haps.max() > 1:
+        exit(f"Record at {parse_position(line)} has genotypes that are not biallelic single digit calls")
+
+    return haps
+
+
+
+def parse_record(line):
+    """
+    Parses the position and haplotype row of a vcf record.
+
+    :param line: record line from vcf opened in binary mode
+    :type line: bytes
+
+    :returns: record position and haplotype row
+    :rtype: int, np.ndarray of uint8
+    """
+
+    return parse_position(line), parse_haps(line)
@@ -0,0 +1,135 @@
+"""
+Unique haplotype counts per sample group (e.g. the superpopulations of the 1000 Genomes panel file) from the
+same pass as the count over all haplotypes.
+
+Each haplotype of a window gets the id of its distinct haplotype, 0 to (number of distinct haplotypes - 1),
+from the grouping step that already counts them:
+    hap_class_ids       inverse of np.unique on the bit-packed haplotypes viewed as byte scalars
+    RollingHapCounter   inverse of np.unique on the haplotype hashes (hap_hash.py)
+    PBWT                index of the run of identical haplotypes in prefix order (pbwt.py)
+
+The distinct haplotypes of a group are then the distinct (group, id) pairs, a grouped count over integers,
+so the haplotypes are not grouped again per group.
+"""
+
+import numpy as np
+
+
+### HELPER FUNCTIONS ###
+
+def read_sample_groups(panel, group_column=2):
+    """
+    Reads the group of each sample from a panel file: one sample per line, sample name in the first column and
+    whitespace separated columns e.g. "sample pop super_pop gender". Blank lines, lines starting with # and a
+    header line starting with "sample" are skipped.
+
+    :param panel: panel file name or path to file
+    :type panel: str
+    :param group_column: column of the group, 0 based, defaults to 2 (super_pop in the 1000 Genomes panel)
+    :type group_column: int, optional
+
+    :returns: group of each sample
+    :rtype: dict of str: str
+    """
+
+    sample_groups = {}
+    with open(panel, "r") as panelfile:
+        for line in panelfile:
+            if line.strip() == "" or line.startswith("#") or line.split()[0].lower() == "sample":
+                continue
+            fields = line.split()
+            if len(fields) <= group_column:
+                exit(f"{panel} has no column {group_column} for sample {fields[0]}")
+            sample_groups[fields[0]] = fields[group_column]
+
+    return sample_groups
+
+
+
+def hap_class_ids(hap_m):
+    """
+    Finds the id of the distinct haplotype of each haplotype of a window, same grouping as _count_unique_haps in the scanners.
+
+    :param hap_m: each row is a site and each column is the haplotype at that site
+    :type hap_m: np.ndarray
+
+    :returns: distinct haplotype id of each haplotype, ids run from 0 to the number of distinct haplotypes - 1
+    :rtype: np.ndarray of int64
+    """
+
+    #packing the alleles of each haplotype into bytes, one row per haplotype
+    packed = np.packbits(np.asarray(hap_m, dtype=np.uint8).T, axis=1)
+    if packed.shape[1] == 0:
+        return np.zeros(len(packed), dtype=np.int64)
+
+    #uniquify, each packed row is viewed as a single bytes scalar
+    rows = np.ascontiguousarray(packed).view(np.dtype((np.void, packed.shape[1]))).ravel()
+
+    return np.unique(rows, return_inverse=True)[1].ravel().astype(np.int64)
+
+
+
+### CLASSES ###
+
+class HapGroups():
+    def __init__(self, samples, sample_groups, manifest_samples=None):
+        """
+        This class holds the group of each haplotype of a scan and counts the distinct haplotypes of each group.
+        The haplotypes are labelled on the first window, once the number of haplotypes per sample is known.
+        Samples that are not in the panel are only counted with all haplotypes.
+
+        :param samples: sample names in vcf column order
+        :type samples: list of str
+        :param sample_groups: group of each sample (see read_sample_groups)
+        :type sample_groups: dict of str: str
+        :param manifest_samples: samples of the scan if it only scans a manifest (see SampleView in hapmatrix.py), defaults to all samples
+        :type manifest_samples: list of str, optional
+
+        Attributes:
+            names (list of str): group names, sorted
+            labels (np.ndarray of int64 or None): group index of each haplotype of the scan, -1 if it is in no group
+        """
+
+        if manifest_samples is not None:
+            keep = set(manifest_samples)
+            samples = [sample for sample in samples if sample in keep]
+
+        self.names = sorted(set(sample_groups.values()))
+        self.labels = None
+        index = {name: g for g, name in enumerate(self.names)}
+        self._sample_labels = np.array([index.get(sample_groups.get(sample), -1) for sample in samples], dtype=np.int64)
+
+
+    def columns(self):
+        """
+        Output column names, distinct haplotypes and number of haplotypes of each group
+        """
+
+        return [column for name in self.names for column in [f"{name}_hapcount", f"{name}_sample_size"]]
+
+
+    def count(self, hap_ids):
+        """
+        Counts the distinct haplotypes and the haplotypes of each group in a window.
+
+        :param hap_ids: distinct haplotype id of each haplotype of the window (see hap_class_ids)
+        :type hap_ids: np.ndarray
+
+        :returns: distinct haplotypes and number of haplotypes of each group, in the order of columns
+        :rtype: list of int
+        """
+
+        if self.labels is None:
+            ploidy = len(hap_ids) // len(self._sample_labels)
+            self.labels = np.repeat(self._sample_labels, ploidy)
+
+        keep = self.labels >= 0
+        labels = self.labels[keep]
+        num_ids = int(hap_ids.max()) + 1 if len(hap_ids) > 0 else 1
+
+        #distinct (group, haplotype id) pairs
+        pairs = np.unique(labels * num_ids + hap_ids[keep])
+        hapcounts = np.bincount(pairs // num_ids, minlength=len(self.names))
+        sample_sizes = np.bincount(labels, minlength=len(self.names))
+
+        return [int(x) for pair in zip(hapcounts, sample_sizes) for x in pair]
@@ -0,0 +1,204 @@
+"""
+Incremental counting of unique haplotypes in sliding SNP windows.
+
+_count_unique_haps transposes every window and sorts its haplotypes with np.unique(axis=0), although
+consecutive windows share all but a step of their sites. RollingHapCounter instead keeps a 128-bit hash
+of every haplotype over the sites of the current window:
+
+    hash(haplotype) = sum of allele(site) * weight(site) over the sites of the window, mod 2^64, twice
+
+where each site has two random 64-bit weights drawn from its index on the chromosome (splitmix64 of the index).
+Sliding the window subtracts the weights of the sites that leave and adds the weights of the sites that enter,
+a (step x haplotypes) product, and the unique haplotypes are counted as the distinct hashes of the haplotypes.
+
+Two different haplotypes get the same hash with probability about 2^-128, so the counts match np.unique.
+With verify=True every haplotype is also compared to the first haplotype with the same hash, a single pass
+over the window with no sorting, and the window is counted exactly with np.unique if any of them differs.
+"""
+
+import numpy as np
+from window_buffer import WindowBuffer
+from hap_groups import hap_class_ids
+
+
+### HELPER FUNCTIONS ###
+
+def _splitmix64(x):
+    """
+    Helper mixes an array of uint64 into random looking uint64, the arithmetic wraps around mod 2^64
+    """
+
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return x ^ (x >> np.uint64(31))
+
+
+
+def site_weights(start, end):
+    """
+    Finds the two hash weights of each site for a range of sites.
+
+    :param start: first site index
+    :type start: int
+    :param end: last site index (exclusive)
+    :type end: int
+
+    :returns: weights, one row per site
+    :rtype: np.ndarray of uint64, shape (end - start, 2)
+    """
+
+    idx = np.arange(start, end, dtype=np.uint64)
+
+    return np.stack([_splitmix64(2 * idx), _splitmix64(2 * idx + np.uint64(1))], axis=1)
+
+
+
+def block_hashes(hap_m, start, block_rows=256):
+    """
+    Sums the hash weights of a block of sites for each haplotype.
+
+    :param hap_m: each row is a site and each column is the haplotype at that site
+    :type hap_m: np.ndarray
+    :param start: site index of the first row
+    :type start: int
+    :param block_rows: number of sites cast to uint64 at a time, defaults to 256
+    :type block_rows: int, optional
+
+    :returns: hash contribution of the block for each haplotype
+    :rtype: np.ndarray of uint64, shape (num_haplotypes, 2)
+    """
+
+    hashes = np.zeros((hap_m.shape[1], 2), dtype=np.uint64)
+    weights = site_weights(start, start + len(hap_m))
+
+    for i in range(0, len(hap_m), block_rows):
+        hashes += hap_m[i:i + block_rows].T.astype(np.uint64) @ weights[i:i + block_rows]
+
+    return hashes
+
+
+
+### CLASSES ###
+
+class RollingHapCounter():
+    def __init__(self, verify=False):
+        """
+        This class counts the unique haplotypes of SNP windows that slide forward along a chromosome,
+        updating the haplotype hashes by the sites that leave and enter the window.
+        The sites of the current window are kept bit-packed so the sites that leave can be subtracted
+        after they are dropped from the scan's sliding window.
+
+        :param verify: compare the haplotypes sharing a hash and count the window exactly on a collision, defaults to False
+        :type verify: bool, optional
+
+        Attributes:
+            lo (int): index of the first site of the current window
+            hi (int): index of the last site of the current window (exclusive)
+            collisions (int): number of windows where a hash collision was found by verify
+        """
+
+        self.verify = verify
+        self.lo = 0
+        self.hi = 0
+        self.collisions = 0
+        self._hashes = None
+        self._num_haps = None
+        self._packed = WindowBuffer()
+
+
+    def _reset(self, lo):
+        """
+        Empties the window, e.g. when the next window does not overlap the current one
+        """
+
+        self.lo = lo
+        self.hi = lo
+        self._hashes[:] = 0
+        self._packed.clear()
+        self._packed.first = lo
+
+
+    def _drop(self, lo):
+        """
+        Subtracts the sites before lo from the hashes
+        """
+
+        if lo >= self.hi:
+            self._reset(lo)
+            return
+
+        leaving = np.unpackbits(self._packed.sites(self.lo, lo), axis=1, count=self._num_haps)
+        self._hashes -= block_hashes(leaving, self.lo)
+        self._packed.pop(lo - self.lo)
+        self.lo = lo
+
+
+    def _slide(self, hap_m, lo, hi):
+        """
+        Updates the hashes to the haplotypes of the window [lo, hi)
+        """
+
+        if self._hashes is None:
+            self._num_haps = hap_m.shape[1]
+            self._hashes = np.zeros((self._num_haps, 2), dtype=np.uint64)
+            self._reset(lo)
+
+        if lo < self.lo or hi < self.hi:
+            exit("Windows have to slide forward to be counted incrementally")
+
+        #sites leaving the window
+        if lo > self.lo:
+            self._drop(lo)
+
+        #sites entering the window
+        entering = hap_m[self.hi - lo:]
+        self._hashes += block_hashes(entering, self.hi)
+        for row in np.packbits(entering, axis=1):
+            self._packed.append(0, row)
+        self.hi = hi
+
+
+    def count(self, hap_m, lo, hi, return_counts=False, return_ids=False):
+        """
+        Counts the unique haplotypes of the next window. Windows have to be counted in order, each starting
+        at or after the start and ending at or after the end of the previous window.
+
+        :param hap_m: haplotypes of the window, each row is a site and each column is the haplotype at that site
+        :type hap_m: np.ndarray
+        :param lo: index of the first site of the window
+        :type lo: int
+        :param hi: index of the last site of the window (exclusive)
+        :type hi: int
+        :param return_counts: also return the number of copies of each distinct haplotype (see hap_spectrum.py), defaults to False
+        :type return_counts: bool, optional
+        :param return_ids: also return the distinct haplotype id of each haplotype (see hap_groups.py), defaults to False
+        :type return_ids: bool, optional
+
+        :returns: number of unique haplotypes and total number of haplotypes (sample size) in the window, then the copies of each
+            distinct haplotype if return_counts and the id of each haplotype if return_ids
+        :rtype: int, int (, np.ndarray of int64) (, np.ndarray of int64)
+        """
+
+        self._slide(hap_m, lo, hi)
+
+        #counting distinct hashes
+        keys = np.ascontiguousarray(self._hashes).view(np.dtype((np.void, 16))).ravel()
+        uniq_keys, first_idx, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+        num_uniq_haps = len(uniq_keys)
+
+        #every haplotype should equal the first haplotype with its hash
+        if self.verify and (hap_m != hap_m[:, first_idx[inverse.ravel()]]).any():
+            self.collisions += 1
+            inverse = hap_class_ids(hap_m)
+            counts = np.bincount(inverse)
+            num_uniq_haps = len(counts)
+
+        result = (num_uniq_haps, self._num_haps)
+        if return_counts:
+            result += (counts,)
+        if return_ids:
+            result += (inverse.ravel().astype(np.int64),)
+
+        return result
@@ -0,0 +1,227 @@
+"""
+Approximate counting of unique haplotypes in sliding SNP windows, for cohorts where an exact count per window
+gets expensive.
+
+Each haplotype's window hash (the 128-bit rolling hash kept by RollingHapCounter, see hap_hash.py) is mixed down to
+64 bits and added to a sketch of the distinct hashes, block_haps haplotypes at a time. The size of the sketch is set
+by the relative error only, so counting the distinct hashes takes the same memory for any number of samples. The
+counter itself still keeps the rolling hashes, a (haplotypes, 2) uint64 array, and the bit-packed window like
+RollingHapCounter, so its memory grows with the number of samples as the exact counter's does; the sketch replaces the
+sort of the hashes that an exact count needs. Estimates are capped at the number of haplotypes of the window:
+
+    KMV     k minimum values, keeps the k smallest distinct hashes. Exact below k distinct haplotypes, otherwise the
+            estimate is (k - 1) / u_k with u_k the k-th smallest hash over 2^64, relative standard error 1 / sqrt(k - 2)
+    HLL     HyperLogLog (Flajolet et al. 2007), m = 2^p registers each holding the largest rank (leading zeros + 1) of
+            the hashes routed to it, relative standard error 1.04 / sqrt(m), linear counting for small counts
+
+The relative standard error of each window's estimate is written next to the count (0 when KMV is exact).
+"""
+
+import numpy as np
+from hap_hash import RollingHapCounter, _splitmix64
+
+
+### HELPER FUNCTIONS ###
+
+def mix_hashes(hashes):
+    """
+    Mixes the two 64-bit words of each haplotype hash into one uniform 64-bit hash.
+
+    :param hashes: haplotype hashes, one row per haplotype
+    :type hashes: np.ndarray of uint64, shape (num_haplotypes, 2)
+
+    :returns: 64-bit hash of each haplotype
+    :rtype: np.ndarray of uint64
+    """
+
+    return _splitmix64(hashes[:, 0] ^ _splitmix64(hashes[:, 1]))
+
+
+
+def _bit_length(x):
+    """
+    Helper finds the number of bits of each uint64, exact since each 32-bit half is exact as a float64
+    """
+
+    high = np.frexp((x >> np.uint64(32)).astype(np.float64))[1]
+    low = np.frexp((x & np.uint64(0xFFFFFFFF)).astype(np.float64))[1]
+
+    return np.where(high > 0, high + 32, low)
+
+
+
+def new_sketch(rel_error, method="kmv"):
+    """
+    Makes an empty sketch with a relative standard error of at most rel_error.
+
+    :param rel_error: relative standard error of the estimates e.g. 0.01
+    :type rel_error: float
+    :param method: "kmv" or "hll", defaults to "kmv"
+    :type method: str, optional
+
+    :returns: empty sketch
+    :rtype: KMVSketch or HLLSketch
+    """
+
+    if rel_error <= 0:
+        exit("The relative error of a sketch has to be positive")
+
+    if method == "kmv":
+        return KMVSketch(int(np.ceil(1 / rel_error ** 2)) + 2)
+    elif method == "hll":
+        return HLLSketch(int(min(max(np.ceil(np.log2((1.04 / rel_error) ** 2)), 4), 18)))
+
+    exit(f"Unknown sketch {method}, use kmv or hll")
+
+
+
+### CLASSES ###
+
+class KMVSketch():
+    def __init__(self, k):
+        """
+        This class keeps the k smallest distinct 64-bit hashes added to it.
+
+        :param k: number of hashes kept
+        :type k: int
+
+        Attributes:
+            k (int): number of hashes kept
+            values (np.ndarray of uint64): smallest distinct hashes added so far, sorted
+        """
+
+        self.k = k
+        self.values = np.empty(0, dtype=np.uint64)
+
+
+    def add(self, hashes):
+        """
+        Adds a block of hashes
+        """
+
+        #hashes above the k-th smallest cannot make it into the sketch
+        if len(self.values) == self.k:
+            hashes = hashes[hashes < self.values[-1]]
+
+        self.values = np.unique(np.concatenate([self.values, hashes]))[:self.k]
+
+
+    def estimate(self):
+        """
+        Estimates the number of distinct hashes added.
+
+        :returns: estimated count and its relative standard error
+        :rtype: float, float
+        """
+
+        if len(self.values) < self.k:
+            return float(len(self.values)), 0.0
+
+        u_k = (float(self.values[-1]) + 1) / 2 ** 64
+
+        return (self.k - 1) / u_k, 1 / np.sqrt(self.k - 2)
+
+
+
+class HLLSketch():
+    def __init__(self, p):
+        """
+        This class is a HyperLogLog sketch of 64-bit hashes, the first p bits of a hash pick its register.
+
+        :param p: number of index bits, 2^p registers
+        :type p: int
+
+        Attributes:
+            p (int): number of index bits
+            m (int): number of registers
+            registers (np.ndarray of uint8): largest rank routed to each register
+        """
+
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+
+
+    def add(self, hashes):
+        """
+        Adds a block of hashes
+        """
+
+        idx = (hashes >> np.uint64(64 - self.p)).astype(np.intp)
+        rest = hashes << np.uint64(self.p)
+        rank = np.minimum(64 - _bit_length(rest), 64 - self.p) + 1
+
+        np.maximum.at(self.registers, idx, rank.astype(np.uint8))
+
+
+    def estimate(self):
+        """
+        Estimates the number of distinct hashes added.
+
+        :returns: estimated count and its relative standard error
+        :rtype: float, float
+        """
+
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(self.m, 0.7213 / (1 + 1.079 / self.m))
+        est = alpha * self.m ** 2 / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+
+        #linear counting while registers are still empty
+        num_zero = int(np.count_nonzero(self.registers == 0))
+        if est <= 2.5 * self.m and num_zero > 0:
+            est = self.m * np.log(self.m / num_zero)
+
+        return float(est), 1.04 / np.sqrt(self.m)
+
+
+
+class SketchHapCounter(RollingHapCounter):
+    def __init__(self, rel_error=0.01, method="kmv", block_haps=65536):
+        """
+        This class estimates the number of unique haplotypes of SNP windows that slide forward along a chromosome.
+        The haplotype hashes are updated like RollingHapCounter and their distinct values are counted with a sketch.
+
+        :param rel_error: relative standard error of the estimates, defaults to 0.01
+        :type rel_error: float, optional
+        :param method: "kmv" or "hll", defaults to "kmv"
+        :type method: str, optional
+        :param block_haps: number of haplotype hashes added to the sketch at a time, defaults to 65536
+        :type block_haps: int, optional
+
+        Attributes:
+            lo (int): index of the first site of the current window
+            hi (int): index of the last site of the current window (exclusive)
+            error (float): relative standard error of the last estimate
+        """
+
+        super().__init__()
+        self.rel_error = rel_error
+        self.method = method
+        self.block_haps = block_haps
+        self.error = 0.0
+
+
+    def count(self, hap_m, lo, hi):
+        """
+        Estimates the unique haplotypes of the next window, same use as RollingHapCounter.count.
+
+        :param hap_m: haplotypes of the window, each row is a site and each column is the haplotype at that site
+        :type hap_m: np.ndarray
+        :param lo: index of the first site of the window
+        :type lo: int
+        :param hi: index of the last site of the window (exclusive)
+        :type hi: int
+
+        :returns: estimated number of unique haplotypes and total number of haplotypes (sample size) in the window
+        :rtype: int, int
+        """
+
+        self._slide(hap_m, lo, hi)
+
+        sketch = new_sketch(self.rel_error, self.method)
+        for i in range(0, self._num_haps, self.block_haps):
+            sketch.add(mix_hashes(self._hashes[i:i + self.block_haps]))
+
+        est, self.error = sketch.estimate()
+
+        #a window cannot hold more distinct haplotypes than haplotypes
+        return min(int(round(est)), self._num_haps), self._num_haps
@@ -0,0 +1,140 @@
+"""
+Haplotype frequency spectrum of a window and the statistics derived from it.
+
+The spectrum of a window is the number of copies of each distinct haplotype, sorted from the most to the least
+frequent. It comes out of the grouping step that counts the unique haplotypes, so it costs almost nothing more:
+    unique_hap_counts       np.unique(return_counts=True) on the bit-packed haplotypes viewed as byte scalars
+    RollingHapCounter       counts of each distinct haplotype hash (hap_hash.py)
+    PBWT                    sizes of the runs of identical haplotypes in prefix order (pbwt.py)
+
+With p_i the frequency of the i-th most frequent haplotype and n the sample size, the statistics are:
+    hap_diversity   n / (n - 1) * (1 - sum p_i^2), Nei's unbiased haplotype diversity
+    hap_entropy     -sum p_i * ln(p_i), Shannon entropy in nats
+    H1              sum p_i^2, haplotype homozygosity
+    H12             (p_1 + p_2)^2 + sum_{i > 2} p_i^2, Garud et al. 2015
+    H2_H1           (H1 - p_1^2) / H1, Garud et al. 2015
+    top{k}_freq     p_k for the k most frequent haplotypes, 0 if there are fewer than k
+    hap_spectrum    the spectrum itself, run-length encoded e.g. "812;40;3*2;1*97" is 812, 40, 3, 3 and 97 singletons
+"""
+
+import numpy as np
+
+
+### HELPER FUNCTIONS ###
+
+def unique_hap_counts(hap_m):
+    """
+    Counts the copies of each distinct haplotype of a window, same grouping as _count_unique_haps in the scanners.
+
+    :param hap_m: each row is a site and each column is the haplotype at that site
+    :type hap_m: np.ndarray
+
+    :returns: number of copies of each distinct haplotype, in no particular order
+    :rtype: np.ndarray of int64
+    """
+
+    #packing the alleles of each haplotype into bytes, one row per haplotype
+    packed = np.packbits(np.asarray(hap_m, dtype=np.uint8).T, axis=1)
+    if packed.shape[1] == 0:
+        return np.array([len(packed)] if len(packed) > 0 else [], dtype=np.int64)
+
+    #uniquify, each packed row is viewed as a single bytes scalar
+    rows = np.ascontiguousarray(packed).view(np.dtype((np.void, packed.shape[1]))).ravel()
+
+    return np.unique(rows, return_counts=True)[1].astype(np.int64)
+
+
+
+def encode_spectrum(counts):
+    """
+    Run-length encodes a spectrum as text, see the module docstring.
+
+    :param counts: number of copies of each distinct haplotype
+    :type counts: np.ndarray
+
+    :returns: encoded spectrum, runs separated by ";"
+    :rtype: str
+    """
+
+    counts = np.sort(np.asarray(counts, dtype=np.int64))[::-1]
+    if len(counts) == 0:
+        return ""
+
+    #start of each run of equal counts
+    starts = np.flatnonzero(np.concatenate([[True], counts[1:] != counts[:-1]]))
+    reps = np.diff(np.append(starts, len(counts)))
+
+    return ";".join([str(c) if r == 1 else f"{c}*{r}" for c, r in zip(counts[starts], reps)])
+
+
+
+def decode_spectrum(encoded):
+    """
+    Decodes a spectrum written by encode_spectrum.
+
+    :param encoded: encoded spectrum
+    :type encoded: str
+
+    :returns: number of copies of each distinct haplotype, from the most to the least frequent
+    :rtype: np.ndarray of int64
+    """
+
+    counts = []
+    for run in str(encoded).split(";"):
+        if run == "" or run == "nan":
+            continue
+        count, _, reps = run.partition("*")
+        counts += [int(count)] * (int(reps) if reps else 1)
+
+    return np.array(counts, dtype=np.int64)
+
+
+
+def spectrum_columns(top_k=3):
+    """
+    Column names of the statistics returned by spectrum_stats.
+
+    :param top_k: number of most frequent haplotype frequencies, defaults to 3
+    :type top_k: int, optional
+
+    :returns: column names
+    :rtype: list of str
+    """
+
+    return ["hap_diversity", "hap_entropy", "H1", "H12", "H2_H1"] + [f"top{k + 1}_freq" for k in range(top_k)] + ["hap_spectrum"]
+
+
+
+def spectrum_stats(counts, top_k=3):
+    """
+    Computes the haplotype frequency spectrum statistics of a window, see the module docstring.
+
+    :param counts: number of copies of each distinct haplotype
+    :type counts: np.ndarray
+    :param top_k: number of most frequent haplotype frequencies, defaults to 3
+    :type top_k: int, optional
+
+    :returns: statistics in the order of spectrum_columns
+    :rtype: list
+    """
+
+    counts = np.sort(np.asarray(counts, dtype=np.int64))[::-1]
+    sample_size = int(counts.sum())
+    if sample_size == 0:
+        return [0, 0, 0, 0, 0] + [0] * top_k + [""]
+
+    freqs = counts / sample_size
+    sq = freqs ** 2
+
+    #homozygosity and diversity
+    h1 = float(sq.sum())
+    diversity = sample_size / (sample_size - 1) * (1 - h1) if sample_size > 1 else 0.0
+    entropy = float((freqs * np.log(1 / freqs)).sum())
+
+    #Garud's H12 pools the two most frequent haplotypes
+    h12 = h1 + 2 * freqs[0] * freqs[1] if len(freqs) > 1 else h1
+    h2_h1 = (h1 - sq[0]) / h1
+
+    top = [float(freqs[k]) if k < len(freqs) else 0 for k in range(top_k)]
+
+    return [float(diversity), entropy, h1, float(h12), float(h2_h1)] + top + [encode_spectrum(counts)]
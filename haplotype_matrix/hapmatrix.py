@@ -0,0 +1,506 @@
+"""
+This script converts a phased vcf of biallelic SNPs for a single chromosome into a bit-packed
+haplotype matrix on disk (1 bit per allele, sites x haplotypes) plus a positions array. The
+conversion only needs to be run once per chromosome. The scanners then read the matrix through
+np.memmap instead of decompressing and text-parsing the vcf on every scan.
+
+Files written next to the vcf (prefix is the vcf name without .vcf.gz):
+    prefix.hapmatrix        raw bit-packed matrix, one row of ceil(num_haps / 8) bytes per site
+    prefix.positions.npy    int64 array of site positions (also cached on its own by load_positions)
+    prefix.samples.txt      sample names in vcf column order
+    prefix.hapmatrix.txt    chromosome, number of sites, number of haplotypes and ploidy
+"""
+
+import os
+import numpy as np
+from multiprocessing import Pool
+from gt_parser import parse_record, parse_position
+from bgzf_reader import bgzf_open
+
+
+### HELPER FUNCTIONS ###
+
+def _hapmatrix_prefix(vcfgz):
+    """
+    Helper function that returns the file prefix for the haplotype matrix files of a vcf
+    """
+
+    return vcfgz.replace(".vcf.gz", "")
+
+
+
+def hapmatrix_exists(vcfgz):
+    """
+    Checks if the haplotype matrix has been built for a vcf.
+    The metadata file is written last so a partially converted matrix is not picked up.
+    """
+
+    return os.path.exists(_hapmatrix_prefix(vcfgz) + ".hapmatrix.txt")
+
+
+
+def snp_window_bounds(num_sites, window_size, window_step):
+    """
+    Finds the site index bounds of every SNP window in the same order that the SNP window
+    scanners output them. The last window holds the sites left over after the last full window.
+
+    :param num_sites: number of sites on the chromosome
+    :type num_sites: int
+    :param window_size: number of SNPs defining the window size
+    :type window_size: int
+    :param window_step: number of SNPs to slide window
+    :type window_step: int
+
+    :returns: [first_site, last_site) index pairs for each window
+    :rtype: list of (int, int)
+    """
+
+    bounds = []
+
+    #full windows
+    lo = 0
+    while lo + window_size <= num_sites:
+        bounds.append((lo, lo + window_size))
+        lo += window_step
+
+    #left over window
+    if lo < num_sites:
+        bounds.append((lo, num_sites))
+
+    return bounds
+
+
+
+def bp_window_bounds(positions, window_size, window_step):
+    """
+    Finds the site index bounds of every bp window in the same order that the bp window scanners
+    output them, including the empty windows. The scanners pop sites up to the start of the next window
+    (inclusive) once a window is done, so this is the lower bound used for each window after the first.
+    The last window is the one holding the last site.
+
+    :param positions: sorted site positions
+    :type positions: np.ndarray of int64
+    :param window_size: number of bps defining the window size
+    :type window_size: int
+    :param window_step: number of bps to slide window
+    :type window_step: int
+
+    :returns: window starts, window ends, first site index and last site index (exclusive) for each window
+    :rtype: np.ndarray, np.ndarray, np.ndarray, np.ndarray
+    """
+
+    #number of windows up to the window holding the last site
+    if len(positions) == 0:
+        num_windows = 0
+    elif positions[-1] <= window_size:
+        num_windows = 1
+    else:
+        num_windows = int(-(-(positions[-1] - window_size) // window_step)) + 1
+
+    #window grid
+    k = np.arange(num_windows, dtype=np.int64)
+    win_ends = window_size + k * window_step
+    win_starts = win_ends - window_size + 1
+    win_starts[:1] = 1
+
+    #sites popped after each window are those up to the next window start (the first pop stops one bp short)
+    pop_to = win_starts + window_step
+    pop_to[:1] = window_step
+    lower = np.zeros(num_windows, dtype=np.int64)
+    lower[1:] = np.minimum(pop_to[:-1], win_ends[:-1])
+
+    #site index bounds
+    lo = np.searchsorted(positions, lower, side="right")
+    hi = np.searchsorted(positions, win_ends, side="right")
+
+    return win_starts, win_ends, lo, hi
+
+
+
+def write_empty_windows(outfile, chrom, win_starts, win_ends, fill, sep=",", chunk_size=100000):
+    """
+    Writes the output lines of a run of empty bp windows in vectorized blocks, so that
+    gaps such as centromeres are not written one window at a time.
+
+    :param outfile: open output file
+    :type outfile: file
+    :param chrom: chromosome name for the output
+    :type chrom: str
+    :param win_starts: start positions of the empty windows
+    :type win_starts: np.ndarray of int64
+    :param win_ends: end positions of the empty windows
+    :type win_ends: np.ndarray of int64
+    :param fill: columns written after the window end for an empty window e.g. "0,0"
+    :type fill: str
+    :param sep: column separator
+    :type sep: str, optional
+    :param chunk_size: number of lines built at once, bounds the memory of long gaps
+    :type chunk_size: int, optional
+    """
+
+    for i in range(0, len(win_starts), chunk_size):
+        lines = np.char.add(chrom + sep, np.asarray(win_starts[i:i + chunk_size]).astype(str))
+        lines = np.char.add(np.char.add(lines, sep), np.asarray(win_ends[i:i + chunk_size]).astype(str))
+        lines = np.char.add(lines, sep + fill + "\n")
+        outfile.write("".join(lines))
+
+
+
+def load_positions(vcfgz, decompress_threads=1):
+    """
+    Loads the site positions of a vcf. The positions are read from the vcf the first time
+    and cached in prefix.positions.npy (the same file vcf2hapmatrix writes) so that the
+    window bounds of a chromosome can be planned without reading the genotypes.
+
+    :param vcfgz: gziped vcf file name or path to file
+    :type vcfgz: str
+    :param decompress_threads: number of threads inflating the BGZF blocks of the vcf
+    :type decompress_threads: int, optional
+
+    :returns: sorted site positions
+    :rtype: np.ndarray of int64
+    """
+
+    positions_file = _hapmatrix_prefix(vcfgz) + ".positions.npy"
+    if os.path.exists(positions_file):
+        return np.load(positions_file)
+
+    #only the POS column is parsed
+    positions = []
+    with bgzf_open(vcfgz, "rb", threads=decompress_threads) as vcf:
+        for line in vcf:
+            if line.startswith(b"#"):
+                continue
+            positions.append(parse_position(line))
+    positions = np.array(positions, dtype=np.int64)
+
+    #written under a temporary name first so a partly written cache is never loaded
+    with open(positions_file + ".tmp", "wb") as cachefile:
+        np.save(cachefile, positions)
+    os.replace(positions_file + ".tmp", positions_file)
+
+    return positions
+
+
+
+def vcf_samples(vcfgz):
+    """
+    Reads the sample names of a vcf in column order, from prefix.samples.txt if the
+    haplotype matrix was built, otherwise from the #CHROM header line of the vcf.
+
+    :param vcfgz: gziped vcf file name or path to file
+    :type vcfgz: str
+
+    :returns: sample names in vcf column order
+    :rtype: list of str
+    """
+
+    if hapmatrix_exists(vcfgz):
+        with open(_hapmatrix_prefix(vcfgz) + ".samples.txt", "r") as samplefile:
+            return [x.strip() for x in samplefile]
+
+    with bgzf_open(vcfgz, "rb") as vcf:
+        for line in vcf:
+            if line.startswith(b"#CHROM"):
+                return line.decode().strip().split("\t")[9:]
+
+    exit(f"{vcfgz} has no #CHROM header line")
+
+
+
+def read_sample_manifest(manifest):
+    """
+    Reads a sample manifest: one sample name per line in the first column, so panel files such as
+    "sample pop super_pop gender" can be used as is. Blank lines, lines starting with # and a header line starting with "sample" are skipped.
+
+    :param manifest: manifest file name or path to file
+    :type manifest: str
+
+    :returns: sample names of the manifest
+    :rtype: list of str
+    """
+
+    manifest_samples = []
+    with open(manifest, "r") as manifestfile:
+        for line in manifestfile:
+            if line.strip() == "" or line.startswith("#") or line.split()[0].lower() == "sample":
+                continue
+            manifest_samples.append(line.split()[0])
+
+    return manifest_samples
+
+
+
+def manifest_haplotypes(samples, manifest_samples, ploidy):
+    """
+    Finds the haplotype columns of the manifest samples in the haplotype rows of a vcf, in vcf column order.
+    When the samples are one contiguous run of columns a slice is returned so that windows are selected as a view.
+
+    :param samples: sample names in vcf column order
+    :type samples: list of str
+    :param manifest_samples: sample names to keep
+    :type manifest_samples: list of str
+    :param ploidy: number of haplotypes per sample
+    :type ploidy: int
+
+    :returns: haplotype columns of the manifest samples
+    :rtype: np.ndarray of int64 or slice
+    """
+
+    missing = set(manifest_samples) - set(samples)
+    if len(missing) > 0:
+        exit(f"{len(missing)} manifest samples are not in the vcf e.g. {sorted(missing)[0]}")
+
+    keep = set(manifest_samples)
+    sample_idx = np.array([i for i, sample in enumerate(samples) if sample in keep], dtype=np.int64)
+    haplotypes = (sample_idx[:, None] * ploidy + np.arange(ploidy, dtype=np.int64)).ravel()
+
+    #contiguous run of columns
+    if len(haplotypes) > 0 and haplotypes[-1] - haplotypes[0] == len(haplotypes) - 1:
+        return slice(int(haplotypes[0]), int(haplotypes[-1]) + 1)
+
+    return haplotypes
+
+
+
+def manifest_tag(manifest):
+    """
+    Returns the output file name tag of a sample manifest ("" without a manifest) so that
+    the scans of different subsets of a vcf do not write to the same files
+    """
+
+    if manifest is None:
+        return ""
+
+    return "_" + os.path.splitext(os.path.basename(manifest))[0]
+
+
+
+### CLASSES ###
+
+class SampleView():
+    def __init__(self, hapsites, samples, manifest_samples):
+        """
+        This class selects the haplotype columns of a subset of samples from the sites of a scan,
+        so that superpopulation, sex or bootstrap subsets are scanned from the shared haplotype matrix
+        (or vcf stream) without writing a vcf per subset. The columns are found on the first window,
+        once the number of haplotypes per site is known.
+
+        :param hapsites: sites to select the haplotypes from
+        :type hapsites: HapMatrix or WindowBuffer or ShardSites
+        :param samples: sample names in vcf column order
+        :type samples: list of str
+        :param manifest_samples: sample names to keep (see read_sample_manifest)
+        :type manifest_samples: list of str
+
+        Attributes:
+            hapsites (HapMatrix or WindowBuffer or ShardSites): sites to select the haplotypes from
+            haplotypes (np.ndarray or slice or None): haplotype columns of the manifest samples
+        """
+
+        self.hapsites = hapsites
+        self.haplotypes = None
+        self._samples = samples
+        self._manifest_samples = manifest_samples
+
+
+    def sites(self, start, end):
+        """
+        Returns the haplotypes of the manifest samples for a range of sites, same layout as HapMatrix.sites
+        """
+
+        hap_m = self.hapsites.sites(start, end)
+
+        if self.haplotypes is None:
+            ploidy = hap_m.shape[1] // len(self._samples)
+            self.haplotypes = manifest_haplotypes(self._samples, self._manifest_samples, ploidy)
+
+        return hap_m[:, self.haplotypes]
+
+
+    def site_positions(self, start, end):
+        """
+        Returns the positions for a range of sites
+        """
+
+        return self.hapsites.site_positions(start, end)
+
+
+
+class HapMatrix():
+    def __init__(self, vcfgz):
+        """
+        This class opens the bit-packed haplotype matrix built by `vcf2hapmatrix` for a vcf.
+        The packed matrix is read through np.memmap so only the windows being scanned are paged in.
+
+        :param vcfgz: gziped vcf file name or path to file that the matrix was built from
+        :type vcfgz: str
+
+        Attributes:
+            chrom (str): chromosome from the vcf CHROM column
+            num_sites (int): number of sites
+            num_haps (int): number of haplotypes (columns)
+            ploidy (int): number of haplotypes per sample
+            positions (np.ndarray of int64): site positions
+            samples (list of str): sample names in vcf column order
+            packed (np.memmap of uint8): bit-packed matrix, one row per site
+        """
+
+        prefix = _hapmatrix_prefix(vcfgz)
+
+        #metadata
+        meta = {}
+        with open(prefix + ".hapmatrix.txt", "r") as metafile:
+            for line in metafile:
+                key, value = line.strip().split("\t")
+                meta[key] = value
+
+        self.chrom = meta["chrom"]
+        self.num_sites = int(meta["num_sites"])
+        self.num_haps = int(meta["num_haps"])
+        self.ploidy = int(meta["ploidy"])
+
+        #positions and samples
+        self.positions = np.load(prefix + ".positions.npy")
+        with open(prefix + ".samples.txt", "r") as samplefile:
+            self.samples = [x.strip() for x in samplefile]
+
+        #packed matrix
+        bytes_per_site = (self.num_haps + 7) // 8
+        self.packed = np.memmap(prefix + ".hapmatrix", dtype=np.uint8, mode="r", shape=(self.num_sites, bytes_per_site))
+
+
+    def sites(self, start, end):
+        """
+        Unpacks the haplotypes for a range of sites.
+
+        :param start: first site index
+        :type start: int
+        :param end: last site index (exclusive)
+        :type end: int
+
+        :returns: each row is a site and each column is a haplotype, same layout as _construct_matrix
+        :rtype: np.ndarray of uint8
+        """
+
+        return np.unpackbits(self.packed[start:end], axis=1, count=self.num_haps)
+
+
+    def site_positions(self, start, end):
+        """
+        Returns the positions for a range of sites
+        """
+
+        return self.positions[start:end]
+
+
+
+### CONVERTER ###
+
+def vcf2hapmatrix(vcfgz, decompress_threads=1):
+    """
+    Function converts a gziped vcf into the bit-packed haplotype matrix files. See module docstring for the files written.
+
+    :param vcfgz: gziped vcf file name or path to file
+    :type vcfgz: str
+    :param decompress_threads: number of threads inflating the BGZF blocks of the vcf
+    :type decompress_threads: int, optional
+
+    :returns: writes haplotype matrix files next to the vcf
+    :rtype: None
+    """
+
+    print(f"Building haplotype matrix for {vcfgz}...")
+
+    prefix = _hapmatrix_prefix(vcfgz)
+
+    #book keeping
+    positions = []
+    chrom = None
+    num_haps = None
+    ploidy = None
+
+    with bgzf_open(vcfgz, "rb", threads=decompress_threads) as vcf, open(prefix + ".hapmatrix", "wb") as matfile:
+
+        #loop through lines
+        for line in vcf:
+
+            #skip meta lines
+            if line.startswith(b"##"):
+                continue
+
+            #grab sample names
+            elif line.startswith(b"#CHROM"):
+                samples = line.decode().strip().split("\t")[9:]
+                continue
+
+            #records
+            position, haps = parse_record(line)
+
+            #setting up on the first record
+            if chrom is None:
+                chrom = line[:line.index(b"\t")].decode()
+                num_haps = len(haps)
+                ploidy = num_haps // len(samples)
+
+            if len(haps) != num_haps:
+                exit(f"Record at {position} does not have {num_haps} phased haplotypes")
+
+            #write packed row
+            matfile.write(np.packbits(haps).tobytes())
+            positions.append(position)
+
+    #positions and samples
+    np.save(prefix + ".positions.npy", np.array(positions, dtype=np.int64))
+    with open(prefix + ".samples.txt", "w") as samplefile:
+        samplefile.write("\n".join(samples) + "\n")
+
+    #metadata is written last so that hapmatrix_exists only sees finished conversions
+    with open(prefix + ".hapmatrix.txt", "w") as metafile:
+        metafile.write(f"chrom\t{chrom}\n")
+        metafile.write(f"num_sites\t{len(positions)}\n")
+        metafile.write(f"num_haps\t{num_haps}\n")
+        metafile.write(f"ploidy\t{ploidy}\n")
+
+    print(f"FINISHED building haplotype matrix for {vcfgz}")
+
+
+
+### PARALLELIZATION ###
+
+def main():
+
+    vcflist = [
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr1.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr2.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr3.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr4.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr5.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr6.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr7.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr8.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr9.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr10.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr11.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr12.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr13.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr14.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr15.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr16.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr17.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr18.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr19.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr20.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr21.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr22.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_nonPAR_chrX.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_PAR_chrX.vcf.gz",
+        "beagle_imputed_males_biallelic_SNPs_1000GP30X_chrY.vcf.gz"
+        ]
+
+    pool = Pool(processes=25)
+    pool.map(vcf2hapmatrix, vcflist)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+"""
+Archive of the UPGMA trees of every window of a scan, read back window by window.
+
+The UPGMA scans only keep a few statistics of each tree, so a new branch statistic or a dendrogram of a window meant
+clustering its haplotypes again. With an archive the scans also store the linkage array of every window in one .npz
+per chromosome (the zip of .npy arrays that np.savez writes and np.load reads, like the window tables of
+window_table.py). The trees are buffered and written every chunk_windows windows as deflate compressed members: the
+cluster ids and sizes as int32 and the merge heights as float64, so the linkage read back is the same float64 array
+scipy's linkage returned. The window coordinates are written last, and LinkageArchive loads only them when it opens an
+archive: the windows holding a genomic position are found with a binary search and only the chunk of a requested tree
+is inflated, so a statistic or a plot of stored trees takes seconds instead of a scan.
+
+Members of a linkage archive .npz:
+    m.{chunk}       left cluster id, right cluster id and size of each merge of the windows of a chunk, int32, e.g. m.000002
+    h.{chunk}       merge heights of the windows of a chunk, float64
+    __chrom__       chromosome name
+    __start__       start position of each window, in window order
+    __end__         end position (exclusive) of each window
+    __chunks__      number of windows of each chunk, written last so a partly written archive is never loaded
+
+Every window of an archive has the same haplotypes, so the trees of a chunk are stacked in one array per member.
+"""
+
+import os
+import zipfile
+import numpy as np
+
+
+### HELPER FUNCTIONS ###
+
+def _write_member(zf, name, array):
+    """
+    Helper writes an array as a compressed .npy member of an open zip file
+    """
+
+    with zf.open(name + ".npy", "w", force_zip64=True) as member:
+        np.lib.format.write_array(member, np.asarray(array), allow_pickle=False)
+
+
+
+def _copy_member(source, out, name, new_name):
+    """
+    Helper copies a .npy member from one zip file to another under a new name
+    """
+
+    with source.open(name + ".npy", "r") as member, out.open(new_name + ".npy", "w", force_zip64=True) as copy:
+        while True:
+            block = member.read(1 << 20)
+            if not block:
+                break
+            copy.write(block)
+
+
+
+def archive_path(outfile):
+    """
+    Linkage archive written next to a scan output e.g. chr2_window1000_step500_avg_branch_len.csv -> chr2_window1000_step500_linkage.npz.
+
+    :param outfile: output file of the scan or of a shard of the scan
+    :type outfile: str
+
+    :returns: linkage archive file name
+    :rtype: str
+    """
+
+    stem = outfile[:-len(".csv")] if outfile.endswith(".csv") else outfile
+
+    return stem.replace("_avg_branch_len", "") + "_linkage.npz"
+
+
+
+### CLASSES ###
+
+class LinkageArchiveWriter():
+    def __init__(self, path, chrom, chunk_windows=16):
+        """
+        This class writes the linkage arrays of the windows of a scan to a linkage archive, see the module docstring for the layout.
+
+        :param path: archive file name or path to file, overwritten
+        :type path: str
+        :param chrom: chromosome name of the windows
+        :type chrom: str
+        :param chunk_windows: number of trees buffered before they are written as a chunk, defaults to 16
+            (about 2 MB of compressed trees per chunk for 6404 haplotypes)
+        :type chunk_windows: int, optional
+
+        Attributes:
+            num_windows (int): number of windows added so far
+        """
+
+        self.chrom = chrom
+        self.chunk_windows = chunk_windows
+        self.num_windows = 0
+        self._starts = []
+        self._ends = []
+        self._chunks = []
+        self._trees = []
+        self._zf = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+
+
+    def flush(self):
+        """
+        Writes the buffered trees as a chunk
+        """
+
+        if len(self._trees) == 0:
+            return
+
+        trees = np.stack(self._trees)
+        chunk = len(self._chunks)
+        _write_member(self._zf, f"m.{chunk:06d}", trees[:, :, [0, 1, 3]].astype(np.int32))
+        _write_member(self._zf, f"h.{chunk:06d}", trees[:, :, 2])
+        self._chunks.append(len(self._trees))
+        self._trees = []
+
+
+    def add(self, start_pos, end_pos, tree):
+        """
+        Buffers the tree of one window, windows are added in order.
+
+        :param start_pos: start position of the window
+        :type start_pos: int
+        :param end_pos: end position of the window, exclusive
+        :type end_pos: int
+        :param tree: linkage array of the window
+        :type tree: np.ndarray of float64
+        """
+
+        self._starts.append(start_pos)
+        self._ends.append(end_pos)
+        self._trees.append(tree)
+        self.num_windows += 1
+
+        if len(self._trees) >= self.chunk_windows:
+            self.flush()
+
+
+    def close(self):
+        """
+        Writes the last trees and the window coordinates
+        """
+
+        self.flush()
+        _write_member(self._zf, "__chrom__", np.array(self.chrom))
+        _write_member(self._zf, "__start__", np.array(self._starts, dtype=np.int64))
+        _write_member(self._zf, "__end__", np.array(self._ends, dtype=np.int64))
+        _write_member(self._zf, "__chunks__", np.array(self._chunks, dtype=np.int64))
+        self._zf.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+
+class LinkageArchive():
+    def __init__(self, path):
+        """
+        This class reads the trees of a linkage archive written by LinkageArchiveWriter. Only the window coordinates are
+        loaded when the archive is opened, the chunk of a tree is inflated when the tree is read and kept until a tree
+        of another chunk is read, so reading the windows in order inflates every chunk once.
+
+        :param path: linkage archive .npz file name or path to file
+        :type path: str
+
+        Attributes:
+            chrom (str): chromosome name of the windows
+            starts (np.ndarray of int64): start position of each window
+            ends (np.ndarray of int64): end position (exclusive) of each window
+        """
+
+        self.path = path
+        self._npz = np.load(path)
+
+        if "__chunks__" not in self._npz.files:
+            self._npz.close()
+            exit(f"{path} is not a finished linkage archive")
+
+        self.chrom = str(self._npz["__chrom__"])
+        self.starts = self._npz["__start__"]
+        self.ends = self._npz["__end__"]
+
+        #first window of each chunk
+        self._offsets = np.concatenate([[0], np.cumsum(self._npz["__chunks__"])]).astype(np.int64)
+        self._chunk = -1
+        self._merges = None
+        self._heights = None
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+    def find(self, position):
+        """
+        Finds the windows holding a genomic position.
+
+        :param position: genomic position
+        :type position: int
+
+        :returns: indices of the windows with start <= position < end, in order
+        :rtype: np.ndarray of int64
+        """
+
+        #starts and ends of sliding windows both grow with the window index
+        first = np.searchsorted(self.ends, position, side="right")
+        last = np.searchsorted(self.starts, position, side="right")
+
+        return np.arange(first, max(first, last), dtype=np.int64)
+
+
+    def overlapping(self, start, end):
+        """
+        Finds the windows overlapping a genomic interval.
+
+        :param start: start position of the interval
+        :type start: int
+        :param end: end position of the interval, exclusive
+        :type end: int
+
+        :returns: indices of the windows overlapping [start, end), in order
+        :rtype: np.ndarray of int64
+        """
+
+        first = np.searchsorted(self.ends, start, side="right")
+        last = np.searchsorted(self.starts, end, side="left")
+
+        return np.arange(first, max(first, last), dtype=np.int64)
+
+
+    def linkage(self, window):
+        """
+        Reads the tree of a window.
+
+        :param window: index of the window in the archive (see find and overlapping)
+        :type window: int
+
+        :returns: linkage array of the window, same as the one the scan computed
+        :rtype: np.ndarray of float64
+        """
+
+        if window < 0 or window >= len(self):
+            exit(f"window {window} is not in {self.path}, which has {len(self)} windows")
+
+        chunk = int(np.searchsorted(self._offsets, window, side="right")) - 1
+        if chunk != self._chunk:
+            self._merges = self._npz[f"m.{chunk:06d}"]
+            self._heights = self._npz[f"h.{chunk:06d}"]
+            self._chunk = chunk
+
+        i = window - self._offsets[chunk]
+        tree = np.empty((self._merges.shape[1], 4))
+        tree[:, [0, 1, 3]] = self._merges[i]
+        tree[:, 2] = self._heights[i]
+
+        return tree
+
+
+    def trees(self, windows=None):
+        """
+        Reads the trees of windows in order.
+
+        :param windows: indices of the windows, defaults to every window of the archive
+        :type windows: iterable of int, optional
+
+        :returns: start position, end position and linkage array of each window
+        :rtype: generator of (int, int, np.ndarray of float64)
+        """
+
+        if windows is None:
+            windows = range(len(self))
+
+        for window in windows:
+            yield int(self.starts[window]), int(self.ends[window]), self.linkage(window)
+
+
+    def close(self):
+        self._npz.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+### STITCHING ###
+
+def stitch_linkage_archives(paths, outfile):
+    """
+    Concatenates linkage archives in window order (e.g. the shard archives of a scan) by copying their chunks, then removes them.
+
+    :param paths: linkage archives in window order
+    :type paths: list of str
+    :param outfile: output linkage archive
+    :type outfile: str
+    """
+
+    chrom = ""
+    starts, ends, chunks = [], [], []
+    with zipfile.ZipFile(outfile, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as out:
+        for path in paths:
+            with np.load(path) as npz:
+                chrom = str(npz["__chrom__"])
+                starts.append(npz["__start__"])
+                ends.append(npz["__end__"])
+                shard_chunks = npz["__chunks__"]
+
+            #copying the members with renumbered chunks
+            with zipfile.ZipFile(path, "r") as shard:
+                for k in range(len(shard_chunks)):
+                    _copy_member(shard, out, f"m.{k:06d}", f"m.{len(chunks):06d}")
+                    _copy_member(shard, out, f"h.{k:06d}", f"h.{len(chunks):06d}")
+                    chunks.append(int(shard_chunks[k]))
+
+            os.remove(path)
+
+        _write_member(out, "__chrom__", np.array(chrom))
+        _write_member(out, "__start__", np.concatenate(starts) if len(starts) > 0 else np.array([], dtype=np.int64))
+        _write_member(out, "__end__", np.concatenate(ends) if len(ends) > 0 else np.array([], dtype=np.int64))
+        _write_member(out, "__chunks__", np.array(chunks, dtype=np.int64))
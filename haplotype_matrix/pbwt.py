@@ -0,0 +1,229 @@
+"""
+Positional Burrows-Wheeler transform (PBWT, Durbin 2014) of the haplotypes of a chromosome, used to count
+the distinct haplotypes of every window from a single sweep over the sites.
+
+After sweeping the sites [start, k) the PBWT holds:
+    prefix      haplotype indices sorted by their reversed haplotype up to site k
+    divergence  for each haplotype in prefix order, the site where its match with the previous haplotype starts,
+                k if they differ at the last site (the first haplotype always holds k)
+
+Haplotypes that are identical over the sites [lo, k) are neighbours in prefix order, and a haplotype starts a
+new group exactly when its match with the previous one starts after lo. The number of distinct haplotypes over
+[lo, k) is therefore the number of divergence values above lo, for any lo, so windows of every size and step
+ending at site k are all counted from the same arrays. Each site is added with a stable partition of the prefix
+order by allele and a segment max (np.maximum.reduceat) of the divergence, O(haplotypes) numpy work per site.
+"""
+
+import numpy as np
+
+
+class PBWT():
+    def __init__(self, start=0):
+        """
+        This class sweeps the sites of a chromosome in order and keeps the prefix and divergence arrays.
+        The arrays are allocated on the first site, once the number of haplotypes is known.
+        Alleles are expected to be 0 or 1 (biallelic SNPs).
+
+        :param start: site index of the first site of the sweep, defaults to 0
+        :type start: int, optional
+
+        Attributes:
+            start (int): site index of the first site of the sweep
+            k (int): number of sites swept plus start, the next site to add
+            prefix (np.ndarray of int64): haplotype indices in prefix order
+            divergence (np.ndarray of int64): divergence array in prefix order
+        """
+
+        self.start = start
+        self.k = start
+        self.prefix = None
+        self.divergence = None
+
+
+    def _restart(self, start, num_haps):
+        """
+        Starts the sweep over at a site, e.g. when the next window does not overlap the swept sites
+        """
+
+        self.start = start
+        self.k = start
+        self.prefix = np.arange(num_haps, dtype=np.int64)
+        self.divergence = np.full(num_haps, start, dtype=np.int64)
+
+
+    def update(self, hap_m):
+        """
+        Adds a block of sites to the sweep, in order.
+
+        :param hap_m: each row is a site and each column is the haplotype at that site
+        :type hap_m: np.ndarray
+        """
+
+        if len(hap_m) > 0 and self.prefix is None:
+            self._restart(self.k, hap_m.shape[1])
+
+        for row in hap_m:
+
+            #alleles in prefix order
+            alleles = row[self.prefix]
+            k1 = self.k + 1
+            groups = [np.flatnonzero(alleles == 0), np.flatnonzero(alleles != 0)]
+
+            #stable partition of the prefix order by allele
+            self.prefix = self.prefix[np.concatenate(groups)]
+
+            #the match of each haplotype with the previous haplotype of the same allele starts at the largest divergence between them
+            divergences = []
+            for idx in groups:
+                if len(idx) == 0:
+                    continue
+                group_div = np.empty(len(idx), dtype=np.int64)
+                group_div[0] = k1
+                if len(idx) > 1:
+                    group_div[1:] = np.maximum.reduceat(self.divergence[:idx[-1] + 1], idx[:-1] + 1)
+                divergences.append(group_div)
+
+            self.divergence = np.concatenate(divergences)
+            self.k = k1
+
+
+    def num_distinct(self, lo):
+        """
+        Counts the distinct haplotypes over the sites [lo, k).
+
+        :param lo: index of the first site of the window, at or after the start of the sweep
+        :type lo: int
+
+        :returns: number of distinct haplotypes
+        :rtype: int
+        """
+
+        if lo < self.start:
+            exit("Window starts before the sites swept by the PBWT")
+
+        return int(np.count_nonzero(self.divergence > lo))
+
+
+    def group_sizes(self, lo):
+        """
+        Counts the copies of each distinct haplotype over the sites [lo, k), the sizes of the runs of
+        identical haplotypes in prefix order (see hap_spectrum.py).
+
+        :param lo: index of the first site of the window, at or after the start of the sweep
+        :type lo: int
+
+        :returns: number of copies of each distinct haplotype, in prefix order
+        :rtype: np.ndarray of int64
+        """
+
+        if lo < self.start:
+            exit("Window starts before the sites swept by the PBWT")
+
+        starts = np.flatnonzero(self.divergence > lo)
+
+        return np.diff(np.append(starts, len(self.divergence)))
+
+
+    def hap_ids(self, lo):
+        """
+        Finds the id of the distinct haplotype of each haplotype over the sites [lo, k), the index of its run
+        of identical haplotypes in prefix order (see hap_groups.py).
+
+        :param lo: index of the first site of the window, at or after the start of the sweep
+        :type lo: int
+
+        :returns: distinct haplotype id of each haplotype, in haplotype order
+        :rtype: np.ndarray of int64
+        """
+
+        if lo < self.start:
+            exit("Window starts before the sites swept by the PBWT")
+
+        ids = np.empty(len(self.prefix), dtype=np.int64)
+        ids[self.prefix] = np.cumsum(self.divergence > lo) - 1
+
+        return ids
+
+
+    def count(self, hap_m, lo, hi, return_counts=False, return_ids=False):
+        """
+        Counts the unique haplotypes of a window, same use as RollingHapCounter.count in hap_hash.py. Windows have to end at or
+        after the end of the previous window. The sites of the window not swept yet are added first, and the sweep starts over
+        at lo if the window starts after the swept sites. A window ending at the swept sites only reads the divergence array,
+        so a PBWT fed every site of a scan answers the windows of all of its configurations.
+
+        :param hap_m: haplotypes of the window, each row is a site and each column is the haplotype at that site
+        :type hap_m: np.ndarray
+        :param lo: index of the first site of the window
+        :type lo: int
+        :param hi: index of the last site of the window (exclusive)
+        :type hi: int
+        :param return_counts: also return the number of copies of each distinct haplotype, defaults to False
+        :type return_counts: bool, optional
+        :param return_ids: also return the distinct haplotype id of each haplotype, defaults to False
+        :type return_ids: bool, optional
+
+        :returns: number of unique haplotypes and total number of haplotypes (sample size) in the window, then the copies of each
+            distinct haplotype if return_counts and the id of each haplotype if return_ids
+        :rtype: int, int (, np.ndarray of int64) (, np.ndarray of int64)
+        """
+
+        if hi < self.k:
+            exit("Windows have to end in order to be counted with the PBWT")
+
+        if self.prefix is None or lo > self.k:
+            self._restart(lo, hap_m.shape[1])
+
+        self.update(hap_m[self.k - lo:])
+
+        result = (self.num_distinct(lo), len(self.prefix))
+        if return_counts:
+            result += (self.group_sizes(lo),)
+        if return_ids:
+            result += (self.hap_ids(lo),)
+
+        return result
+
+
+
+def pbwt_window_counts(hapsites, bounds, block_sites=1024, return_counts=False):
+    """
+    Counts the distinct haplotypes of windows of any sizes and steps from one sweep over their sites.
+
+    :param hapsites: sites to sweep, by site index on the chromosome, requested in increasing blocks
+    :type hapsites: HapMatrix or ShardSites or SampleView
+    :param bounds: [first_site, last_site) index pairs of the windows
+    :type bounds: list of (int, int)
+    :param block_sites: number of sites requested from hapsites at a time, defaults to 1024
+    :type block_sites: int, optional
+    :param return_counts: also return the copies of each distinct haplotype of each window, defaults to False
+    :type return_counts: bool, optional
+
+    :returns: number of distinct haplotypes of each window in the order of bounds, total number of haplotypes (sample size),
+        and the copies of each distinct haplotype of each window if return_counts
+    :rtype: np.ndarray of int64, int (, list of np.ndarray of int64)
+    """
+
+    bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 2)
+    counts = np.zeros(len(bounds), dtype=np.int64)
+    spectra = [None] * len(bounds)
+    if len(bounds) == 0:
+        return (counts, 0, spectra) if return_counts else (counts, 0)
+
+    #windows in order of their last site
+    order = np.argsort(bounds[:, 1], kind="stable")
+    pbwt = PBWT(int(bounds[:, 0].min()))
+
+    for w in order:
+        lo, hi = int(bounds[w, 0]), int(bounds[w, 1])
+        while pbwt.k < hi:
+            end = min(hi, pbwt.k + block_sites)
+            pbwt.update(hapsites.sites(pbwt.k, end))
+        counts[w] = pbwt.num_distinct(lo)
+        if return_counts:
+            spectra[w] = pbwt.group_sizes(lo)
+
+    if return_counts:
+        return counts, len(pbwt.prefix), spectra
+
+    return counts, len(pbwt.prefix)
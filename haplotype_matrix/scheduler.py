@@ -0,0 +1,199 @@
+"""
+Memory and duration aware scheduling of the jobs of a scan (shards or whole chromosomes) on a pool of processes.
+
+Each job gets an estimate of its peak memory and of its runtime from the number of haplotypes, the site ranges
+of its windows and the method (estimate_job):
+    hapcount    the window of sites (1 byte per allele) and its bit-packed copy, the 16 byte hashes of each haplotype,
+                runtime ~ haplotypes x (sites + windows) for the rolling hashes
+    upgma       the window as uint8, its copies for packing and for the sliding distances, the int32 mismatch counts, the
+                condensed distance matrix and the copy linkage makes of it (10 bytes x haplotypes^2),
+                runtime ~ haplotypes^2 x sites of each window
+    fused       both
+Runtimes are in relative units, they are only used to order the jobs.
+
+run_scheduled admits the jobs longest first (longest processing time first, so the big chromosomes do not end up
+running last on their own) while the estimated memory of the running jobs fits in a RAM budget, and yields the
+result of each job as soon as it is done (imap_unordered). A job larger than the whole budget runs alone. Every job
+runs in a fresh worker process started by a fork server (spawned where there is none). A worker forked from the scan
+process would inherit its pages and report them in its ru_maxrss, so its peak RSS would not be that of its job. A fork
+server worker only holds the interpreter and the imports of the scan script, so its peak RSS is the peak of the job
+plus that base, comparable with the estimates. The rise of the peak RSS while the job ran is logged next to it.
+"""
+
+import os
+import sys
+import time
+import resource
+import threading
+import numpy as np
+from multiprocessing import get_context, get_all_start_methods
+
+
+#memory of a worker before it reads any sites: interpreter, numpy/scipy and the vcf reading buffers
+BASE_MEMORY = 256 * 2 ** 20
+
+
+### HELPER FUNCTIONS ###
+
+def estimate_job(method, num_haps, los, his):
+    """
+    Estimates the peak memory and the runtime of a job.
+
+    :param method: "hapcount", "upgma" or "fused"
+    :type method: str
+    :param num_haps: number of haplotypes (2 x samples for diploid vcfs)
+    :type num_haps: int
+    :param los: first site index of each window of the job
+    :type los: np.ndarray
+    :param his: last site index (exclusive) of each window of the job
+    :type his: np.ndarray
+
+    :returns: estimated peak memory in bytes and runtime in relative units
+    :rtype: int, float
+    """
+
+    window_snps = np.asarray(his, dtype=np.int64) - np.asarray(los, dtype=np.int64)
+    if len(window_snps) == 0:
+        return BASE_MEMORY, 0.0
+    num_sites = int(np.max(his) - np.min(los))
+    window_bytes = int(window_snps.max()) * num_haps
+
+    #window, packed window and hashes
+    hapcount_memory = 2 * window_bytes + 32 * num_haps
+    hapcount_cost = float(num_haps) * (num_sites + len(window_snps))
+
+    #window and its copies, mismatch counts, condensed distances and the copy linkage works on
+    upgma_memory = 3 * window_bytes + 10 * num_haps ** 2
+    upgma_cost = float(num_haps) ** 2 * float(window_snps.sum())
+
+    if method == "hapcount":
+        return BASE_MEMORY + hapcount_memory, hapcount_cost
+    elif method == "upgma":
+        return BASE_MEMORY + upgma_memory, upgma_cost
+    elif method == "fused":
+        return BASE_MEMORY + upgma_memory + hapcount_memory, upgma_cost + hapcount_cost
+
+    exit(f"Unknown method {method}, use hapcount, upgma or fused")
+
+
+
+def combine_estimates(estimates):
+    """
+    Estimate of a job that scans several window configurations in one pass over the sites: the configurations share
+    the sliding window so the memory is the largest of them, and their runtimes add up.
+
+    :param estimates: (memory, runtime) of each configuration (see estimate_job)
+    :type estimates: list of (int, float)
+
+    :returns: estimated peak memory in bytes and runtime in relative units
+    :rtype: int, float
+    """
+
+    return max([mem for mem, cost in estimates]), sum([cost for mem, cost in estimates])
+
+
+
+def _peak_rss():
+    """
+    Helper reads the peak resident memory of this process in bytes (ru_maxrss is in kilobytes on Linux and bytes on macOS)
+    """
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+
+def _run_job(task):
+    """
+    Helper runs one job in a worker, returns its index, result, runtime in seconds, the peak RSS of the worker and how much the job raised it
+    """
+
+    i, func, job = task
+
+    start_peak = _peak_rss()
+    start = time.time()
+    result = func(job)
+    peak = _peak_rss()
+
+    return i, result, time.time() - start, peak, peak - start_peak
+
+
+
+### SCHEDULER ###
+
+def run_scheduled(func, jobs, estimates, processes, ram_budget, log=None):
+    """
+    Runs func on every job in a pool of processes, longest job first, and yields the results as the jobs finish.
+    A job is only started while the estimated memory of the running jobs plus its own fits in ram_budget.
+
+    :param func: function run on each job, it has to be picklable e.g. a module level function or a functools.partial of one
+    :type func: callable
+    :param jobs: jobs e.g. ShardLoader or ArgLoader objects
+    :type jobs: list
+    :param estimates: estimated (memory in bytes, runtime) of each job (see estimate_job)
+    :type estimates: list of (int, float)
+    :param processes: maximum number of jobs running at once
+    :type processes: int
+    :param ram_budget: memory the running jobs may use together, in bytes
+    :type ram_budget: int
+    :param log: tab separated file to append a line per finished job to (job, estimated memory, peak RSS, rise of the peak RSS during the job,
+        estimated runtime, seconds), defaults to printing only
+    :type log: str, optional
+
+    :returns: each job with the result of func, in the order they finish
+    :rtype: generator of (job, result)
+    """
+
+    #longest processing time first
+    order = sorted(range(len(jobs)), key=lambda i: estimates[i][1], reverse=True)
+
+    admission = threading.Condition()
+    in_use = {"memory": 0, "jobs": 0, "stopped": False}
+
+    def admitted():
+        """
+        Yields the jobs to the pool, waiting while the running jobs hold the processes or too much of the RAM budget
+        """
+
+        for i in order:
+            memory = estimates[i][0]
+            with admission:
+                while not in_use["stopped"] and (in_use["jobs"] >= processes or (in_use["jobs"] > 0 and in_use["memory"] + memory > ram_budget)):
+                    admission.wait()
+                #a failed job stops the scan, the pool can only shut down once this generator returns
+                if in_use["stopped"]:
+                    return
+                if memory > ram_budget:
+                    print(f"{jobs[i]} needs about {memory / 2 ** 20:.0f} MB, more than the RAM budget, it runs alone")
+                in_use["memory"] += memory
+                in_use["jobs"] += 1
+            yield i, func, jobs[i]
+
+    if log is not None and not os.path.exists(log):
+        with open(log, "w") as logfile:
+            logfile.write("\t".join(["job", "estimated_MB", "peak_RSS_MB", "job_RSS_MB", "estimated_runtime", "seconds"]) + "\n")
+
+    #one job per worker process so that the peak RSS of a worker is the peak of its job, workers are not forked from this process so they do not inherit its pages
+    context = get_context("forkserver" if "forkserver" in get_all_start_methods() else "spawn")
+    with context.Pool(processes=processes, maxtasksperchild=1) as pool:
+        try:
+            for i, result, seconds, peak, job_peak in pool.imap_unordered(_run_job, admitted(), chunksize=1):
+
+                #free the budget of the finished job
+                with admission:
+                    in_use["memory"] -= estimates[i][0]
+                    in_use["jobs"] -= 1
+                    admission.notify()
+
+                print(f"Finished {jobs[i]} in {seconds:.1f} s, peak RSS {peak / 2 ** 20:.0f} MB, {job_peak / 2 ** 20:.0f} MB over the worker start (estimated {estimates[i][0] / 2 ** 20:.0f} MB)")
+                if log is not None:
+                    with open(log, "a") as logfile:
+                        logfile.write("\t".join([str(jobs[i]).replace("\t", " "), f"{estimates[i][0] / 2 ** 20:.0f}", f"{peak / 2 ** 20:.0f}", f"{job_peak / 2 ** 20:.0f}", f"{estimates[i][1]:.3g}", f"{seconds:.1f}"]) + "\n")
+
+                yield jobs[i], result
+
+        finally:
+            with admission:
+                in_use["stopped"] = True
+                admission.notify_all()
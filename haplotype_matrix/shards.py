@@ -0,0 +1,477 @@
+"""
+Splitting a chromosome scan into shards that can run in parallel.
+
+A scan is a list of windows, each window being a [lo, hi) range of site indices (see snp_window_bounds and
+bp_window_bounds in hapmatrix.py). A shard is a contiguous run of those windows. It reads the sites from the
+first site of its first window up to the last site of its last window, so neighbouring shards overlap by up to
+one window of sites, and every window is computed by exactly one shard with all of its sites. Stitching the
+shard outputs back together in order gives the same output as the serial scan.
+
+Shards are cut so that they hold about the same number of SNPs, not the same number of windows or bps. When the
+bit-packed haplotype matrix exists the shards slice it, otherwise they seek into the vcf with the tabix index.
+
+Several window configurations of one chromosome can be scanned together: plan_config_shards cuts the sites of the
+chromosome once and every window goes to the range of sites holding its first site, so the k-th shard of every
+configuration covers the same sites. A ShardGroup of those shards is one job that reads its sites once for all of
+the configurations, and each shard output is still stitched into the output of its own configuration.
+"""
+
+import os
+import gzip
+import struct
+import numpy as np
+from hapmatrix import HapMatrix, SampleView, hapmatrix_exists, vcf_samples, read_sample_manifest
+from gt_parser import parse_position, parse_haps
+from bgzf_reader import BGZFReader
+from window_buffer import WindowBuffer
+from window_table import stitch_window_tables
+
+
+### HELPER FUNCTIONS ###
+
+def read_tbi(tbi):
+    """
+    Reads the linear index of each reference sequence in a tabix index.
+    Entry i of a linear index is the virtual offset of the first record overlapping bps [i*16384 + 1, (i+1)*16384].
+
+    :param tbi: tabix index file name or path to file
+    :type tbi: str
+
+    :returns: linear index for each sequence name
+    :rtype: dict of str: np.ndarray of uint64
+    """
+
+    with gzip.open(tbi, "rb") as f:
+        data = f.read()
+
+    if data[:4] != b"TBI\x01":
+        exit(f"{tbi} is not a tabix index")
+
+    #header
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    l_nm = struct.unpack_from("<i", data, 32)[0]
+    names = data[36:36 + l_nm].split(b"\x00")[:n_ref]
+    offset = 36 + l_nm
+
+    linear_indexes = {}
+    for name in names:
+
+        #binning index, skipped
+        n_bin = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        for b in range(n_bin):
+            n_chunk = struct.unpack_from("<i", data, offset + 4)[0]
+            offset += 8 + 16 * n_chunk
+
+        #linear index
+        n_intv = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        linear_indexes[name.decode()] = np.frombuffer(data, dtype="<u8", count=n_intv, offset=offset).copy()
+        offset += 8 * n_intv
+
+    return linear_indexes
+
+
+
+def seek_offset(linear_index, position):
+    """
+    Finds a virtual offset at or before the first record at a position. Empty 16 kb bins can hold 0,
+    so the largest offset up to the bin of the position is used.
+    """
+
+    if len(linear_index) == 0:
+        return 0
+
+    bin_idx = min((position - 1) >> 14, len(linear_index) - 1)
+
+    return int(linear_index[:bin_idx + 1].max())
+
+
+
+def plan_shards(los, his, shard_snps):
+    """
+    Splits the windows of a scan into contiguous shards holding about shard_snps SNPs each.
+    Windows are weighted by their number of SNPs so shards of dense regions hold fewer windows.
+
+    :param los: first site index of each window
+    :type los: np.ndarray
+    :param his: last site index (exclusive) of each window
+    :type his: np.ndarray
+    :param shard_snps: target number of SNPs per shard
+    :type shard_snps: int
+
+    :returns: [first_window, last_window) index pairs of each shard
+    :rtype: list of (int, int)
+    """
+
+    num_windows = len(los)
+    if num_windows == 0:
+        return []
+
+    #empty windows still cost a line of output
+    weights = np.maximum(np.asarray(his) - np.asarray(los), 1)
+    cumulative = np.cumsum(weights)
+    num_shards = max(1, int(-(-cumulative[-1] // max(1, shard_snps))))
+
+    #cut where the cumulative SNP count crosses each multiple of the shard size
+    targets = cumulative[-1] * np.arange(1, num_shards) / num_shards
+    cuts = np.searchsorted(cumulative, targets, side="left") + 1
+    cuts = np.unique(np.concatenate([[0], cuts, [num_windows]]))
+
+    return [(int(cuts[i]), int(cuts[i + 1])) for i in range(len(cuts) - 1)]
+
+
+
+def plan_config_shards(los, his, shard_snps):
+    """
+    Splits the windows of several window configurations of one chromosome into shards cut at the same sites. The sites are cut
+    into ranges of about shard_snps SNPs and every window goes to the range holding its first site, so the k-th shard of every
+    configuration covers the same range of sites.
+
+    :param los: first site index of each window, for each configuration
+    :type los: list of np.ndarray
+    :param his: last site index (exclusive) of each window, for each configuration
+    :type his: list of np.ndarray
+    :param shard_snps: target number of SNPs per shard
+    :type shard_snps: int
+
+    :returns: [first_window, last_window) index pairs of the shards of each configuration, every configuration gets the same
+        number of shards and some of them may hold no windows
+    :rtype: list of list of (int, int)
+    """
+
+    num_sites = max([int(np.max(config_his)) for config_his in his if len(config_his) > 0], default=0)
+    num_shards = max(1, int(-(-num_sites // max(1, shard_snps))))
+
+    #site ranges of about the same number of SNPs
+    cuts = num_sites * np.arange(num_shards + 1) // num_shards
+
+    plans = []
+    for config_los in los:
+        #windows whose first site is in each range
+        firsts = np.searchsorted(config_los, cuts, side="left")
+        plans.append([(int(firsts[k]), int(firsts[k + 1])) for k in range(num_shards)])
+
+    return plans
+
+
+
+### CLASSES ###
+
+class ShardLoader():
+    def __init__(self, vcfgz_file, windowsize, windowstep, first_window, last_window, outfile, decompress_threads=1, manifest=None, outformat="csv", window_threads=1):
+        """
+        Class used to store the arguments of one shard of a scan so that shards can be run in parallel using multiprocessing.Pool
+
+        :param vcfgz_file: filename or path to file for the vcf to scan
+        :type vcfgz_file: str
+        :param windowsize: window size
+        :type windowsize: int
+        :param windowstep: window step
+        :type windowstep: int
+        :param first_window: index of the first window of the shard
+        :type first_window: int
+        :param last_window: index of the last window of the shard (exclusive)
+        :type last_window: int
+        :param outfile: output file of the shard, without a header
+        :type outfile: str
+        :param decompress_threads: number of threads inflating the vcf, defaults to 1
+        :type decompress_threads: int, optional
+        :param manifest: sample manifest of the samples to scan (see read_sample_manifest in hapmatrix.py), defaults to all samples
+        :type manifest: str, optional
+        :param outformat: "npz" for a columnar window table (see window_table.py), anything else for text, defaults to "csv"
+        :type outformat: str, optional
+        :param window_threads: number of threads evaluating the windows of the shard (see window_pool.py), defaults to 1
+        :type window_threads: int, optional
+        """
+
+        self.vcf = vcfgz_file
+        self.winsize = windowsize
+        self.winstep = windowstep
+        self.first_window = first_window
+        self.last_window = last_window
+        self.outfile = outfile
+        self.threads = decompress_threads
+        self.manifest = manifest
+        self.outformat = outformat
+        self.window_threads = window_threads
+
+    def __str__(self):
+        return self.vcf + "\t" + str(self.winsize) + "\t" + str(self.winstep) + "\t" + str(self.first_window) + "\t" + str(self.last_window)
+
+
+
+class ShardGroup():
+    def __init__(self, shards):
+        """
+        Class used to store the shards of several window configurations of one vcf that cover the same range of sites (see plan_config_shards),
+        so that one job reads the sites once and writes the windows of every configuration to the output of its shard.
+
+        :param shards: shard of each window configuration, with the same vcf, sample manifest and output format
+        :type shards: list of ShardLoader
+
+        Attributes:
+            shards (list of ShardLoader): holds the shard of each window configuration
+            vcf (str): holds the vcf filename of the shards
+            threads (int): holds the number of decompression threads of the shards
+            manifest (str or None): holds the sample manifest of the shards
+            outformat (str): holds the output format of the shards
+            window_threads (int): holds the number of window threads of the shards
+        """
+
+        self.shards = shards
+        self.vcf = shards[0].vcf
+        self.threads = shards[0].threads
+        self.manifest = shards[0].manifest
+        self.outformat = shards[0].outformat
+        self.window_threads = shards[0].window_threads
+
+    def __str__(self):
+        return self.vcf + "\t" + ",".join([f"{shard.winsize}/{shard.winstep}:{shard.first_window}-{shard.last_window}" for shard in self.shards])
+
+
+
+class ShardSites():
+    def __init__(self, vcfgz, positions, site_lo, site_hi, decompress_threads=1):
+        """
+        This class streams the haplotypes of a range of sites of a vcf, starting from the tabix index
+        entry of the first site. Windows are requested in order with `sites` and `site_positions`,
+        like HapMatrix.sites, and sites before the requested window are dropped.
+        A range starting at site 0 streams the whole vcf from its start without the tabix index.
+
+        :param vcfgz: bgziped and tabix indexed vcf file name or path to file
+        :type vcfgz: str
+        :param positions: positions of all sites of the vcf (see load_positions in hapmatrix.py)
+        :type positions: np.ndarray of int64
+        :param site_lo: index of the first site of the shard
+        :type site_lo: int
+        :param site_hi: index of the last site of the shard (exclusive)
+        :type site_hi: int
+        :param decompress_threads: number of threads inflating the vcf
+        :type decompress_threads: int, optional
+
+        Attributes:
+            site_hi (int): index of the last site of the shard (exclusive)
+            window (WindowBuffer): buffered sites, addressed by their site index on the chromosome
+        """
+
+        first_pos = int(positions[site_lo])
+        #sites sharing the first position that belong to the previous shard
+        dups = site_lo - int(np.searchsorted(positions, first_pos, side="left"))
+
+        #a shard starting at the first site reads from the start of the vcf and does not need the index
+        if site_lo == 0:
+            voffset = 0
+        else:
+            linear_indexes = read_tbi(vcfgz + ".tbi")
+            if len(linear_indexes) != 1:
+                exit(f"{vcfgz} should hold a single chromosome to be scanned in shards")
+            voffset = seek_offset(list(linear_indexes.values())[0], first_pos)
+
+        self._records = self._read(vcfgz, voffset, first_pos, dups, site_hi - site_lo, decompress_threads)
+        self.site_hi = site_hi
+        self.window = WindowBuffer()
+        self.window.first = site_lo
+
+
+    @staticmethod
+    def _read(vcfgz, voffset, first_pos, dups, num_sites, decompress_threads):
+        """
+        Yields the position and haplotype row of the shard sites in order. Static so that the generator does not hold the ShardSites,
+        which is then freed as soon as it is dropped e.g. by a failed scan, closing the vcf and its inflating threads right away
+        """
+
+        with BGZFReader(vcfgz, "rb", threads=decompress_threads, voffset=voffset) as vcf:
+            for line in vcf:
+
+                if num_sites == 0:
+                    break
+
+                #skip header lines and records before the shard
+                if line.startswith(b"#"):
+                    continue
+                position = parse_position(line)
+                if position < first_pos:
+                    continue
+                if position == first_pos and dups > 0:
+                    dups -= 1
+                    continue
+
+                num_sites -= 1
+                yield position, parse_haps(line)
+
+        if num_sites > 0:
+            exit(f"{vcfgz} ended before the last site of the shard, the positions cache may be out of date")
+
+
+    def sites(self, start, end):
+        """
+        Returns the haplotypes for a range of sites, same layout as HapMatrix.sites.
+        Ranges have to be requested in increasing order, and the returned view is only valid until the next request.
+        """
+
+        #drop sites before the window
+        self.window.pop(start - self.window.first)
+
+        #read up to the end of the window
+        while self.window.num_appended() < end:
+            self.window.append(*next(self._records))
+
+        #close the vcf and its inflating threads once the last site of the shard is read
+        if self.window.num_appended() == self.site_hi:
+            self._records.close()
+
+        return self.window.sites(start, end)
+
+
+    def site_positions(self, start, end):
+        """
+        Returns the positions for a range of sites, the range has to be requested with `sites` first
+        """
+
+        return self.window.site_positions(start, end)
+
+
+
+### SHARD FUNCTIONS ###
+
+def scan_shards(vcfgz, windowsize, windowstep, los, his, shard_snps, outfile, decompress_threads=1, manifest=None, outformat="csv", window_threads=1):
+    """
+    Plans the shards of one scan of a vcf (see plan_shards).
+
+    :param vcfgz: vcf file name or path to file
+    :type vcfgz: str
+    :param windowsize: window size
+    :type windowsize: int
+    :param windowstep: window step
+    :type windowstep: int
+    :param los: first site index of each window
+    :type los: np.ndarray
+    :param his: last site index (exclusive) of each window
+    :type his: np.ndarray
+    :param shard_snps: target number of SNPs per shard
+    :type shard_snps: int
+    :param outfile: scan output file, the shard outputs are named outfile.shard0, outfile.shard1, ...
+    :type outfile: str
+    :param decompress_threads: number of threads inflating the vcf, defaults to 1
+    :type decompress_threads: int, optional
+    :param manifest: sample manifest of the samples to scan, defaults to all samples
+    :type manifest: str, optional
+    :param outformat: output format of the shards, "npz" or text, defaults to "csv"
+    :type outformat: str, optional
+    :param window_threads: number of threads evaluating the windows of each shard, defaults to 1
+    :type window_threads: int, optional
+
+    :returns: shards in window order
+    :rtype: list of ShardLoader
+    """
+
+    shards = []
+    for i, (first_window, last_window) in enumerate(plan_shards(los, his, shard_snps)):
+        shards.append(ShardLoader(vcfgz, windowsize, windowstep, first_window, last_window, f"{outfile}.shard{i}", decompress_threads, manifest, outformat, window_threads))
+
+    return shards
+
+
+
+
+def scan_config_shards(vcfgz, windowing, los, his, shard_snps, outfiles, decompress_threads=1, manifest=None, outformat="csv", window_threads=1):
+    """
+    Plans the shards of several window configurations of one vcf cut at the same sites (see plan_config_shards).
+    The k-th shards of the configurations are run together as a ShardGroup.
+
+    :param vcfgz: vcf file name or path to file
+    :type vcfgz: str
+    :param windowing: (window size, window step) of each window configuration
+    :type windowing: list of (int, int)
+    :param los: first site index of each window, for each configuration
+    :type los: list of np.ndarray
+    :param his: last site index (exclusive) of each window, for each configuration
+    :type his: list of np.ndarray
+    :param shard_snps: target number of SNPs per shard
+    :type shard_snps: int
+    :param outfiles: scan output file of each configuration, the shard outputs are named outfile.shard0, outfile.shard1, ...
+    :type outfiles: list of str
+    :param decompress_threads: number of threads inflating the vcf, defaults to 1
+    :type decompress_threads: int, optional
+    :param manifest: sample manifest of the samples to scan, defaults to all samples
+    :type manifest: str, optional
+    :param outformat: output format of the shards, "npz" or text, defaults to "csv"
+    :type outformat: str, optional
+    :param window_threads: number of threads evaluating the windows of each shard, defaults to 1
+    :type window_threads: int, optional
+
+    :returns: shards of each configuration in window order, the k-th shard of every configuration covers the same range of sites
+    :rtype: list of list of ShardLoader
+    """
+
+    config_shards = []
+    for (windowsize, windowstep), plan, outfile in zip(windowing, plan_config_shards(los, his, shard_snps), outfiles):
+        config_shards.append([ShardLoader(vcfgz, windowsize, windowstep, first_window, last_window, f"{outfile}.shard{k}", decompress_threads, manifest, outformat, window_threads)
+                              for k, (first_window, last_window) in enumerate(plan)])
+
+    return config_shards
+
+
+
+
+def shard_sites(shard, positions, site_lo, site_hi):
+    """
+    Opens the sites of a shard, from the bit-packed haplotype matrix if it was built, otherwise from the vcf.
+    The haplotypes of the shard manifest samples are selected with a SampleView.
+
+    :param shard: shard arguments
+    :type shard: ShardLoader or ShardGroup
+    :param positions: positions of all sites of the vcf
+    :type positions: np.ndarray of int64
+    :param site_lo: index of the first site of the shard
+    :type site_lo: int
+    :param site_hi: index of the last site of the shard (exclusive)
+    :type site_hi: int
+
+    :returns: object with a sites(start, end) method, None if the shard only holds empty windows
+    :rtype: HapMatrix or ShardSites or SampleView or None
+    """
+
+    if site_lo >= site_hi:
+        return None
+    elif hapmatrix_exists(shard.vcf):
+        hapsites = HapMatrix(shard.vcf)
+    else:
+        hapsites = ShardSites(shard.vcf, positions, site_lo, site_hi, shard.threads)
+
+    if shard.manifest is not None:
+        return SampleView(hapsites, vcf_samples(shard.vcf), read_sample_manifest(shard.manifest))
+
+    return hapsites
+
+
+
+def stitch_shards(shards, outfile, header, mode="a"):
+    """
+    Writes the header and then appends the shard outputs in order to the scan output, removing the shard files once they are all written.
+    Window table shards are concatenated into a window table and the header is not used.
+
+    :param shards: shards of one scan in window order
+    :type shards: list of ShardLoader
+    :param outfile: scan output file
+    :type outfile: str
+    :param header: header line, with its newline
+    :type header: str
+    :param mode: text file mode of the scan output, "w" writes it from scratch e.g. when stitching again after an interrupted run, defaults to "a"
+    :type mode: str, optional
+    """
+
+    if len(shards) > 0 and shards[0].outformat == "npz":
+        stitch_window_tables([shard.outfile for shard in shards], outfile)
+        return
+
+    with open(outfile, mode) as out:
+        out.write(header)
+        for shard in shards:
+            with open(shard.outfile, "r") as shardfile:
+                for line in shardfile:
+                    out.write(line)
+
+    for shard in shards:
+        os.remove(shard.outfile)
@@ -0,0 +1,92 @@
+"""
+Hamming distances between the haplotypes of a sliding window of sites, updated window after window.
+
+UPGMA runs on the euclidean distances between haplotypes, and for 0/1 alleles the squared euclidean distance between
+two haplotypes is the number of sites where they differ. Consecutive windows share most of their sites, so instead of
+counting the mismatches of every window from scratch (packed_distances.py), SlidingHamming keeps the condensed matrix of
+mismatch counts of the current window and moves it to the next one: the pairwise mismatches of the sites leaving the
+window are subtracted and those of the sites entering it are added. The sites of a haplotype are packed 64 to a uint64
+word and the mismatches of a pair are the bits set in the XOR of their words (pair_mismatches in window_kernels.py), so
+an update costs haplotypes^2 x changed sites / 64 word operations instead of haplotypes^2 x window sites / 64.
+
+The counts are exact integers, so sqrt of the counts is the same float64 as the distances pdist computes and the linkage
+is unchanged. Every call of pair_mismatches walks all the pairs, which costs about as much as 16 words per pair on top
+of the words themselves, so when the sites leaving and entering the window would take more words than rebuilding the
+counts from the whole window (small windows, big steps, or windows going back) the counts are rebuilt instead. The
+matrix is updated in window order, so it stays in the thread iterating the windows (see window_pool.py).
+"""
+
+import numpy as np
+from window_kernels import pair_mismatches
+from packed_distances import pack_haplotypes
+
+
+#cost of walking the pairs in one call of pair_mismatches, in words per pair
+PAIR_OVERHEAD_WORDS = 16
+
+
+### HELPER FUNCTIONS ###
+
+def _words(num_sites):
+    """Helper returns the number of uint64 words holding num_sites packed sites"""
+
+    return -(-num_sites // 64)
+
+
+
+### CLASSES ###
+
+class SlidingHamming():
+    def __init__(self):
+        """
+        This class holds the number of mismatching sites between every pair of haplotypes of the current window,
+        moved along the chromosome with distances.
+
+        Attributes:
+            lo (int): index of the first site of the current window
+            hi (int): index after the last site of the current window
+            mismatches (np.ndarray of int32): condensed mismatch counts of the current window, None before the first window
+        """
+
+        self.lo = 0
+        self.hi = 0
+        self.mismatches = None
+
+        #sites of the current window, the sites leaving it are read from here
+        self._window = None
+
+
+    def distances(self, haplo_matrix, lo, hi):
+        """
+        Moves to the window of sites [lo, hi) and returns the euclidean distances between its haplotypes.
+
+        :param haplo_matrix: sites lo to hi, each row is a site and each column is the haplotype at that site
+        :type haplo_matrix: np.ndarray
+        :param lo: index of the first site of the window, non decreasing from window to window
+        :type lo: int
+        :param hi: index after the last site of the window, non decreasing from window to window
+        :type hi: int
+
+        :returns: condensed euclidean distances, the same as pdist(haplo_matrix.T, metric="euclidean")
+        :rtype: np.ndarray of float64
+        """
+
+        #rebuilding when the window goes back, jumps past the current one or when updating costs more words than rebuilding
+        if self.mismatches is None or lo < self.lo or hi < self.hi or lo >= self.hi or \
+                _words(lo - self.lo) + _words(hi - self.hi) + PAIR_OVERHEAD_WORDS >= _words(hi - lo):
+            self.mismatches = pair_mismatches(pack_haplotypes(haplo_matrix))
+
+        else:
+            #sites leaving the window
+            if lo > self.lo:
+                self.mismatches -= pair_mismatches(pack_haplotypes(self._window[:lo - self.lo]))
+
+            #sites entering the window
+            if hi > self.hi:
+                self.mismatches += pair_mismatches(pack_haplotypes(haplo_matrix[self.hi - lo:]))
+
+        #own copy, the window may be a view that the next window overwrites
+        self._window = np.array(haplo_matrix, dtype=np.uint8)
+        self.lo, self.hi = lo, hi
+
+        return np.sqrt(self.mismatches.astype(np.float64))
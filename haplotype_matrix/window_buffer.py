@@ -0,0 +1,175 @@
+"""
+Array-backed sliding window shared by the scanners that stream a vcf (or the per-site MAF csv).
+
+A window used to be a deque of one Python object per site. WindowBuffer instead holds the sites
+of the current window in a preallocated block (one row per site, e.g. a uint8 haplotype row or a
+float MAF) plus an int64 positions array. Sliding the window only moves the start index: a SNP
+step drops a fixed number of sites and a bp step finds the sites to drop with np.searchsorted on
+the positions. When the end of the block is reached the live rows are moved back to the front,
+so the block is reused for the whole chromosome and only grows when a window holds more sites than
+half of it. The window is always a contiguous view of the block and is never copied to be scanned.
+
+Sites can also be addressed by their index on the chromosome (the number of sites appended before them),
+so that scans of several window configurations can share one buffer holding the sites of all of their windows.
+"""
+
+import numpy as np
+
+
+class WindowBuffer():
+    def __init__(self, capacity=1024, dtype=np.uint8):
+        """
+        This class holds the sites of a sliding window in a preallocated block.
+        The block is allocated on the first append, once the row length is known.
+
+        :param capacity: number of sites the block starts with room for, it is grown if a window needs more
+        :type capacity: int, optional
+        :param dtype: data type of the rows
+        :type dtype: np.dtype, optional
+
+        Attributes:
+            rows (np.ndarray or None): block of rows, one per site
+            pos (np.ndarray of int64): block of positions, one per site
+            start (int): index in the block of the first site of the window
+            end (int): index in the block after the last site of the window
+            first (int): chromosome index of the first site of the window (number of sites dropped so far)
+        """
+
+        self.dtype = dtype
+        self.rows = None
+        self.pos = np.empty(capacity, dtype=np.int64)
+        self.start = 0
+        self.end = 0
+        self.first = 0
+
+
+    def __len__(self):
+        return self.end - self.start
+
+
+    def _make_room(self, row):
+        """
+        Moves the window back to the front of the block, and doubles the block if the window fills more than half of it
+        """
+
+        num_sites = len(self)
+        capacity = len(self.pos)
+        if num_sites > capacity // 2:
+            capacity *= 2
+
+        #allocating on the first append or growing
+        if self.rows is None or capacity != len(self.pos):
+            rows = np.empty((capacity,) + np.shape(row), dtype=self.dtype)
+            pos = np.empty(capacity, dtype=np.int64)
+            if self.rows is not None:
+                rows[:num_sites] = self.rows[self.start:self.end]
+            pos[:num_sites] = self.pos[self.start:self.end]
+            self.rows, self.pos = rows, pos
+
+        #moving the window to the front
+        else:
+            self.rows[:num_sites] = self.rows[self.start:self.end]
+            self.pos[:num_sites] = self.pos[self.start:self.end]
+
+        self.start = 0
+        self.end = num_sites
+
+
+    def append(self, position, row):
+        """
+        Adds a site to the end of the window.
+
+        :param position: site position
+        :type position: int
+        :param row: site data e.g. a haplotype row
+        :type row: np.ndarray or scalar
+        """
+
+        if self.rows is None or self.end == len(self.pos):
+            self._make_room(row)
+
+        self.rows[self.end] = row
+        self.pos[self.end] = position
+        self.end += 1
+
+
+    def matrix(self):
+        """
+        Returns the rows of the window, a view of the block that changes when the window slides.
+        For haplotype rows each row is a site and each column is a haplotype, same layout as HapMatrix.sites.
+        """
+
+        if self.rows is None:
+            return np.empty((0,), dtype=self.dtype)
+
+        return self.rows[self.start:self.end]
+
+
+    def positions(self):
+        """
+        Returns the positions of the sites in the window
+        """
+
+        return self.pos[self.start:self.end]
+
+
+    def num_appended(self):
+        """
+        Returns the number of sites appended so far, i.e. the chromosome index after the last site of the window
+        """
+
+        return self.first + len(self)
+
+
+    def sites(self, start, end):
+        """
+        Returns the rows for a range of sites by chromosome index, same layout as HapMatrix.sites.
+        The sites have to still be in the window.
+        """
+
+        return self.rows[self.start + start - self.first:self.start + end - self.first]
+
+
+    def site_positions(self, start, end):
+        """
+        Returns the positions for a range of sites by chromosome index
+        """
+
+        return self.pos[self.start + start - self.first:self.start + end - self.first]
+
+
+    def first_position(self):
+        return int(self.pos[self.start])
+
+
+    def last_position(self):
+        return int(self.pos[self.end - 1])
+
+
+    def pop(self, num_sites):
+        """
+        Drops a number of sites from the start of the window (SNP window step)
+        """
+
+        num_sites = min(num_sites, len(self))
+        self.start += num_sites
+        self.first += num_sites
+
+
+    def pop_to(self, position):
+        """
+        Drops the sites at or before a position from the start of the window (bp window step).
+        The positions are sorted so the sites to drop are found with a binary search.
+        """
+
+        self.pop(int(np.searchsorted(self.pos[self.start:self.end], position, side="right")))
+
+
+    def clear(self):
+        """
+        Drops every site of the window and starts the chromosome index over (new chromosome)
+        """
+
+        self.start = 0
+        self.end = 0
+        self.first = 0
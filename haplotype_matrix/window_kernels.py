@@ -0,0 +1,631 @@
+"""
+Compiled kernels for the per-window statistics of the sliding window scans, with a NumPy fallback.
+
+Each kernel is written twice:
+    numpy   vectorized NumPy, always available
+    numba   the same computation as an explicit loop compiled with numba.njit, used when numba is installed. The loops
+            are compiled without the GIL so that the window threads of window_pool.py run them in parallel
+
+The backend is picked at import ("numba" if numba can be imported, otherwise "numpy") and can be changed at runtime
+with set_backend. Both backends give bit-identical results: the counts are integers, and the float kernels add in the
+same order in both (np.cumsum and the loop both sum from the first to the last value, like the Python sum the scans
+used before) and divide the same way. check_backends compares them on random windows, tests/test_window_kernels.py
+also on the edge cases of the scans (trees of height 0, empty windows, identical haplotypes, a single pair).
+
+Kernels:
+    count_rare          number of variants with 0 < MAF <= threshold (_count_rare_SNVs)
+    count_common        number of variants with MAF >= threshold (_count_common_SNPs)
+    prop_below          proportion of values below a threshold (_compute_sigp_density)
+    count_at_or_before  number of leading sorted positions at or before a position (_pop_bp_step)
+    avg_branch          average merge height of a linkage over the tree height (_find_avg_branch)
+    average_linkage     UPGMA merges of scipy's linkage with the identical haplotypes sharing their distances (collapsed_upgma.py)
+    pair_mismatches     number of mismatching sites between every pair of bit-packed haplotypes, XOR and popcount (packed_distances.py, sliding_hamming.py)
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+### NUMPY KERNELS ###
+
+def _count_rare_numpy(mafs, thresh):
+    return int(np.count_nonzero((mafs <= thresh) & (mafs > 0)))
+
+
+def _count_common_numpy(mafs, thresh):
+    return int(np.count_nonzero(mafs >= thresh))
+
+
+def _prop_below_numpy(values, thresh):
+    return int(np.count_nonzero(values < thresh)) / len(values)
+
+
+def _count_at_or_before_numpy(positions, position):
+    return int(np.searchsorted(positions, position, side="right"))
+
+
+def _avg_branch_numpy(heights):
+    #tree of identical haplotypes, 0 / 0 like the Python sum over numpy floats the scans used before
+    if heights[-1] == 0:
+        return np.nan
+    #cumsum adds in order, same as a loop
+    return (np.cumsum(heights)[-1] / len(heights)) / heights[-1]
+
+
+def _popcount_rows(words):
+    #number of set bits of each row of uint64 words, byte lookup table without np.bitwise_count (numpy < 2)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int32)
+    return _BYTE_COUNTS[words.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+
+def _pair_mismatches_numpy(packed):
+    n = len(packed)
+    counts = np.empty(n * (n - 1) // 2, dtype=np.int32)
+    #one row against every later row, the condensed order of pdist, the later rows are taken a block at a time
+    for i in range(n - 1):
+        start = i * n - i * (i + 1) // 2 - i - 1
+        for j in range(i + 1, n, _PAIR_BLOCK * 16):
+            block = packed[j:j + _PAIR_BLOCK * 16]
+            counts[start + j:start + j + len(block)] = _popcount_rows(packed[i] ^ block)
+    return counts
+
+
+def _average_linkage_numpy(dists, groups):
+    n, u = len(groups), len(dists)
+    #haplotypes of each group in index order, the fresh (not yet merged) haplotypes of a group all have the distances of the group
+    members = np.argsort(groups, kind="mergesort")
+    counts = np.bincount(groups, minlength=u)
+    ends = np.cumsum(counts)
+    lowest = ends - counts
+    size = np.ones(n, dtype=np.int64)
+    node = groups.copy()
+    #nodes 0 to u - 1 are the fresh haplotypes of each group, the merged clusters get the nodes after them
+    cap = 2 * u
+    D = np.zeros((cap, cap))
+    D[:u, :u] = dists
+    alive = np.zeros(cap, dtype=bool)
+    alive[:u] = True
+    #lowest haplotype slot of each node
+    rep = np.zeros(cap, dtype=np.int64)
+    rep[:u] = members[lowest]
+    free = []
+    top = u
+    Z = np.empty((n - 1, 4))
+    chain = []
+    for k in range(n - 1):
+        if len(chain) == 0:
+            chain.append(int(rep[:top][alive[:top]].min()))
+        #follow nearest neighbors until two slots are each other's nearest, the previous slot of the chain and then the lowest slot win ties
+        while True:
+            x = chain[-1]
+            xn = node[x]
+            row = np.where(alive[:top], D[xn, :top], np.inf)
+            slots = rep[:top].copy()
+            if rep[xn] == x:
+                #x is not its own neighbor, the next fresh haplotype of its group stands for the group
+                row[xn] = np.inf
+                if xn < u:
+                    p = lowest[xn] + 1
+                    while p < ends[xn] and not (size[members[p]] > 0 and node[members[p]] < u):
+                        p += 1
+                    if p < ends[xn]:
+                        row[xn] = D[xn, xn]
+                        slots[xn] = members[p]
+            ties = np.flatnonzero(row == row.min())
+            j = ties[np.argmin(slots[ties])]
+            y, current_min = int(slots[j]), row[j]
+            if len(chain) > 1 and not current_min < D[xn, node[chain[-2]]]:
+                current_min = D[xn, node[chain[-2]]]
+                y = chain.pop(-2)
+                chain.pop()
+                break
+            chain.append(y)
+        if x > y:
+            x, y = y, x
+        nx, ny = size[x], size[y]
+        Z[k] = x, y, current_min, nx + ny
+        a, b = node[x], node[y]
+        size[x] = 0
+        size[y] = nx + ny
+        #the merged cluster takes the slot of y, and the node of y unless y was fresh
+        if b >= u:
+            N = b
+        elif len(free) > 0:
+            N = free.pop()
+        else:
+            if top == cap:
+                D = np.pad(D, ((0, cap), (0, cap)))
+                alive = np.pad(alive, (0, cap))
+                rep = np.pad(rep, (0, cap))
+                cap *= 2
+            N = top
+            top += 1
+        node[y] = N
+        #groups that lost a fresh haplotype move on to the next one, or leave when none is left
+        for g in (a, b):
+            if g < u:
+                while lowest[g] < ends[g] and not (size[members[lowest[g]]] > 0 and node[members[lowest[g]]] < u):
+                    lowest[g] += 1
+                if lowest[g] < ends[g]:
+                    rep[g] = members[lowest[g]]
+                else:
+                    alive[g] = False
+        if a >= u:
+            alive[a] = False
+        alive[N] = True
+        rep[N] = y
+        #average distances of the merged cluster
+        others = np.flatnonzero(alive[:top])
+        others = others[others != N]
+        merged = (nx * D[a, others] + ny * D[b, others]) / (nx + ny)
+        D[N, others] = merged
+        D[others, N] = merged
+        D[N, N] = 0.0
+        if a >= u:
+            free.append(a)
+    return Z
+
+
+
+### LOOP KERNELS ###
+#compiled with numba when it is installed
+
+#uint64 constants of the popcount, typed so that numba keeps the bit operations in uint64
+_ONE, _TWO, _FOUR, _FIFTY_SIX = np.uint64(1), np.uint64(2), np.uint64(4), np.uint64(56)
+_M1, _M2, _M4, _H01 = np.uint64(0x5555555555555555), np.uint64(0x3333333333333333), np.uint64(0x0f0f0f0f0f0f0f0f), np.uint64(0x0101010101010101)
+_BYTE_COUNTS = np.array([bin(b).count("1") for b in range(256)], dtype=np.int32)
+
+#rows of haplotypes compared block against block, so that both blocks of words stay in cache
+_PAIR_BLOCK = 64
+
+def _count_rare_loop(mafs, thresh):
+    count = 0
+    for maf in mafs:
+        if maf <= thresh and maf > 0:
+            count += 1
+    return count
+
+
+def _count_common_loop(mafs, thresh):
+    count = 0
+    for maf in mafs:
+        if maf >= thresh:
+            count += 1
+    return count
+
+
+def _prop_below_loop(values, thresh):
+    count = 0
+    for value in values:
+        if value < thresh:
+            count += 1
+    return count / len(values)
+
+
+def _count_at_or_before_loop(positions, position):
+    count = 0
+    for pos in positions:
+        if pos > position:
+            break
+        count += 1
+    return count
+
+
+def _avg_branch_loop(heights):
+    #compiled loops raise ZeroDivisionError instead of giving nan
+    if heights[-1] == 0:
+        return np.nan
+    total = 0.0
+    for height in heights:
+        total += height
+    return (total / len(heights)) / heights[-1]
+
+
+def _popcount64(x):
+    #bit counting of a uint64 word by adding neighboring bit fields
+    x = x - ((x >> _ONE) & _M1)
+    x = (x & _M2) + ((x >> _TWO) & _M2)
+    x = (x + (x >> _FOUR)) & _M4
+    return (x * _H01) >> _FIFTY_SIX
+
+
+def _pair_mismatches_loop(packed):
+    n, words = packed.shape
+    counts = np.empty(n * (n - 1) // 2, dtype=np.int32)
+    for bi in range(0, n, _PAIR_BLOCK):
+        for bj in range(bi, n, _PAIR_BLOCK):
+            for i in range(bi, min(bi + _PAIR_BLOCK, n)):
+                #pair (i, j) is at start + j of the condensed counts
+                start = i * n - i * (i + 1) // 2 - i - 1
+                for j in range(max(bj, i + 1), min(bj + _PAIR_BLOCK, n)):
+                    count = 0
+                    for w in range(words):
+                        count += _popcount64(packed[i, w] ^ packed[j, w])
+                    counts[start + j] = count
+    return counts
+
+
+def _average_linkage_loop(dists, groups):
+    n = len(groups)
+    u = len(dists)
+    members = np.argsort(groups, kind="mergesort")
+    ends = np.zeros(u, dtype=np.int64)
+    for i in range(n):
+        ends[groups[i]] += 1
+    lowest = np.zeros(u, dtype=np.int64)
+    total = 0
+    for g in range(u):
+        lowest[g] = total
+        total += ends[g]
+        ends[g] = total
+    size = np.ones(n, dtype=np.int64)
+    node = groups.copy()
+    cap = 2 * u
+    D = np.zeros((cap, cap))
+    D[:u, :u] = dists
+    alive = np.zeros(cap, dtype=np.bool_)
+    rep = np.zeros(cap, dtype=np.int64)
+    for g in range(u):
+        alive[g] = True
+        rep[g] = members[lowest[g]]
+    free = np.empty(cap, dtype=np.int64)
+    num_free = 0
+    top = u
+    Z = np.empty((n - 1, 4))
+    chain = np.empty(n, dtype=np.int64)
+    chain_length = 0
+    for k in range(n - 1):
+        if chain_length == 0:
+            chain_length = 1
+            chain[0] = n
+            for j in range(top):
+                if alive[j] and rep[j] < chain[0]:
+                    chain[0] = rep[j]
+        while True:
+            x = chain[chain_length - 1]
+            xn = node[x]
+            y = n
+            current_min = np.inf
+            for j in range(top):
+                if not alive[j]:
+                    continue
+                slot = rep[j]
+                if slot == x:
+                    if j >= u:
+                        continue
+                    p = lowest[j] + 1
+                    while p < ends[j] and not (size[members[p]] > 0 and node[members[p]] < u):
+                        p += 1
+                    if p == ends[j]:
+                        continue
+                    slot = members[p]
+                if D[xn, j] < current_min or (D[xn, j] == current_min and slot < y):
+                    current_min = D[xn, j]
+                    y = slot
+            if chain_length > 1:
+                prev = chain[chain_length - 2]
+                if not current_min < D[xn, node[prev]]:
+                    current_min = D[xn, node[prev]]
+                    y = prev
+                    break
+            chain[chain_length] = y
+            chain_length += 1
+        chain_length -= 2
+        if x > y:
+            x, y = y, x
+        nx = size[x]
+        ny = size[y]
+        Z[k, 0] = x
+        Z[k, 1] = y
+        Z[k, 2] = current_min
+        Z[k, 3] = nx + ny
+        a = node[x]
+        b = node[y]
+        size[x] = 0
+        size[y] = nx + ny
+        if b >= u:
+            N = b
+        elif num_free > 0:
+            num_free -= 1
+            N = free[num_free]
+        else:
+            if top == cap:
+                grown = np.zeros((2 * cap, 2 * cap))
+                grown[:cap, :cap] = D
+                D = grown
+                grown_alive = np.zeros(2 * cap, dtype=np.bool_)
+                grown_alive[:cap] = alive
+                alive = grown_alive
+                grown_rep = np.zeros(2 * cap, dtype=np.int64)
+                grown_rep[:cap] = rep
+                rep = grown_rep
+                grown_free = np.empty(2 * cap, dtype=np.int64)
+                grown_free[:cap] = free
+                free = grown_free
+                cap *= 2
+            N = top
+            top += 1
+        node[y] = N
+        for g in (a, b):
+            if g < u:
+                while lowest[g] < ends[g] and not (size[members[lowest[g]]] > 0 and node[members[lowest[g]]] < u):
+                    lowest[g] += 1
+                if lowest[g] < ends[g]:
+                    rep[g] = members[lowest[g]]
+                else:
+                    alive[g] = False
+        if a >= u:
+            alive[a] = False
+        alive[N] = True
+        rep[N] = y
+        for j in range(top):
+            if not alive[j] or j == N:
+                continue
+            merged = (nx * D[a, j] + ny * D[b, j]) / (nx + ny)
+            D[N, j] = merged
+            D[j, N] = merged
+        D[N, N] = 0.0
+        if a >= u:
+            free[num_free] = a
+            num_free += 1
+    return Z
+
+
+
+_NUMPY = {
+    "count_rare": _count_rare_numpy,
+    "count_common": _count_common_numpy,
+    "prop_below": _prop_below_numpy,
+    "count_at_or_before": _count_at_or_before_numpy,
+    "avg_branch": _avg_branch_numpy,
+    "average_linkage": _average_linkage_numpy,
+    "pair_mismatches": _pair_mismatches_numpy,
+}
+
+_LOOPS = {
+    "count_rare": _count_rare_loop,
+    "count_common": _count_common_loop,
+    "prop_below": _prop_below_loop,
+    "count_at_or_before": _count_at_or_before_loop,
+    "avg_branch": _avg_branch_loop,
+    "average_linkage": _average_linkage_loop,
+    "pair_mismatches": _pair_mismatches_loop,
+}
+
+#the popcount is compiled first so that the compiled kernels call it compiled
+if njit is not None:
+    _popcount64 = njit(cache=True, nogil=True)(_popcount64)
+
+_NUMBA = {name: njit(cache=True, nogil=True)(kernel) for name, kernel in _LOOPS.items()} if njit is not None else None
+
+_kernels = _NUMBA if _NUMBA is not None else _NUMPY
+
+
+
+### BACKEND ###
+
+def set_backend(name):
+    """
+    Picks the kernel backend.
+
+    :param name: "numba" or "numpy"
+    :type name: str
+    """
+
+    global _kernels
+
+    if name == "numpy":
+        _kernels = _NUMPY
+    elif name == "numba":
+        if _NUMBA is None:
+            exit("numba is not installed, use the numpy backend")
+        _kernels = _NUMBA
+    else:
+        exit(f"Unknown kernel backend {name}, use numba or numpy")
+
+
+
+def get_backend():
+    """
+    Returns the name of the kernel backend in use
+    """
+
+    return "numba" if _kernels is _NUMBA else "numpy"
+
+
+
+### KERNELS ###
+
+def count_rare(mafs, thresh):
+    """
+    Counts the variants with 0 < MAF <= thresh.
+
+    :param mafs: minor allele frequencies of the variants of a window
+    :type mafs: np.ndarray of float64
+    :param thresh: minor allele frequency threshold
+    :type thresh: float
+
+    :returns: number of rare variants
+    :rtype: int
+    """
+
+    return int(_kernels["count_rare"](mafs, thresh))
+
+
+
+def count_common(mafs, thresh):
+    """
+    Counts the variants with MAF >= thresh.
+
+    :param mafs: minor allele frequencies of the variants of a window
+    :type mafs: np.ndarray of float64
+    :param thresh: minor allele frequency threshold
+    :type thresh: float
+
+    :returns: number of common variants
+    :rtype: int
+    """
+
+    return int(_kernels["count_common"](mafs, thresh))
+
+
+
+def prop_below(values, thresh):
+    """
+    Finds the proportion of values below a threshold e.g. the density of significant p-values of a window.
+
+    :param values: values of a window, at least one
+    :type values: np.ndarray of float64
+    :param thresh: threshold
+    :type thresh: float
+
+    :returns: proportion of values below thresh
+    :rtype: float
+    """
+
+    return float(_kernels["prop_below"](values, thresh))
+
+
+
+def count_at_or_before(positions, position):
+    """
+    Counts the leading positions at or before a position, i.e. the sites a bp window step drops.
+
+    :param positions: sorted site positions of a window
+    :type positions: np.ndarray of int64
+    :param position: last position to drop
+    :type position: int
+
+    :returns: number of sites at or before position
+    :rtype: int
+    """
+
+    return int(_kernels["count_at_or_before"](positions, position))
+
+
+
+def avg_branch(heights):
+    """
+    Finds the average merge height of a linkage normalized by the tree height (the last merge).
+
+    :param heights: merge heights, column 2 of a scipy linkage array
+    :type heights: np.ndarray of float64
+
+    :returns: normalized average branch length, nan for a tree of height 0 (every haplotype of the window is the same)
+    :rtype: float
+    """
+
+    return float(_kernels["avg_branch"](np.ascontiguousarray(heights, dtype=np.float64)))
+
+
+
+def average_linkage(dists, groups):
+    """
+    Runs UPGMA (average linkage) on haplotypes of which many are identical, with the nearest neighbor chain algorithm
+    and distance updates of scipy.cluster.hierarchy.linkage(method="average"). The haplotypes of a group are identical
+    and share the distances of the group until they are merged, so the distances are held for the groups and the merged
+    clusters only, while the chain still walks and merges the haplotype slots in scipy's order. The merges are those of
+    scipy's linkage on all haplotypes before they are sorted and relabelled, to the last bit.
+
+    :param dists: square matrix of the distances between the groups of identical haplotypes
+    :type dists: np.ndarray of float64
+    :param groups: group of each haplotype
+    :type groups: np.ndarray of int64
+
+    :returns: merges in the order they are made, each row holds the two merged haplotype slots (the merged cluster takes
+        the slot of the second), the merge height and the size of the merged cluster
+    :rtype: np.ndarray of float64
+    """
+
+    return _kernels["average_linkage"](np.ascontiguousarray(dists, dtype=np.float64), np.ascontiguousarray(groups, dtype=np.int64))
+
+
+
+def pair_mismatches(packed):
+    """
+    Counts the mismatching sites between every pair of haplotypes, as the bits set in the XOR of their bit-packed sites.
+
+    :param packed: sites of each haplotype packed into uint64 words, one row per haplotype, padded with 0 bits (see pack_haplotypes in sliding_hamming.py)
+    :type packed: np.ndarray of uint64
+
+    :returns: condensed mismatch counts, same pair order as scipy's pdist
+    :rtype: np.ndarray of int32
+    """
+
+    return _kernels["pair_mismatches"](np.ascontiguousarray(packed, dtype=np.uint64))
+
+
+
+### BACKEND CHECK ###
+
+def _random_clusters(rng):
+    """
+    Helper draws the distances and groups of random haplotypes with many copies, with duplicated distances so that ties are broken the same way
+    """
+
+    haps = rng.integers(0, 2, (int(rng.integers(1, 30)), int(rng.integers(1, 12)))).astype(np.float64)
+    haps = np.unique(haps, axis=0)
+    dists = np.sqrt(((haps[:, None, :] - haps[None, :, :]) ** 2).sum(axis=2))
+    groups = np.concatenate([np.arange(len(haps)), rng.integers(0, len(haps), int(rng.integers(1, 100)))])
+
+    return dists, rng.permutation(groups)
+
+
+
+
+def check_backends(num_windows=200, seed=0):
+    """
+    Compares the kernels of every available backend (and the plain Python loops) on random windows.
+
+    :param num_windows: number of random windows per kernel, defaults to 200
+    :type num_windows: int, optional
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+
+    :returns: names of the kernels whose results differ between backends, empty if they are all bit-identical
+    :rtype: list of str
+    """
+
+    rng = np.random.default_rng(seed)
+    backends = [_NUMPY, _LOOPS] + ([_NUMBA] if _NUMBA is not None else [])
+
+    mismatches = set()
+    for w in range(num_windows):
+        n = int(rng.integers(1, 2000))
+        mafs = np.round(rng.random(n) * 0.5, int(rng.integers(2, 6)))
+        positions = np.sort(rng.integers(1, 10 ** 6, n)).astype(np.int64)
+        #trees of identical haplotypes have height 0
+        heights = np.sort(rng.random(n) * rng.random() * 10) if w % 10 != 0 else np.zeros(n)
+        thresh = float(rng.choice([0.0, 0.01, 0.05, float(mafs[0])]))
+        cases = {
+            "count_rare": (mafs, thresh),
+            "count_common": (mafs, thresh),
+            "prop_below": (mafs, thresh),
+            "count_at_or_before": (positions, int(positions[int(rng.integers(0, n))])),
+            "avg_branch": (heights,),
+            "average_linkage": _random_clusters(rng),
+            "pair_mismatches": (rng.integers(0, 2 ** 63, (int(rng.integers(2, 150)), int(rng.integers(1, 4))), dtype=np.uint64) * np.uint64(rng.integers(1, 3)),),
+        }
+        for name, args in cases.items():
+            results = [kernels[name](*args) for kernels in backends]
+            if any(np.asarray(r, dtype=np.float64).tobytes() != np.asarray(results[0], dtype=np.float64).tobytes() for r in results):
+                mismatches.add(name)
+
+    return sorted(mismatches)
+
+
+
+
+def main():
+    print(f"kernel backend: {get_backend()}")
+    mismatches = check_backends()
+    print("all kernels bit-identical" if len(mismatches) == 0 else f"kernels differing between backends: {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
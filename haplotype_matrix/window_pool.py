@@ -0,0 +1,64 @@
+"""
+Thread-parallel evaluation of the windows of a chromosome scan.
+
+The statistic kernels (np.unique on the packed haplotypes, the distances and linkage of UPGMA, ...) spend most of their time
+in C or numba code that releases the GIL, so the windows of one chromosome can be evaluated on threads sharing the sliding window
+of sites. The producer, the thread iterating the windows, decodes the vcf and slices each window in order, and queues
+the kernel on a thread pool. At most max_pending windows are queued: when the queue is full the producer waits for the
+oldest window, so the memory held by queued windows is bounded and decoding does not run ahead of the kernels.
+Results come back in window order, so the output lines are the same as a serial scan.
+
+Kernels have to be stateless (rolling hash and PBWT counters update their state window after window and stay serial).
+"""
+
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+### FUNCTIONS ###
+
+def ordered_window_map(func, windows, threads=1, max_pending=None):
+    """
+    Runs func on each window on a pool of threads and yields the results in window order.
+
+    :param func: statistic kernel of a window, it must not keep state between windows
+    :type func: callable
+    :param windows: (key, args) of each window in order, func is called as func(*args). The windows are only taken from the
+        iterable as the queue has room, and array arguments are copied before they are queued since sliced windows are views
+        of a sliding window that the next slice overwrites
+    :type windows: iterable of (object, tuple)
+    :param threads: number of threads running func, 1 runs the windows one after another in the calling thread, defaults to 1
+    :type threads: int, optional
+    :param max_pending: maximum number of windows queued or running, defaults to 2 x threads
+    :type max_pending: int, optional
+
+    :returns: key and result of func of each window, in window order
+    :rtype: generator of (object, object)
+    """
+
+    #serial scan, no copies
+    if threads <= 1:
+        for key, args in windows:
+            yield key, func(*args)
+        return
+
+    if max_pending is None:
+        max_pending = 2 * threads
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for key, args in windows:
+
+            #own copies of the sliced arrays
+            args = [np.array(arg) if isinstance(arg, np.ndarray) else arg for arg in args]
+            pending.append((key, executor.submit(func, *args)))
+
+            #wait for the oldest window while the queue is full, and pass on the windows that are already done
+            while len(pending) > max_pending or (len(pending) > 0 and pending[0][1].done()):
+                key, future = pending.popleft()
+                yield key, future.result()
+
+        while len(pending) > 0:
+            key, future = pending.popleft()
+            yield key, future.result()
@@ -0,0 +1,359 @@
+"""
+Buffered writers and fast loaders for the windowed scan outputs.
+
+The scanners used to format every window into a text line and write it on its own. A window table can
+instead be written as a columnar .npz (the zip of .npy arrays that np.savez writes and np.load reads): rows are
+buffered per column and written to the zip as one array per column every chunk_rows rows, so memory stays bounded
+and runs of empty windows are written as whole arrays. Downstream scripts load the columns straight into a
+DataFrame instead of re-parsing multi GB text files with pd.read_csv, and window_table_to_text exports a table
+back to text (e.g. a bedgraph) when a text file is needed.
+
+Members of a window table .npz:
+    c{column}.{chunk}   values of a column for one chunk of rows, e.g. c3.000002
+    __columns__         column names
+    __chunks__          number of chunks, written last so a partly written table is never loaded
+
+TextTableWriter writes the same rows to a text file, so a scanner can write either format through the same calls.
+"""
+
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+from hapmatrix import write_empty_windows
+
+
+### HELPER FUNCTIONS ###
+
+def _write_member(zf, name, array):
+    """
+    Helper writes an array as a .npy member of an open zip file
+    """
+
+    #string columns of a DataFrame come as object arrays
+    array = np.asarray(array)
+    if array.dtype == object:
+        array = array.astype(str)
+
+    with zf.open(name + ".npy", "w", force_zip64=True) as member:
+        np.lib.format.write_array(member, array, allow_pickle=False)
+
+
+
+def _column_name(column):
+    """
+    Helper strips the # of a text header column e.g. #CHROM -> CHROM
+    """
+
+    return column.lstrip("#")
+
+
+
+### CLASSES ###
+
+class TextTableWriter():
+    def __init__(self, path, columns, sep=",", header=True, mode="a"):
+        """
+        This class writes the rows of a window table as text lines, same lines as the scanners always wrote.
+
+        :param path: output file name or path to file
+        :type path: str
+        :param columns: column names for the header line
+        :type columns: list of str
+        :param sep: column separator, defaults to ","
+        :type sep: str, optional
+        :param header: write the header line, defaults to True
+        :type header: bool, optional
+        :param mode: file mode, defaults to "a"
+        :type mode: str, optional
+        """
+
+        self.sep = sep
+        self.outfile = open(path, mode)
+        if header:
+            self.outfile.write(sep.join(columns) + "\n")
+
+
+    def write_row(self, row):
+        """
+        Writes one window, the row can be shorter than the header e.g. for an empty window
+        """
+
+        self.outfile.write(self.sep.join([str(x) for x in row]) + "\n")
+
+
+    def write_block(self, chrom, win_starts, win_ends, fill):
+        """
+        Writes a run of windows that only differ by their coordinates (e.g. empty windows) in one vectorized block
+        """
+
+        write_empty_windows(self.outfile, chrom, win_starts, win_ends, self.sep.join([str(x) for x in fill]), self.sep)
+
+
+    def close(self):
+        self.outfile.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+class WindowTableWriter():
+    def __init__(self, path, columns, chunk_rows=100000):
+        """
+        This class writes the rows of a window table to a columnar .npz, see the module docstring for the layout.
+        Rows shorter than the columns are padded with nan.
+
+        :param path: output file name or path to file, overwritten
+        :type path: str
+        :param columns: column names, a leading # is dropped
+        :type columns: list of str
+        :param chunk_rows: number of rows buffered before they are written as a chunk, defaults to 100000
+        :type chunk_rows: int, optional
+
+        Attributes:
+            columns (list of str): column names
+            num_chunks (int): number of chunks written so far
+        """
+
+        self.columns = [_column_name(c) for c in columns]
+        self.chunk_rows = chunk_rows
+        self.num_chunks = 0
+        self._rows = [[] for c in self.columns]
+        self._zf = zipfile.ZipFile(path, "w", allowZip64=True)
+
+
+    def _write_chunk(self, arrays):
+        """
+        Writes one array per column as the next chunk
+        """
+
+        for j, array in enumerate(arrays):
+            _write_member(self._zf, f"c{j}.{self.num_chunks:06d}", array)
+        self.num_chunks += 1
+
+
+    def flush(self):
+        """
+        Writes the buffered rows as a chunk
+        """
+
+        if len(self._rows[0]) == 0:
+            return
+
+        self._write_chunk([np.asarray(values) for values in self._rows])
+        self._rows = [[] for c in self.columns]
+
+
+    def write_row(self, row):
+        """
+        Buffers one window
+        """
+
+        for j in range(len(self.columns)):
+            self._rows[j].append(row[j] if j < len(row) else np.nan)
+
+        if len(self._rows[0]) >= self.chunk_rows:
+            self.flush()
+
+
+    def write_block(self, chrom, win_starts, win_ends, fill):
+        """
+        Writes a run of windows that only differ by their coordinates (e.g. empty windows) as whole column arrays
+        """
+
+        if len(win_starts) == 0:
+            return
+
+        #keep the rows in order
+        self.flush()
+
+        num_rows = len(win_starts)
+        arrays = [np.full(num_rows, chrom), np.asarray(win_starts), np.asarray(win_ends)]
+        for j in range(3, len(self.columns)):
+            arrays.append(np.full(num_rows, fill[j - 3] if j - 3 < len(fill) else np.nan))
+
+        self._write_chunk(arrays)
+
+
+    def close(self):
+        """
+        Writes the last rows and the table members
+        """
+
+        self.flush()
+        _write_member(self._zf, "__columns__", np.array(self.columns))
+        _write_member(self._zf, "__chunks__", np.array(self.num_chunks))
+        self._zf.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+### WRITER AND LOADER FUNCTIONS ###
+
+def open_window_table(path, columns, outformat="text", sep=",", header=True, mode="a"):
+    """
+    Opens a writer for the windows of a scan.
+
+    :param path: output file name or path to file
+    :type path: str
+    :param columns: column names
+    :type columns: list of str
+    :param outformat: "npz" for a columnar WindowTableWriter, anything else for a TextTableWriter, defaults to "text"
+    :type outformat: str, optional
+    :param sep: text column separator, defaults to ","
+    :type sep: str, optional
+    :param header: write the text header line, defaults to True
+    :type header: bool, optional
+    :param mode: text file mode, defaults to "a"
+    :type mode: str, optional
+
+    :returns: writer with write_row, write_block and close methods
+    :rtype: WindowTableWriter or TextTableWriter
+    """
+
+    if outformat == "npz":
+        return WindowTableWriter(path, columns)
+
+    return TextTableWriter(path, columns, sep, header, mode)
+
+
+
+def load_window_table(path, columns=None):
+    """
+    Loads a window table written by WindowTableWriter.
+
+    :param path: window table .npz file name or path to file
+    :type path: str
+    :param columns: names of the columns to load, defaults to all of them
+    :type columns: list of str, optional
+
+    :returns: window table
+    :rtype: DataFrame
+    """
+
+    with np.load(path) as npz:
+
+        if "__chunks__" not in npz.files:
+            exit(f"{path} is not a finished window table")
+
+        names = [str(c) for c in npz["__columns__"]]
+        num_chunks = int(npz["__chunks__"])
+
+        data = {}
+        for j, name in enumerate(names):
+            if columns is not None and name not in columns:
+                continue
+            chunks = [npz[f"c{j}.{k:06d}"] for k in range(num_chunks)]
+            data[name] = np.concatenate(chunks) if num_chunks > 0 else np.array([])
+
+    return pd.DataFrame(data, columns=[n for n in names if n in data])
+
+
+
+def save_window_table(df, path):
+    """
+    Writes a DataFrame (e.g. a filtered window table) as a window table .npz
+    """
+
+    writer = WindowTableWriter(path, list(df.columns))
+    if len(df) > 0:
+        writer._write_chunk([df[c].to_numpy() for c in df.columns])
+    writer.close()
+
+
+
+def load_bedgraph(path, names):
+    """
+    Loads a bedgraph of windowed data as a DataFrame, from a window table .npz or from a headerless text bedgraph.
+    For a window table the CHROM, START and END columns and the last column are taken, same as a bedgraph cut from it.
+
+    :param path: window table .npz or bedgraph file name or path to file
+    :type path: str
+    :param names: names to give the 4 columns e.g. ["CHROM", "START", "END", "DATA"]
+    :type names: list of str
+
+    :returns: bedgraph data
+    :rtype: DataFrame
+    """
+
+    if path.endswith(".npz"):
+        df = load_window_table(path)
+        df = df[list(df.columns[:3]) + [df.columns[-1]]]
+        df.columns = names
+        return df
+
+    return pd.read_csv(path, sep="\t", header=None, names=names)
+
+
+
+def window_table_to_text(path, textfile, columns=None, sep="\t", header=True):
+    """
+    Exports a window table .npz as text e.g. a bedgraph with columns=["CHROM", "START", "END", "hapcount"] and header=False.
+
+    :param path: window table .npz file name or path to file
+    :type path: str
+    :param textfile: output text file
+    :type textfile: str
+    :param columns: columns to export, defaults to all of them
+    :type columns: list of str, optional
+    :param sep: column separator, defaults to tab
+    :type sep: str, optional
+    :param header: write a header line, defaults to True
+    :type header: bool, optional
+    """
+
+    df = load_window_table(path, columns)
+    if columns is not None:
+        df = df[columns]
+
+    df.to_csv(textfile, sep=sep, index=False, header=header)
+
+
+
+def stitch_window_tables(paths, outfile):
+    """
+    Concatenates window tables in order (e.g. the shard outputs of a scan) by copying their chunks, then removes them.
+
+    :param paths: window table files in row order
+    :type paths: list of str
+    :param outfile: output window table
+    :type outfile: str
+    """
+
+    columns = None
+    num_chunks = 0
+    with zipfile.ZipFile(outfile, "w", allowZip64=True) as out:
+        for path in paths:
+            with np.load(path) as npz:
+                columns = [str(c) for c in npz["__columns__"]]
+                chunks = int(npz["__chunks__"])
+
+            #copying the raw .npy members with renumbered chunks
+            with zipfile.ZipFile(path, "r") as shard:
+                for k in range(chunks):
+                    for j in range(len(columns)):
+                        with shard.open(f"c{j}.{k:06d}.npy", "r") as member, out.open(f"c{j}.{num_chunks:06d}.npy", "w", force_zip64=True) as copy:
+                            while True:
+                                block = member.read(1 << 20)
+                                if not block:
+                                    break
+                                copy.write(block)
+                    num_chunks += 1
+
+            os.remove(path)
+
+        _write_member(out, "__columns__", np.array(columns if columns is not None else []))
+        _write_member(out, "__chunks__", np.array(num_chunks))
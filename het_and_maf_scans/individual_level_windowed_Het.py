@@ -1,9 +1,13 @@
+import os
+import sys
 import gzip
 import csv
 import numpy as np
 from statistics import geometric_mean
 from scipy.stats import pmean
 from multiprocessing import Pool
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from hapmatrix import HapMatrix, hapmatrix_exists
 
 
 def vcf2persiteHet(vcfgz):
@@ -21,6 +25,10 @@ def vcf2persiteHet(vcfgz):
 
     print(f"Loading data from {vcfgz}...")
 
+    #read from the bit-packed haplotype matrix if it was built for this vcf
+    if hapmatrix_exists(vcfgz):
+        return _hapmatrix2persiteHet(vcfgz)
+
     #Hom Het matrix
     homhet_data = []
 
@@ -69,6 +77,65 @@ def vcf2persiteHet(vcfgz):
 
 
 
+def _hapmatrix2persiteHet(vcfgz, block_size=10000):
+    """
+    Builds the same per site HomHet matrix as vcf2persiteHet from the bit-packed haplotype matrix
+    built with haplotype_matrix/hapmatrix.py. A sample is heterozygous where its two haplotypes differ.
+    Sites are unpacked in blocks of block_size to keep memory down.
+    """
+
+    #open haplotype matrix
+    hapmat = HapMatrix(vcfgz)
+    chrom = hapmat.chrom
+
+    header = ["CHROM", "POS"] + hapmat.samples + ["Geometric_mean", "p10_mean"]
+
+    #only diploid samples have a Hom/Het call
+    num_cols = len(hapmat.samples) if hapmat.ploidy == 2 else 0
+
+    #Hom Het matrix
+    homhet_data = np.zeros((hapmat.num_sites, num_cols + 1), dtype=np.int64)
+    homhet_data[:, 0] = hapmat.positions
+
+    if num_cols > 0:
+        for start in range(0, hapmat.num_sites, block_size):
+            end = min(start + block_size, hapmat.num_sites)
+            haps = hapmat.sites(start, end)
+            homhet_data[start:end, 1:] = haps[:, 0::2] != haps[:, 1::2]
+
+    print(f"FINISHED loading data from {vcfgz}")
+
+    return chrom, header, homhet_data
+
+
+
+
+def _windowed_het(homhet_chunk, chunk_length):
+    """
+    Helper computes the windowed heterozygosity of each sample from the HomHet data of a window,
+    and the geometric mean and p^10 mean of heterozygosity across samples.
+    Used by persite2windowedHet and the het kernel of fused_window_scan.py.
+
+    homhet_chunk (np.ndarray): each row is a site and each column is 0 (Hom) or 1 (Het) for a sample
+    chunk_length (int): window length in bps
+
+    Returns np array of per sample windowed heterozygosity, geometric mean, p10 mean
+    """
+
+    #summing per site heterozygosity
+    winHets = np.sum(homhet_chunk, axis=0, dtype=np.float64)
+    
+    #normalizing by window length
+    winHets /= chunk_length
+    #compute geometrix mean
+    geomean = geometric_mean([x for x in winHets if x > 0])
+    #compute p^10 mean
+    p10mean = pmean(winHets, 10)
+
+    return winHets, geomean, p10mean
+
+
+
 
 def persite2windowedHet(matrix, chromosome, header, SNPwindow, SNPstep):    #persitefile
     """
@@ -102,15 +169,8 @@ def persite2windowedHet(matrix, chromosome, header, SNPwindow, SNPstep):    #per
         chunkpos = (startpos + endpos) // 2
         chunk_length = (endpos - startpos) + 1
 
-        #summing per site heterozygosity
-        winHets = np.sum(chunk[:, 1:], axis=0, dtype=np.float64)
-        
-        #normalizing by window length
-        winHets /= chunk_length
-        #compute geometrix mean
-        geomean = geometric_mean([x for x in winHets if x > 0])
-        #compute p^10 mean
-        p10mean = pmean(winHets, 10)
+        #windowed heterozygosity of each sample and means across samples
+        winHets, geomean, p10mean = _windowed_het(chunk[:, 1:], chunk_length)
 
         #outputting to file
         output_row = [chromosome, chunkpos] + list(winHets) + [geomean, p10mean]
@@ -141,10 +201,11 @@ def main_func(vcffile):
 #main_func("beagle_phased_biallelic_SNPs_1000GP30X_chr10.vcf.gz")
 
 
-main_func("beagle_phased_biallelic_SNPs_1000GP30X_chr19.vcf.gz")
-main_func("beagle_phased_biallelic_SNPs_1000GP30X_chr17.vcf.gz")
-main_func("beagle_phased_biallelic_SNPs_1000GP30X_chr15.vcf.gz")
-main_func("beagle_phased_biallelic_SNPs_1000GP30X_chr14.vcf.gz")
+if __name__ == '__main__':
+    main_func("beagle_phased_biallelic_SNPs_1000GP30X_chr19.vcf.gz")
+    main_func("beagle_phased_biallelic_SNPs_1000GP30X_chr17.vcf.gz")
+    main_func("beagle_phased_biallelic_SNPs_1000GP30X_chr15.vcf.gz")
+    main_func("beagle_phased_biallelic_SNPs_1000GP30X_chr14.vcf.gz")
 
 
 """
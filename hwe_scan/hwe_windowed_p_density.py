@@ -1,4 +1,9 @@
-from collections import deque
+import os
+import sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from window_buffer import WindowBuffer
+from window_kernels import count_at_or_before, prop_below
 
 
 ### HELPER FUNCTIONS ###
@@ -12,40 +17,27 @@ def _joinany(sep, mylist):
 
 
 
-def _pop_bp_step(d, step):
+def _pop_bp_step(window, step):
     """
-    Helper function used to pop a number of elements from the left
-    of a deque equal to the step size in. This is done in place.
+    Helper function used to drop the sites at or before the step position
+    from the start of the window. This is done in place.
     """
 
-    #count how many elements to pop
-    count_ele_to_pop = 0
-    for idx in range(len(d)):
-        if d[idx].position <= step:
-            count_ele_to_pop += 1
-        else:
-            break
-    
+    #count how many sites to pop (see haplotype_matrix/window_kernels.py)
+    count_ele_to_pop = count_at_or_before(window.positions(), step)
+
     #pop from left
-    for i in range(count_ele_to_pop):
-        d.popleft()
+    window.pop(count_ele_to_pop)
 
 
-def _compute_sigp_density(deque_window, thresh):
+def _compute_sigp_density(window, thresh):
     """
-    Helper function that computes the proportion of p-values in a deque
+    Helper function that computes the proportion of p-values in a window
     that are below a specified threshold
     """
 
-    #count significant p values
-    ps_below = [x.pval for x in deque_window if x.pval < thresh]
-    sigPs = len(ps_below)
-
-    #count total p values
-    totPs = len(deque_window)
-
-    #significant p-value density
-    den = sigPs/totPs
+    #significant p-value density (see haplotype_matrix/window_kernels.py)
+    den = prop_below(window.matrix(), thresh)
 
     return den
 
@@ -92,8 +84,8 @@ def windowed_p_density_scan(plink_hwe, window_size, window_step, significance_th
     :type significance_threshold: float
     """
 
-    #setting up deque for sliding window
-    window_deque = deque()
+    #setting up the array-backed sliding window of p-values (see haplotype_matrix/window_buffer.py)
+    window_deque = WindowBuffer(dtype=np.float64)
 
     #open files
     with open(plink_hwe, "r") as vcf, open(f"hwe_{significance_threshold}pvalue_windowed_density_{window_size}bpwin_{window_step}step.bedgraph", "w") as outbedgraph:
@@ -122,8 +114,8 @@ def windowed_p_density_scan(plink_hwe, window_size, window_step, significance_th
                 sigPdensity = _compute_sigp_density(window_deque, significance_threshold)
                 #write to file
                 outbedgraph.write(_joinany("\t", [f"chr{chrom}", win_start, win_end, sigPdensity]) + "\n")
-                #empty deque
-                window_deque = deque()
+                #empty window
+                window_deque.clear()
                 #reset window bookeeping
                 print(f"Done running through Chromosome {chrom}")
                 chrom = current_record.chromosome
@@ -137,7 +129,7 @@ def windowed_p_density_scan(plink_hwe, window_size, window_step, significance_th
                     exit("Record position before window start position")
                 
                 if current_record.position <= win_end:
-                    window_deque.append(current_record)
+                    window_deque.append(current_record.position, current_record.pval)
                     continue
 
             #increment window until position is reached
@@ -160,8 +152,8 @@ def windowed_p_density_scan(plink_hwe, window_size, window_step, significance_th
                 win_start = win_end - window_size + 1
                 win_step = win_start + window_step
                 
-            #append current record to deque
-            window_deque.append(current_record)
+            #append current record to window
+            window_deque.append(current_record.position, current_record.pval)
 
         #clean up last window
         if len(window_deque) > 0:
@@ -1,5 +1,8 @@
-import pandas as pd
+import os
+import sys
 import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from window_table import load_bedgraph, save_window_table
 
 
 
@@ -36,9 +39,10 @@ def remove_bad_regions(bedgraph_df, region_list):
 
 def main(bedgraph, remove_regions, outfile):
     """
-    Main function that runs remove_bad_regions and outputs a bedgraph file
+    Main function that runs remove_bad_regions and outputs a bedgraph file.
+    Window tables (.npz, see haplotype_matrix/window_table.py) are loaded without parsing text and an .npz outfile is written as a window table.
     
-    :param bedfile: bedfile name
+    :param bedfile: bedfile or window table name
     :type bedfile: str
     :param remove_regions: list of tuples with regions to remove
     :type remove_regions: List of Tuples
@@ -49,11 +53,14 @@ def main(bedgraph, remove_regions, outfile):
     """
 
     #opening file
-    df = pd.read_csv(bedgraph, sep="\t", header=None, names=["CHROM", "START", "END", "PARAMETER"])
+    df = load_bedgraph(bedgraph, ["CHROM", "START", "END", "PARAMETER"])
 
     cleaned_df = remove_bad_regions(df, remove_regions)
 
-    cleaned_df.to_csv(outfile, sep="\t", index=False, header=False)
+    if outfile.endswith(".npz"):
+        save_window_table(cleaned_df, outfile)
+    else:
+        cleaned_df.to_csv(outfile, sep="\t", index=False, header=False)
 
 
 
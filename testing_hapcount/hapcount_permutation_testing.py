@@ -10,13 +10,14 @@ Note that averaging was done as a whole instead of computing an average of avera
 
 
 import os,sys
-import pandas as pd
 import numpy as np
 from statistics import mean
 from statistics import stdev
 import scipy.stats
 import random
 import matplotlib.pyplot as plt
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from window_table import load_bedgraph
 
 
 random.seed(349)
@@ -339,7 +340,8 @@ def run_ztest_on_coordinates(bedgraph, breakpoint_coordinates, num_permutations,
     Main function to run permutation Z-test on last bedgraph column (Proportion of unique haplotypes) to test for a significant difference
     between its values in breakpoints versus genome wide
     
-    :param bedgraph: bedgraph file of windowed data. There shouldnt be a header line but the columns should be CHROM, START, END, Proportion of Unique Haplotypes
+    :param bedgraph: bedgraph file of windowed data. There shouldnt be a header line but the columns should be CHROM, START, END, Proportion of Unique Haplotypes.
+        A window table .npz (see haplotype_matrix/window_table.py) is loaded with its last column as the data
     :param coordinates_to_extract: list of tuples with regions to include [("chrom", start, end)...]
     :param num_permutations: number of permutations
     :param plottitle: Title of plot and name of filename
@@ -352,7 +354,7 @@ def run_ztest_on_coordinates(bedgraph, breakpoint_coordinates, num_permutations,
 
     print("Running Permutation...")
 
-    data = pd.read_csv(bedgraph, sep="\t", header=None, names=["CHROM", "START", "END", "Proportion_of_Unique_Haplotypes"])
+    data = load_bedgraph(bedgraph, ["CHROM", "START", "END", "Proportion_of_Unique_Haplotypes"])
 
     top, num_windows_ls = _avg_from_windows_within_coordinates(data, breakpoint_coordinates, "Proportion_of_Unique_Haplotypes")
     
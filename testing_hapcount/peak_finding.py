@@ -1,7 +1,10 @@
-import pandas as pd
+import os
+import sys
 import numpy as np
 from statsmodels.nonparametric.smoothers_lowess import lowess
 from scipy.signal import find_peaks
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from window_table import load_bedgraph
 
 
 def _chrom_sorter(chrom_name):
@@ -226,7 +229,7 @@ def find_peaks_from_bedgraph_v1(bedgraph):
     "CHROM", "START", "END", and "DATA" and filtering by chromsome. Each chromosome df is then passed to the peak identifying functions.
     The function outputs a list for each peak idenitfication method used.
 
-    :param bedgraph: filename for the input bedgraph
+    :param bedgraph: filename for the input bedgraph, or a window table .npz whose last column is the data (see haplotype_matrix/window_table.py)
     :type bedgraph: str
 
     :returns: 5 lists for each of the peak identification methods used
@@ -235,7 +238,7 @@ def find_peaks_from_bedgraph_v1(bedgraph):
 
     #loading data
     print("LOADING BEDGRAPH FILE...")
-    df = pd.read_csv(bedgraph, sep="\t", header=None, names=["CHROM", "START", "END", "DATA"])
+    df = load_bedgraph(bedgraph, ["CHROM", "START", "END", "DATA"])
 
     #grabbing chromosomes
     chromosomes = _get_chromosomes_in_order(df["CHROM"])
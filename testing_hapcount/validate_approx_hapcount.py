@@ -0,0 +1,119 @@
+"""
+Validation of the approximate hapcount mode (see haplotype_matrix/hap_sketch.py) against the exact counts of
+_count_unique_haps in hapcount_scan.py. Every window of a SNP window scan is counted exactly and with a sketch
+for each (relative error, sketch) setting, and the error of the estimates is compared to the error bound the
+approximate scan writes for them.
+"""
+
+import os
+import sys
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+from hapcount_scan import _count_unique_haps
+from hapmatrix import HapMatrix, SampleView, hapmatrix_exists, snp_window_bounds, load_positions, vcf_samples, read_sample_manifest
+from shards import ShardSites
+from hap_sketch import SketchHapCounter
+
+
+
+def compare_approx_hapcount(vcfgz, SNPwindow_size, SNPwindow_step, settings, manifest=None, decompress_threads=1):
+    """
+    Counts the unique haplotypes of every window of a SNP window scan exactly and approximately.
+
+    :param vcfgz: gziped and tabix indexed vcf file name or path to file, the haplotype matrix is used if it was built
+    :type vcfgz: str
+    :param SNPwindow_size: number of SNPs per window
+    :type SNPwindow_size: int
+    :param SNPwindow_step: number of SNPs to slide the window
+    :type SNPwindow_step: int
+    :param settings: (relative error, sketch) of each approximate count e.g. [(0.01, "kmv"), (0.01, "hll")]
+    :type settings: list of (float, str)
+    :param manifest: sample manifest of the samples to count, defaults to all samples
+    :type manifest: str, optional
+    :param decompress_threads: number of threads inflating the vcf, defaults to 1
+    :type decompress_threads: int, optional
+
+    :returns: one row per window and setting with the exact and approximate counts, the relative difference and the error bound
+    :rtype: DataFrame
+    """
+
+    #sites of the chromosome
+    positions = load_positions(vcfgz, decompress_threads)
+    if hapmatrix_exists(vcfgz):
+        hapsites = HapMatrix(vcfgz)
+        samples = hapsites.samples
+    else:
+        hapsites = ShardSites(vcfgz, positions, 0, len(positions), decompress_threads)
+        samples = vcf_samples(vcfgz)
+    if manifest is not None:
+        hapsites = SampleView(hapsites, samples, read_sample_manifest(manifest))
+
+    counters = [SketchHapCounter(rel_error, sketch) for rel_error, sketch in settings]
+
+    rows = []
+    for lo, hi in snp_window_bounds(len(positions), SNPwindow_size, SNPwindow_step):
+
+        hap_m = hapsites.sites(lo, hi)
+        start_pos = int(positions[lo])
+        exact = _count_unique_haps(hap_m)[0]
+
+        for (rel_error, sketch), counter in zip(settings, counters):
+            approx = counter.count(hap_m, lo, hi)[0]
+            rows.append([start_pos, rel_error, sketch, exact, approx, (approx - exact) / exact, counter.error])
+
+    return pd.DataFrame(rows, columns=["START", "rel_error", "sketch", "exact", "approx", "rel_diff", "rse"])
+
+
+
+def summarize_errors(df):
+    """
+    Summarizes the errors of the approximate counts of each setting.
+
+    :param df: output of compare_approx_hapcount
+    :type df: DataFrame
+
+    :returns: number of windows, mean and max absolute relative difference, and the proportion of windows within 1, 2 and 3
+        relative standard errors of the exact count for each setting
+    :rtype: DataFrame
+    """
+
+    df = df.assign(abs_diff=df["rel_diff"].abs())
+
+    #windows counted exactly by KMV have an error bound of 0 and have to match
+    for z in [1, 2, 3]:
+        df[f"within_{z}rse"] = df["abs_diff"] <= z * df["rse"]
+
+    summary = df.groupby(["rel_error", "sketch"]).agg(
+        windows=("abs_diff", "size"), mean_abs_rel_diff=("abs_diff", "mean"), max_abs_rel_diff=("abs_diff", "max"),
+        rse=("rse", "max"), within_1rse=("within_1rse", "mean"), within_2rse=("within_2rse", "mean"), within_3rse=("within_3rse", "mean"))
+
+    return summary.reset_index()
+
+
+
+
+def main():
+
+    vcflist = [
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr21.vcf.gz",
+        "beagle_phased_biallelic_SNPs_1000GP30X_chr22.vcf.gz",
+        ]
+
+    windowing = [(1000, 100), (10000, 1000)]
+    #at 0.01 KMV keeps more hashes than there are haplotypes in the 1000GP and is exact, the larger errors check the estimates
+    settings = [(0.01, "kmv"), (0.01, "hll"), (0.05, "kmv"), (0.05, "hll"), (0.1, "kmv"), (0.1, "hll")]
+
+    summaries = []
+    for vcffile in vcflist:
+        chrom = vcffile.split("_")[-1].replace(".vcf.gz", "")
+        for size, step in windowing:
+            df = compare_approx_hapcount(vcffile, size, step, settings)
+            df.to_csv(f"{chrom}_SNPwindow{size}_SNPstep{step}_approx_hapcount_validation.csv", index=False)
+            summaries.append(summarize_errors(df).assign(CHROM=chrom, SNPwindow=size, SNPstep=step))
+
+    pd.concat(summaries).to_csv("approx_hapcount_validation_summary.csv", index=False)
+
+
+if __name__ == '__main__':
+    main()
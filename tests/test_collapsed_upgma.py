@@ -0,0 +1,79 @@
+"""
+Checks that the collapsed UPGMA of haplotype_matrix/collapsed_upgma.py gives scipy's linkage of all haplotypes to the
+last bit, on windows with many copies of few sites where the distances hold many ties, with every kernel backend.
+
+Run from the repository root with: python -m pytest tests
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+import window_kernels
+from collapsed_upgma import collapsed_linkage
+
+
+### HELPER FUNCTIONS ###
+
+BACKENDS = [
+    pytest.param("numpy", id="numpy"),
+    pytest.param("numba", id="numba", marks=pytest.mark.skipif(window_kernels._NUMBA is None, reason="numba is not installed")),
+]
+
+
+@pytest.fixture
+def backend(request):
+    """Helper runs a test with a kernel backend and puts the previous one back"""
+
+    previous = window_kernels.get_backend()
+    window_kernels.set_backend(request.param)
+    yield request.param
+    window_kernels.set_backend(previous)
+
+
+def _tied_windows(seed, num_windows):
+    """
+    Helper draws windows of copies of a few distinct haplotypes over a few sites, so that many pairs of haplotypes
+    are at the same distance
+    """
+
+    rng = np.random.default_rng(seed)
+    for w in range(num_windows):
+        num_distinct = int(rng.integers(1, 40))
+        distinct = rng.integers(0, 2, (int(rng.integers(1, 10)), num_distinct), dtype=np.uint8)
+        yield distinct[:, rng.integers(0, num_distinct, int(rng.integers(2, 300)))]
+
+
+def _full_linkage(haplo_matrix):
+    """Helper runs scipy's UPGMA on all haplotypes of a window"""
+
+    return linkage(pdist(haplo_matrix.T.astype(np.float64)), "average")
+
+
+
+### TESTS ###
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_tied_distances_match_linkage(backend):
+    for haplo_matrix in _tied_windows(7, 200):
+        assert collapsed_linkage(haplo_matrix).tobytes() == _full_linkage(haplo_matrix).tobytes()
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_picked_distances_match_linkage(backend):
+    #distances picked out of those of all haplotypes, like the sliding Hamming distances of the SNP window scans
+    for haplo_matrix in _tied_windows(8, 50):
+        hap_dists = pdist(haplo_matrix.T.astype(np.float64))
+        assert collapsed_linkage(haplo_matrix, hap_dists).tobytes() == _full_linkage(haplo_matrix).tobytes()
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_identical_haplotypes(backend):
+    haplo_matrix = np.ones((5, 9), dtype=np.uint8)
+
+    Z = collapsed_linkage(haplo_matrix)
+    assert not Z[:, 2].any()
+    assert Z.tobytes() == _full_linkage(haplo_matrix).tobytes()
@@ -0,0 +1,124 @@
+"""
+Checks the downsampled UPGMA statistics of haplotype_matrix/downsampled_upgma.py on draws of identical haplotypes, which
+small draws hit in the sparse windows of bp scans, and runs a downsampled bp window scan over sparse windows with every kernel backend.
+
+Run from the repository root with: python -m pytest tests
+"""
+
+import os
+import sys
+import gzip
+import numpy as np
+import pandas as pd
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "UPGMA_scan"))
+import window_kernels
+from downsampled_upgma import Downsampling, downsampled_stats
+import bp_windows_UPGMA_windowed_scan as bp_scan
+
+
+### HELPER FUNCTIONS ###
+
+BACKENDS = ["numpy"] + (["numba"] if window_kernels._NUMBA is not None else [])
+
+
+def _never(haplo_matrix):
+    """Helper statistic that fails if a draw is not skipped"""
+
+    raise AssertionError("draw of identical haplotypes was not skipped")
+
+
+def _write_vcf(path, positions, haplotypes):
+    """Helper writes a gziped phased vcf, haplotypes has one row per site and one column per haplotype"""
+
+    num_samples = haplotypes.shape[1] // 2
+    with gzip.open(path, "wt") as vcf:
+        vcf.write("##fileformat=VCFv4.2\n")
+        vcf.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + [f"S{i}" for i in range(num_samples)]) + "\n")
+        for position, alleles in zip(positions, haplotypes):
+            gts = [f"{alleles[2 * i]}|{alleles[2 * i + 1]}" for i in range(num_samples)]
+            vcf.write("\t".join(["chr21", str(position), ".", "A", "G", ".", "PASS", ".", "GT"] + gts) + "\n")
+
+
+def _sparse_vcf(path):
+    """
+    Helper writes a vcf of 20 haplotypes with a dense stretch of common variants followed by single
+    rare variants far apart, so that the bp windows of the rare variants often draw identical haplotypes
+    """
+
+    rng = np.random.default_rng(11)
+    dense_positions = np.arange(1, 4000, 100)
+    dense = rng.integers(0, 2, (len(dense_positions), 20))
+    sparse_positions = np.arange(20000, 80000, 7000)
+    sparse = np.zeros((len(sparse_positions), 20), dtype=np.int64)
+    sparse[np.arange(len(sparse_positions)), rng.integers(0, 20, len(sparse_positions))] = 1
+    #a monomorphic site, every haplotype is the same
+    sparse[-1] = 0
+
+    _write_vcf(path, np.concatenate([dense_positions, sparse_positions]), np.concatenate([dense, sparse]))
+
+
+
+### TESTS ###
+
+def test_identical_draws_are_nan():
+    haplo_matrix = np.ones((3, 10), dtype=np.uint8)
+    draws = [np.arange(4), np.arange(3, 9)]
+
+    stats = downsampled_stats(_never, haplo_matrix, draws, 3)
+    assert len(stats) == 6
+    assert np.isnan(stats).all()
+
+
+def test_identical_draws_are_skipped():
+    haplo_matrix = np.zeros((2, 8), dtype=np.uint8)
+    haplo_matrix[0, 5] = 1
+    #only the second and third draws hold haplotype 5
+    draws = [np.arange(4), np.array([4, 5]), np.array([5, 6, 7])]
+
+    stats = downsampled_stats(lambda hap_m: hap_m.shape[1], haplo_matrix, draws)
+    assert stats == [2.5, float(np.std([2, 3], ddof=1))]
+
+    stats = downsampled_stats(lambda hap_m: hap_m.shape[1], haplo_matrix, draws[:2])
+    assert stats == [2.0, 0.0]
+
+
+def test_sparse_bp_windows(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _sparse_vcf("sparse_chr21.vcf.gz")
+
+    #same output with every kernel backend
+    outputs = []
+    previous = window_kernels.get_backend()
+    for backend in BACKENDS:
+        window_kernels.set_backend(backend)
+        try:
+            bp_scan.windowed_UPGMA_scan("sparse_chr21.vcf.gz", 3000, 1000, downsample=Downsampling(3, 4, 7))
+        finally:
+            window_kernels.set_backend(previous)
+        with open("chr21_window3000_step1000_downsample3x4_avg_branch_len.csv") as outcsv:
+            outputs.append(outcsv.read())
+        os.rename("chr21_window3000_step1000_downsample3x4_avg_branch_len.csv", f"{backend}.csv")
+    assert all(output == outputs[0] for output in outputs)
+
+    bp_scan.windowed_UPGMA_scan("sparse_chr21.vcf.gz", 3000, 1000)
+    sampled = pd.read_csv(f"{BACKENDS[0]}.csv")
+    full = pd.read_csv("chr21_window3000_step1000_avg_branch_len.csv")
+    assert len(sampled) == len(full) == 74
+    stats = sampled.loc[:, "AVG_branch_length":"Tree_Height_sd"]
+
+    #empty windows are written as 0
+    empty = full.SNP_density == 0
+    assert (stats[empty] == 0).all(axis=None)
+
+    #the monomorphic site, every draw is skipped
+    monomorphic = full.START == 73001
+    assert full.AVG_branch_length[monomorphic].isna().all()
+    assert stats[monomorphic].isna().all(axis=None)
+
+    #single rare variants: windows where every draw misses the variant are nan, the others average the draws holding it
+    rare = ~empty & ~monomorphic & (full.START > 4000)
+    assert sampled.Tree_Height[rare].isna().any()
+    assert sampled.Tree_Height[rare].notna().any()
+    assert (sampled.Tree_Height[rare].dropna() == 1).all()
+    assert (sampled.Tree_Height_sd[rare].dropna() == 0).all()
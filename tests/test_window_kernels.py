@@ -0,0 +1,111 @@
+"""
+Checks that the kernel backends of haplotype_matrix/window_kernels.py give bit-identical results, on random windows and
+on the edge cases of the scans: trees of height 0, empty windows, identical haplotypes and a single pair of haplotypes.
+
+The plain Python loops are compared with NumPy everywhere, the numba compiled loops only when numba is installed.
+
+Run from the repository root with: python -m pytest tests
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+from scipy.cluster.hierarchy import linkage
+from scipy.spatial.distance import pdist
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "haplotype_matrix"))
+import window_kernels
+from window_kernels import check_backends
+from packed_distances import pack_haplotypes
+
+
+### HELPER FUNCTIONS ###
+
+BACKENDS = [
+    pytest.param("loops", id="loops"),
+    pytest.param("numba", id="numba", marks=pytest.mark.skipif(window_kernels._NUMBA is None, reason="numba is not installed")),
+]
+
+
+def _kernels(backend):
+    """Helper gives the kernels compared with the NumPy kernels"""
+
+    return window_kernels._LOOPS if backend == "loops" else window_kernels._NUMBA
+
+
+def _same(name, backend, *args):
+    """Helper runs a kernel with NumPy and another backend and checks that the results have the same bits, nan included"""
+
+    expected = np.asarray(window_kernels._NUMPY[name](*args), dtype=np.float64)
+    result = np.asarray(_kernels(backend)[name](*args), dtype=np.float64)
+
+    assert result.shape == expected.shape
+    assert result.tobytes() == expected.tobytes()
+
+    return result
+
+
+### TESTS ###
+
+def test_random_windows():
+    assert check_backends(num_windows=100, seed=1) == []
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_zero_height_tree(backend):
+    assert np.isnan(_same("avg_branch", backend, np.zeros(5)))
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_zero_height_public_kernel(backend):
+    #the kernel the scans call, with the backend in use
+    previous = window_kernels.get_backend()
+    window_kernels._kernels = _kernels(backend)
+    try:
+        assert np.isnan(window_kernels.avg_branch(np.zeros(3)))
+    finally:
+        window_kernels.set_backend(previous)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_empty_maf_arrays(backend):
+    mafs = np.array([], dtype=np.float64)
+    assert _same("count_rare", backend, mafs, 0.05) == 0
+    assert _same("count_common", backend, mafs, 0.05) == 0
+    assert _same("count_at_or_before", backend, np.array([], dtype=np.int64), 100) == 0
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_identical_haplotypes(backend):
+    haps = np.ones((12, 70), dtype=np.uint8)
+
+    counts = _same("pair_mismatches", backend, pack_haplotypes(haps.T))
+    assert not counts.any()
+
+    #UPGMA of identical haplotypes, every merge at height 0
+    Z = _same("average_linkage", backend, np.zeros((1, 1)), np.zeros(12, dtype=np.int64))
+    assert not Z[:, 2].any()
+    assert Z[-1, 3] == 12
+    assert np.isnan(_same("avg_branch", backend, linkage(counts.astype(np.float64), "average")[:, 2]))
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_single_haplotype_pair(backend):
+    haps = np.array([[0, 1, 1, 0, 1], [1, 1, 0, 0, 1]], dtype=np.uint8)
+
+    counts = _same("pair_mismatches", backend, pack_haplotypes(haps.T))
+    assert counts.tolist() == [2]
+
+    #three copies of the first haplotype merge at height 0 before the second haplotype joins them
+    Z = _same("average_linkage", backend, np.array([[0.0, 2.0], [2.0, 0.0]]), np.array([0, 0, 1, 0], dtype=np.int64))
+    assert Z.tolist() == [[0.0, 1.0, 0.0, 2.0], [1.0, 3.0, 0.0, 3.0], [2.0, 3.0, 2.0, 4.0]]
+    assert _same("avg_branch", backend, Z[:, 2]) == (2 / 3) / 2
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_pair_mismatches_match_pdist(backend):
+    rng = np.random.default_rng(5)
+    haps = rng.integers(0, 2, (37, 150), dtype=np.uint8)
+
+    counts = _same("pair_mismatches", backend, pack_haplotypes(haps.T))
+    assert np.array_equal(counts, np.rint(pdist(haps, "hamming") * haps.shape[1]).astype(np.int32))
@@ -4,15 +4,20 @@ in each window with a defined <=frequency, window size in bp and window step in
 The program outputs a csv with MAF for each SNP in the vcf and a bedfile with the windowed results.
 """
 
-import gzip
-from collections import deque
+import os
+import sys
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "haplotype_matrix"))
+from bgzf_reader import bgzf_open
+from window_buffer import WindowBuffer
+from window_kernels import count_rare, count_common
 
 
 ### CLASSES ###
 class MafCsvRowLoader():
     def __init__(self, csvrow):
         """
-        This class is for parsing each row of the csv output from `persite_MAF` for it to be added to a deque.
+        This class is for parsing each row of the csv output from `persite_MAF` for it to be added to the sliding window.
         
         :param csvrow: row from the csv file output by `persite_MAF`
 
@@ -71,45 +76,22 @@ def _compute_record_MAF(record_GTs):
     return maf
 
 
-def _pop_bp_step(d, step):
-    """
-    Helper function used to pop a number of elements from the left
-    of a deque equal to the step size in bp. This is done in place.
-    """
-
-    #count how many elements to pop
-    count_ele_to_pop = 0
-    for idx in range(len(d)):
-        if d[idx].pos <= step:
-            count_ele_to_pop += 1
-        else:
-            break
-    
-    #pop from left
-    for i in range(count_ele_to_pop):
-        d.popleft()
-
-
-
 def _count_rare_SNVs(window_data, maf_thresh):
     """
     Helper function used to count the number of SNVs below the specified MAF threshold in a window.
 
-    :param window_data: a window of data from csv parsed with `MafCsvRowLoader`
+    :param window_data: minor allele frequencies of the variants in a window
     :param maf_thresh: minor allele frequnecy threshold below which to count variants
 
-    :type window_data: deque
+    :type window_data: np.ndarray of float
     :type maf_thresh: float
 
     :returns: count of rare variants for that window
     :rtype: int
     """
 
-    #iterating through window and counting rare variants
-    rare_snv_count = 0
-    for snv in window_data:
-        if snv.maf <= maf_thresh and snv.maf > 0:
-            rare_snv_count += 1
+    #counting rare variants over the whole window at once (see haplotype_matrix/window_kernels.py)
+    rare_snv_count = count_rare(window_data, maf_thresh)
 
     return rare_snv_count
 
@@ -118,21 +100,18 @@ def _count_common_SNPs(window_data, maf_thresh):
     """
     Helper function used to count the number of SNPs above the specified MAF threshold in a window.
 
-    :param window_data: a window of data from csv parsed with `MafCsvRowLoader`
+    :param window_data: minor allele frequencies of the variants in a window
     :param maf_thresh: minor allele frequnecy threshold below which to count variants
 
-    :type window_data: deque
+    :type window_data: np.ndarray of float
     :type maf_thresh: float
 
     :returns: count of common SNP variants for that window
     :rtype: int
     """
 
-    #iterating through window and counting rare variants
-    common_snp_count = 0
-    for snv in window_data:
-        if snv.maf >= maf_thresh:
-            common_snp_count += 1
+    #counting common variants over the whole window at once (see haplotype_matrix/window_kernels.py)
+    common_snp_count = count_common(window_data, maf_thresh)
 
     return common_snp_count
 
@@ -143,7 +122,7 @@ def _count_common_SNPs(window_data, maf_thresh):
 
 ### MAIN FUNCTIONS ###
 
-def persite_MAF(vcfgz, GTindex=9):
+def persite_MAF(vcfgz, GTindex=9, decompress_threads=1):
     """
     Function takes a gzipped vcf file and estimates the minor allele frequency at each record.
     The output is a csv file with the same basename as the vcf + _MAF.csv saved to the same directory.
@@ -152,13 +131,15 @@ def persite_MAF(vcfgz, GTindex=9):
 
     :param vcfgz: filename of input vcf.gz
     :param GTindex: optional argument to denote the index position of the starting Genotype column. Make sure you check this in your vcf and use python 0-based indexing
+    :param decompress_threads: optional number of threads inflating the BGZF blocks of the vcf (see haplotype_matrix/bgzf_reader.py)
     
     :type vcfgz: str
     :type GTindex: int, optional
+    :type decompress_threads: int, optional
     """
 
     #opening files
-    with gzip.open(vcfgz, "rt") as vcf, open(vcfgz.replace(".vcf.gz", "_MAF.csv"), "a") as outcsv:
+    with bgzf_open(vcfgz, "rt", threads=decompress_threads) as vcf, open(vcfgz.replace(".vcf.gz", "_MAF.csv"), "a") as outcsv:
 
         #write header line
         outcsv.write(",".join(["CHROM", "POS", "MAF"]) + "\n")
@@ -221,41 +202,41 @@ def sliding_window_SNV_count(MAFcsv, window_size, window_step, frequency, output
     def _writeout(do_we_slide):
         """
         Nested helper function that writes out the SNV count results for a window
-        to the output file. The required arguments are a row object from the deque
+        to the output file. The required arguments are a row object from the window
         and a boolean value of whether or not to slide the window after writing out.
         """
 
-        if len(window_deque) == 0:
+        if len(window) == 0:
             outbedg.write(_joinany("\t", [prev_chrom, win_start, win_end, 0]) + "\n")
         else:
             #count rare SNVs in window
-            #snv_count = _count_rare_SNVs(window_deque, frequency)
-            snv_count = _count_common_SNPs(window_deque, frequency)
+            #snv_count = _count_rare_SNVs(window.matrix(), frequency)
+            snv_count = _count_common_SNPs(window.matrix(), frequency)
             #write to file
             outbedg.write(_joinany("\t", [prev_chrom, win_start, win_end, snv_count]) + "\n")
 
         if do_we_slide == True:
             #sliding to next step
-            _pop_bp_step(window_deque, win_step)
+            window.pop_to(win_step)
 
 
 
     def _append_OR_increment_and_append(row):
         """
-        Nested helper function that either appends the current row to the deque
-        or increments window to the row's position and appends to the deque, 
+        Nested helper function that either appends the current row to the window
+        or increments window to the row's position and appends to the window, 
         writing out to the outputfile while doing so. The required argument is
-        a row object from the deque.
+        a row object from the window.
         """
 
         #because these variables will be modified
         nonlocal win_start, win_end, win_step
 
-        #decide whether to append to deque or increment window then append to deque
+        #decide whether to append to window or increment window then append to window
         if row.pos < win_start:
             exit("Record position before window start position")
         if row.pos <= win_end:
-            window_deque.append(row)
+            window.append(row.pos, row.maf)
         else:
             #increment window until position is reached, each window increment writes count to output file until current row position is reached
             for i in range(win_end, row.pos, window_step):
@@ -268,15 +249,15 @@ def sliding_window_SNV_count(MAFcsv, window_size, window_step, frequency, output
                 win_start = win_end - window_size + 1
                 win_step = win_start + window_step
 
-            #append current record to deque
-            window_deque.append(row)
+            #append current record to window
+            window.append(row.pos, row.maf)
 
 
 
 
 
-    #setting up deque for sliding window
-    window_deque = deque()
+    #setting up the array-backed sliding window of MAFs (see haplotype_matrix/window_buffer.py)
+    window = WindowBuffer(dtype=np.float64)
 
     #open files
     with open(MAFcsv, "r") as csvf, open(f"{output}.bedgraph", "a") as outbedg:
@@ -309,11 +290,11 @@ def sliding_window_SNV_count(MAFcsv, window_size, window_step, frequency, output
             if row.chrom == prev_chrom:
                 _append_OR_increment_and_append(row)
             else:
-                #count SNVs, write out deque, and no need to slide window
+                #count SNVs, write out window, and no need to slide window
                 _writeout(False)
 
-                #dump out deque
-                window_deque.clear()
+                #dump out window
+                window.clear()
 
                 #set new chromosome
                 prev_chrom = row.chrom
@@ -323,14 +304,14 @@ def sliding_window_SNV_count(MAFcsv, window_size, window_step, frequency, output
                 win_end = window_size
                 win_step = window_step
 
-                #decide whether to append to deque or increment window then append to deque
+                #decide whether to append to window or increment window then append to window
                 _append_OR_increment_and_append(row)
 
         #clean up last window
-        if len(window_deque) > 0:
+        if len(window) > 0:
             #count rare SNVs in window
-            #snv_count = _count_rare_SNVs(window_deque, frequency)
-            snv_count = _count_common_SNPs(window_deque, frequency)
+            #snv_count = _count_rare_SNVs(window.matrix(), frequency)
+            snv_count = _count_common_SNPs(window.matrix(), frequency)
             #write to file
             outbedg.write(_joinany("\t", [row.chrom, win_start, win_end, snv_count]) + "\n")
 
@@ -350,6 +331,7 @@ def sliding_window_SNV_count(MAFcsv, window_size, window_step, frequency, output
 # sliding_window_SNV_count("beagle_biallelic_SNPs_1000GP30X_AllChr_MAF.csv", 500000, 50000, 0.01, "win500Kb_step50Kb_0.01_SNV_count")
 
 
-sliding_window_SNV_count("beagle_biallelic_SNPs_1000GP30X_AllChr_MAF.csv", 10000, 1000, 0.01, "win10Kb_step1Kb_0.01_SNP_count")
-sliding_window_SNV_count("beagle_biallelic_SNPs_1000GP30X_AllChr_MAF.csv", 100000, 10000, 0.01, "win100Kb_step10Kb_0.01_SNP_count")
-sliding_window_SNV_count("beagle_biallelic_SNPs_1000GP30X_AllChr_MAF.csv", 500000, 50000, 0.01, "win500Kb_step50Kb_0.01_SNP_count")
\ No newline at end of file
+if __name__ == '__main__':
+    sliding_window_SNV_count("beagle_biallelic_SNPs_1000GP30X_AllChr_MAF.csv", 10000, 1000, 0.01, "win10Kb_step1Kb_0.01_SNP_count")
+    sliding_window_SNV_count("beagle_biallelic_SNPs_1000GP30X_AllChr_MAF.csv", 100000, 10000, 0.01, "win100Kb_step10Kb_0.01_SNP_count")
+    sliding_window_SNV_count("beagle_biallelic_SNPs_1000GP30X_AllChr_MAF.csv", 500000, 50000, 0.01, "win500Kb_step50Kb_0.01_SNP_count")
\ No newline at end of file